@@ -47,15 +47,24 @@ class CZOHSAccount(object):
         # uname -> hs obj
         return self._uname_hs_dict.get(uname).hs
 
-    def get_hs_by_czo(self, czo):
+    def get_unames(self):
+
+        return list(self._df["uname"].unique())
+
+    def get_account_by_czo(self, czo):
 
         # czo -> uname
         uname = self.query("czo", czo, "uname", case_sensitive=False)
-        # uname -> hs obj
+        # uname -> HSAccount obj
         hs_account_info = self._uname_hs_dict.get(uname)
         if hs_account_info is None:
             logging.warning("Not found HS account for CZO {}".format(czo))
             hs_account_info = self._uname_hs_dict.get(self.get_uname_by_czo("default"))
+        return hs_account_info
+
+    def get_hs_by_czo(self, czo):
+
+        hs_account_info = self.get_account_by_czo(czo)
         logging.info("Connecting to {} with account {}".format(hs_account_info.hs_url, hs_account_info.uname))
 
         return hs_account_info.hs
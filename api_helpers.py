@@ -3,13 +3,24 @@ import logging
 import os
 import shutil
 import tempfile
+import uuid
+import zipfile
+from urllib.parse import unquote
 
 import pandas as pd
 import requests
 from hs_restclient import HydroShare, HydroShareAuthBasic
 
-from file_ops import extract_fileinfo_from_url, retry_func
-from settings import logger, headers, MORE_TMP
+from file_ops import extract_fileinfo_from_url, fetch_file, retry_func, release_staged_file, open_source_stream, \
+    remove_download
+from settings import logger, headers, MORE_TMP, MB_TO_BYTE, METADATA_BATCH_UPDATE, FILE_OPS_BATCH, \
+    FILE_OPS_WORKERS, FILE_BUNDLE, BUNDLE_MAX_FILE_MB, BUNDLE_MAX_FILES, BUNDLE_MAX_MB, STREAM_UPLOADS
+from http_client import get_http_client
+from dead_urls import get_dead_url_registry
+from journal import JOURNAL_LOG_LISTS
+from retry_policy import DeadUrlError
+from czo_data import build_files_table
+from util import run_bounded_per_key
 from utils_logging import log_exception
 
 # TODO move to settings and test
@@ -47,14 +58,21 @@ def get_creator_hs_metadata(creator_list):
     return hs_creator_list
 
 
-def get_files(component_files, migration_log=None, other_urls=[]):
+def get_files(file_rows, migration_log=None, download=True, check_urls=None):
     """
     This is a generator that returns a resource file dict in each iterate
-    :param in_str: file field
-    :return: None
+    :param file_rows: files table rows of a CZO row (see czo_data.build_files_table)
+    :param migration_log: migration log dict
+    :param download: False to leave files to be downloaded by fetch_file (see extract_fileinfo_from_url)
+    :param check_urls: urls to classify by size (cache/HEAD) and download; the other files only get their
+                       file names (check_size False); None for all
+    :return: file dict; 1 on error; 2 for a skipped metadata file
     """
     file_name_used_dict = {}
 
+    def _check_size(url):
+        return check_urls is None or url in check_urls
+
     # # deal with readme.md file first to avoid potential naming conflict with component files
     # if os.path.isfile(readme_path):
     #     file_name_used_dict[README_FILENAME] = 0  # mark "readme.md" as used
@@ -69,70 +87,72 @@ def get_files(component_files, migration_log=None, other_urls=[]):
     #
     #     yield readme_file_info
 
-    # loop through component files and metadata files
-    for f_str in component_files.split("|"):
-        try:
-            f_info_list = f_str.split("$")
-            f_location = f_info_list[0]
-            f_topic = f_info_list[1]
-            f_url = f_info_list[2].strip()
-            f_data_level = f_info_list[3]
-            f_private = f_info_list[4]
-            f_doi = f_info_list[5]
-            # TODO handle this in a more centralized way
-            f_metadata_url = f_info_list[6].strip()
-
-            ref_file_name = f_location + "-" + f_topic
-            file_info = extract_fileinfo_from_url(f_url, ref_file_name,
-                                                  file_name_used_dict=file_name_used_dict,
-                                                  private_flag=(f_private.lower() == "y"))
-
-            file_info["metadata"] = {"title": ref_file_name,
-                                     #"spatial_coverage": {"name": f_location,},  # doesnt work without bounding box
-                                     "extra_metadata": {"private": f_private,
-                                                        "url": f_url,
-                                                        "location": f_location,
-                                                        "doi": f_doi,
-                                                        },  # extra_metadata
-                                     }
-            yield file_info
-        except Exception as ex:
-            extra_msg = "Failed to parse resource file from component {}".format(f_str)
-            log_exception(ex, migration_log=migration_log, extra_msg=extra_msg)
-            yield 1
-
-        try:
-            metadata_file_info = extract_fileinfo_from_url(f_metadata_url, ref_file_name,
-                                                           file_name_used_dict=file_name_used_dict,
-                                                           skip_invalid_url=True)
-            if metadata_file_info is None:
+    # component files each followed by its metadata file, then map/kml
+    file_info = None
+    for row in file_rows:
+        if row["kind"] == "component":
+            file_info = None
+            try:
+                if not row["parse_ok"]:
+                    raise Exception("Malformed component (expected location$topic$url$data_level$private$doi"
+                                    "$metadata_url)")
+                ref_file_name = row["location"] + "-" + row["topic"]
+                file_info = extract_fileinfo_from_url(row["url"], ref_file_name,
+                                                      file_name_used_dict=file_name_used_dict,
+                                                      private_flag=row["is_private"], download=download,
+                                                      check_size=_check_size(row["url"]))
+
+                file_info["metadata"] = {"title": ref_file_name,
+                                         #"spatial_coverage": {"name": f_location,},  # doesnt work without bounding box
+                                         "extra_metadata": {"private": row["private"],
+                                                            "url": row["url"],
+                                                            "location": row["location"],
+                                                            "doi": row["doi"],
+                                                            },  # extra_metadata
+                                         }
+                yield file_info
+            except Exception as ex:
+                extra_msg = "Failed to parse resource file from component {}${}${}".format(
+                    row["location"], row["topic"], row["url"])
+                log_exception(ex, migration_log=migration_log, extra_msg=extra_msg)
+                yield 1
+
+        elif row["kind"] == "metadata":
+            if not row["url_valid"]:
                 yield 2
-            else:
-                metadata_file_info["metadata"]["extra_metadata"] = {"metadata_url": f_metadata_url}
+                continue
+            try:
+                ref_file_name = row["location"] + "-" + row["topic"]
+                metadata_file_info = extract_fileinfo_from_url(row["url"], ref_file_name,
+                                                               file_name_used_dict=file_name_used_dict,
+                                                               download=download,
+                                                               check_size=_check_size(row["url"]))
+                metadata_file_info["metadata"]["extra_metadata"] = {"metadata_url": row["url"]}
                 if file_info is not None:
                     metadata_file_info["metadata"]["title"] = "Metadata File for {}".format(file_info["file_name"])
 
                 yield metadata_file_info
-        except Exception as ex:
-            extra_msg = "Failed to parse metadata file from component {}".format(f_str)
-            log_exception(ex, migration_log=migration_log, extra_msg=extra_msg)
-            yield 1
+            except Exception as ex:
+                extra_msg = "Failed to parse metadata file from component {}".format(row["url"])
+                log_exception(ex, migration_log=migration_log, extra_msg=extra_msg)
+                yield 1
 
-    # other urls - map/kml
-    for url in other_urls:
-        try:
-            url = url.strip()
-            ref_file_name = "map_or_kml"
-            other_file_info = extract_fileinfo_from_url(url, ref_file_name,
-                                                        file_name_used_dict=file_name_used_dict)
-            other_file_info["metadata"]["extra_metadata"] = {"url": url}
-            other_file_info["tag"] = "map"
-
-            yield other_file_info
-        except Exception as ex:
-            extra_msg = "Failed to parse map/kml field {}".format(url)
-            log_exception(ex, migration_log=migration_log, extra_msg=extra_msg)
-            yield 1
+        else:
+            # other urls - map/kml
+            try:
+                ref_file_name = "map_or_kml"
+                other_file_info = extract_fileinfo_from_url(row["url"], ref_file_name,
+                                                            file_name_used_dict=file_name_used_dict,
+                                                            download=download,
+                                                            check_size=_check_size(row["url"]))
+                other_file_info["metadata"]["extra_metadata"] = {"url": row["url"]}
+                other_file_info["tag"] = row["tag"]
+
+                yield other_file_info
+            except Exception as ex:
+                extra_msg = "Failed to parse map/kml field {}".format(row["url"])
+                log_exception(ex, migration_log=migration_log, extra_msg=extra_msg)
+                yield 1
 
 
 def safe_get(url, timeout=10, headers=headers, stream=False, verify=True):
@@ -145,7 +165,7 @@ def safe_get(url, timeout=10, headers=headers, stream=False, verify=True):
     r = {"url_asked": url, "status_code": 400, "error": "", "text": "", "history": ""}
     try:
         # sending headers is very important or in some cases requests.get() wont download the actual file content/binary
-        req = requests.get(url, headers=headers, timeout=timeout, stream=stream, verify=verify)
+        req = get_http_client().get(url, headers=headers, timeout=timeout, stream=stream, verify=verify)
         r['requested'] = url
         r['status_code'] = req.status_code
         r['history'] = str(req.history)
@@ -209,6 +229,28 @@ def get_file_id_by_name(hs, resource_id, fname):
     return file_id
 
 
+def get_resource_file_names(hs, resource_id):
+    """
+    Names of all files in a resource (same listing as get_file_id_by_name)
+    :param hs: hs obj from initialized hs_restclient
+    :param resource_id: res id
+    :return: set of file names
+    """
+    resource = hs.resource(resource_id)
+    file = ""
+    for f in resource.files.all():
+        file += f.decode('utf8')
+    file_json = json.loads(file)
+    return set(unquote(str(file["url"]).rstrip("/").split("/")[-1]) for file in file_json["results"])
+
+
+def _names_on_resource(file_name, file_names):
+    # referenced files may have been added as NOT_RESOLVING_URL_ and get a .url suffix on HS
+    names = [file_name, "NOT_RESOLVING_URL_{}".format(file_name)]
+    names += ["{}.url".format(name) for name in names]
+    return [name for name in names if name in file_names]
+
+
 def _update_core_metadata(hs_obj, hs_id, metadata_dict, message=None, migration_log=None):
     """
        Update core metadata for a HydroShare
@@ -234,6 +276,51 @@ def _update_core_metadata(hs_obj, hs_id, metadata_dict, message=None, migration_
         return result, science_metadata_json
 
 
+def _update_core_metadata_bisect(hs_obj, hs_id, sections, migration_log=None):
+    """
+    Update several core metadata sections with a single updateScienceMetadata call; if it fails, split the
+    sections in halves and update each half the same way, so only the bad sections fail (and get logged)
+    :param hs_obj: hs obj initialized by hs_restclient
+    :param hs_id: resource id
+    :param sections: list of update_metadata ops ({"message", "metadata"})
+    :param migration_log: migration log dict
+    :return: list of messages of the sections that failed
+    """
+    if len(sections) == 1:
+        _success_section, _ = _update_core_metadata(hs_obj, hs_id, sections[0]["metadata"],
+                                                    message=sections[0]["message"],
+                                                    migration_log=migration_log)
+        return [] if _success_section else [sections[0]["message"]]
+
+    metadata_dict = {}
+    for section in sections:
+        metadata_dict.update(section["metadata"])
+    message = ", ".join(section["message"] for section in sections)
+    try:
+        hs_obj.updateScienceMetadata(hs_id, metadata=metadata_dict)
+        logging.info('{message} updated successfully'.format(message=message))
+        return []
+    except Exception as ex:
+        logging.warning("Failed to update {} at once; bisecting: {}".format(message, ex))
+    half = len(sections) // 2
+    return _update_core_metadata_bisect(hs_obj, hs_id, sections[:half], migration_log=migration_log) + \
+        _update_core_metadata_bisect(hs_obj, hs_id, sections[half:], migration_log=migration_log)
+
+
+def _batch_metadata_ops(ops, done_steps):
+    # merge runs of consecutive update_metadata ops not done yet into update_metadata_batch ops
+    batched = []
+    for op in ops:
+        if op["op"] == "update_metadata" and get_op_key(op) not in done_steps:
+            if len(batched) > 0 and batched[-1]["op"] == "update_metadata_batch":
+                batched[-1]["sections"].append(op)
+            else:
+                batched.append({"op": "update_metadata_batch", "sections": [op]})
+        else:
+            batched.append(op)
+    return batched
+
+
 def get_czo_list_from_csv(_num):
     """
     Read czo ids from a csv file
@@ -324,45 +411,62 @@ def string_to_list(in_str, delimiter='|'):
     return in_str.split(delimiter) if in_str is not None else []
 
 
-def create_hs_res_from_czo_row(czo_res_dict, czo_hs_account_obj, index=-99, ):
+def get_czo_primary(czo_res_dict):
     """
-    Create a HydroShare resource from a CZO data row
+    Decide which CZO (and so which HS account) owns the resource of a CZO data row
     :param czo_res_dict: dict of CZO data row
-    :return: {"success": False,
-                 "czo_id": -1,
-                 "hs_id": -1,
-                 "ref_file_list": [],
-                 "concrete_file_list": [],
-                 "error_msg": "success",
-                 }
+    :return: (czo_primary, czos_list)
     """
+    czos = _extract_value_from_df_row_dict(czo_res_dict, "CZOS")
+    czos_list = czos.split('|')
+    czo_primary = czos_list[0]
+    if len(czos_list) > 1:
+        czo_primary = "national"  # cross-czo res goes to national account
+    return czo_primary, czos_list
 
-    migration_log = {"success": False,
-                   "czo_id": -1,
-                   "hs_id": -1,
-                   "ref_file_list": [],
-                   "bad_ref_file_list": [],
-                   "concrete_file_list": [],
-                   "error_msg_list": [],
-                   "uname": None,
-                   "public": False,
-                   "maps":[],
-                   }
 
-    _success = False
+def plan_hs_res_from_czo_row(czo_res_dict, czo_hs_account_obj, index=-99, file_rows=None, download=False,
+                             check_urls=None):
+    """
+    Work out everything needed to create a HydroShare resource from a CZO data row without writing to HydroShare:
+    owner account, metadata payloads, file names and SingleFile/ReferencedFile classification
+    (from the cache and HEAD requests only, unless download is True)
+    :param czo_res_dict: dict of CZO data row
+    :param czo_hs_account_obj: CZOHSAccount obj
+    :param index: row number (for logging)
+    :param file_rows: files table rows of the CZO row (see czo_data.get_files); built from czo_res_dict if None
+    :param download: download SingleFile files now rather than in apply_hs_res_plan
+    :param check_urls: urls of the files to classify; the others are planned by name only (see get_files)
+    :return: json-serializable plan
+             {"czo_id": czo_id,
+              "index": index,
+              "uname": HS account to own the resource,
+              "ok": False if the row couldn't be parsed,
+              "file_errors": number of files that couldn't be planned,
+              "error_msg_list": [],
+              "ops": [{"op": "create_resource" | "scimeta_custom" | "update_metadata" | "add_file" | "make_public",
+                       ...op arguments}],
+              }
+    """
+    migration_log = {"error_msg_list": []}
+    plan = {"czo_id": -1,
+            "index": index,
+            "uname": None,
+            "ok": False,
+            "file_errors": 0,
+            "error_msg_list": migration_log["error_msg_list"],
+            "ops": [],
+            }
     try:
         # parse resource-level metadata
         # parse czo_id
         czo_id = _extract_value_from_df_row_dict(czo_res_dict, "czo_id")
-        migration_log["czo_id"] = czo_id
+        plan["czo_id"] = czo_id
         logging.info("Working on NO.{index} CZO_ID {czo_id}".format(index=index, czo_id=czo_id))
 
         # parse CZOS
-        czos = _extract_value_from_df_row_dict(czo_res_dict, "CZOS")
-        czos_list = czos.split('|')
-        czo_primary = czos_list[0]
+        czo_primary, czos_list = get_czo_primary(czo_res_dict)
         if len(czos_list) > 1:
-            czo_primary = "national"  # cross-czo res goes to national account
             logging.info("Cross-CZO resource to be created by National account: {}".format(czos_list))
 
         # parse title, subtitle, description, comments
@@ -397,10 +501,6 @@ def create_hs_res_from_czo_row(czo_res_dict, czo_hs_account_obj, index=-99, ):
         # parse citation, data_doi
         citation = _extract_value_from_df_row_dict(czo_res_dict, "citation", required=False)
         dataset_doi = _extract_value_from_df_row_dict(czo_res_dict, "dataset_doi", required=False)
-        map_uploads = _extract_value_from_df_row_dict(czo_res_dict, "map_uploads", required=False)
-        map_uploads_list = string_to_list(map_uploads)
-        kml_files = _extract_value_from_df_row_dict(czo_res_dict, "kml_files", required=False)
-        kml_files_list = string_to_list(kml_files)
 
         # parse TOPICS, KEYWORDS
         topics = _extract_value_from_df_row_dict(czo_res_dict, "TOPICS")
@@ -536,7 +636,7 @@ def create_hs_res_from_czo_row(czo_res_dict, czo_hs_account_obj, index=-99, ):
         if related_datasets is not None:
             hs_extra_metadata["related_datasets"] = ", ".join(related_datasets_list)
 
-        hs = czo_hs_account_obj.get_hs_by_czo(czo_primary)
+        plan["uname"] = czo_hs_account_obj.get_account_by_czo(czo_primary).uname
 
         # Since current HydroShare REST API and hs_restclient DO NOT return specific error message,
         # sending a Big JSON to create a complete HydroShare resource is hard to debug
@@ -545,52 +645,26 @@ def create_hs_res_from_czo_row(czo_res_dict, czo_hs_account_obj, index=-99, ):
 
         # create a Composite Resource with title, extra metadata
         # extra metadata is uploaded here because I haven't found a way to update it separately
-        hs_id = hs.createResource("CompositeResource",
-                                  hs_res_title,
-                                  )
-        migration_log["hs_id"] = hs_id
-        migration_log["uname"] = "{}".format(hs.auth.username)  # export owner of this hs res
-        logging.info('HS resource created at: {hs_id}'.format(hs_id=hs_id))
-
-        # update Extended Metadata
-        hs.resource(hs_id).scimeta.custom(hs_extra_metadata)
-
-        # update Abstract/Description
-        _success_abstract, _ = _update_core_metadata(hs, hs_id,
-                                                     {"description": hs_res_abstract.replace('[CRLF]', '\n\n')}, # TODO verify change
-                                                     message="Abstract",
-                                                     migration_log=migration_log)
-
-        # update Keywords/Subjects
-        _success_keyword, _ = _update_core_metadata(hs, hs_id,
-                                                    {"subjects": [{"value": kw} for kw in hs_res_keywords]},
-                                                    message="Keyword",
-                                                    migration_log=migration_log)
-
-        # update creators
-        _success_creator, _ = _update_core_metadata(hs, hs_id,
-                                                    {"creators": hs_creator_list},
-                                                    message="Author",
-                                                    migration_log=migration_log)
-
-        # update coverage
-        # spatial coverage and period coverage must be updated at the same time
-        # as updating any single one would remove the other
-        _success_coverage, _ = _update_core_metadata(hs, hs_id,
-                                                     {'coverages': [hs_coverage_spatial, hs_coverage_period]},
-                                                     message="Coverage",
-                                                     migration_log=migration_log)
-
-        # update award grants
-        _success_grants= True
+        ops = [{"op": "create_resource", "resource_type": "CompositeResource", "title": hs_res_title},
+               {"op": "scimeta_custom", "metadata": hs_extra_metadata},
+               {"op": "update_metadata", "message": "Abstract",
+                "metadata": {"description": hs_res_abstract.replace('[CRLF]', '\n\n')}},  # TODO verify change
+               {"op": "update_metadata", "message": "Keyword",
+                "metadata": {"subjects": [{"value": kw} for kw in sorted(hs_res_keywords)]}},
+               {"op": "update_metadata", "message": "Author",
+                "metadata": {"creators": hs_creator_list}},
+               # spatial coverage and period coverage must be updated at the same time
+               # as updating any single one would remove the other
+               {"op": "update_metadata", "message": "Coverage",
+                "metadata": {'coverages': [hs_coverage_spatial, hs_coverage_period]}},
+               ]
+
+        # award grants
         if len(hs_award_grants_list) > 0:
-            _success_grants, _ = _update_core_metadata(hs, hs_id,
-                                                       {'funding_agencies': hs_award_grants_list},
-                                                       message="Funding_agencies",
-                                                       migration_log=migration_log)
+            ops.append({"op": "update_metadata", "message": "Funding_agencies",
+                        "metadata": {'funding_agencies': hs_award_grants_list}})
 
-        # update relations for publication of this data
-        _success_relations = True
+        # relations for publication of this data
         if publications_of_this_data is not None:
             pub_list = publications_of_this_data.split('|')
             hs_relations_list = []
@@ -601,119 +675,543 @@ def create_hs_res_from_czo_row(czo_res_dict, czo_hs_account_obj, index=-99, ):
                         "value": pub_item[:499]
                     }
                 )
-            # hs_relations_list = [{
-            #         "type": "isDataFor",
-            #         "value": publications_of_this_data[:499]
-            #     }]
-
-            _success_relations, _ = _update_core_metadata(hs, hs_id,
-                                                       {'relations': hs_relations_list},
-                                                       message="Relations",
-                                                       migration_log=migration_log)
-
-        _success_file = True
-        other_urls = [] + map_uploads_list + kml_files_list
-        # component_files field
-        component_files = czo_res_dict['COMPONENT_FILES-location$topic$url$data_level$private$doi$metadata_url']
-
-        for f in get_files(component_files, migration_log=migration_log, other_urls=other_urls):
+            ops.append({"op": "update_metadata", "message": "Relations",
+                        "metadata": {'relations': hs_relations_list}})
+
+        if file_rows is None:
+            file_rows = build_files_table(pd.DataFrame([czo_res_dict])).to_dict(orient='records')
+
+        for f in get_files(file_rows, migration_log=migration_log, download=download, check_urls=check_urls):
             if f == 1:
-                _success_file = False
+                plan["file_errors"] += 1
+            elif f == 2 or f is None:
                 continue
-            elif f == 2:
+            else:
+                ops.append({"op": "add_file", "file": f})
+
+        # make the resource public
+        ops.append({"op": "make_public"})
+
+        plan["ops"] = ops
+        plan["ok"] = True
+
+    except Exception as ex:
+        extra_msg = "Failed to migrate CZO dict {}: ".format(json.dumps(czo_res_dict))
+        log_exception(ex, migration_log=migration_log, extra_msg=extra_msg)
+
+    return plan
+
+
+def _check_response(response, what):
+    """
+    Raise on a non-2xx raw response (hs.resource(...).functions/files calls return it; HTTP errors don't raise)
+    :param response: requests response
+    :param what: what the call did, for the error message
+    :return: response
+    """
+    if not 200 <= response.status_code < 300:
+        raise Exception("{} failed ({}): {}".format(what, response.status_code, response.text[:200]))
+    return response
+
+
+def _run_file_op(hs, hs_id, file_op):
+    if file_op["set_file_type"]:
+        # set Content Type to file
+        options = {
+            "file_path": file_op["file_id"],
+            "hs_file_type": "SingleFile"
+        }
+        try:
+            _check_response(hs.resource(hs_id).functions.set_file_type(options),
+                            "Set file type of {}".format(file_op["file_id"]))
+        except Exception as ex:
+            # the file keeps the type HS detected; its metadata is set anyway
+            logging.warning("Failed to set file type of {} on {}: {}".format(file_op["file_id"], hs_id, ex))
+    _check_response(hs.resource(hs_id).files.metadata(file_op["file_id"], file_op["metadata"]),
+                    "Set file metadata of {}".format(file_op["file_id"]))
+
+
+def run_file_ops(hs, hs_id, file_ops, migration_log):
+    """
+    Set file types and file metadata of the files added to a resource, FILE_OPS_WORKERS at a time;
+    failed items are logged and listed in migration_log["file_op_failures"]
+    :param hs: hs obj
+    :param hs_id: resource id
+    :param file_ops: list of {"file_name", "file_id", "set_file_type", "metadata"} from _add_file
+    :param migration_log: migration log dict
+    :return: list of file ops that succeeded
+    """
+    succeeded = []
+
+    def _on_file_op_done(key, args, result, ex):
+        file_op = args[2]
+        if ex is None:
+            succeeded.append(file_op)
+            return
+        migration_log["file_op_failures"].append({"file_name": file_op["file_name"],
+                                                  "file_id": file_op["file_id"],
+                                                  "error": str(ex)})
+        extra_msg = "Failed to set file type/metadata of {} on {}: ".format(file_op["file_name"], hs_id)
+        log_exception(ex, migration_log=migration_log, extra_msg=extra_msg)
+
+    tasks = [(hs_id, _run_file_op, (hs, hs_id, file_op)) for file_op in file_ops]
+    run_bounded_per_key(tasks, FILE_OPS_WORKERS, FILE_OPS_WORKERS, _on_file_op_done)
+    logging.info("File types/metadata of {} files set on {}; {} failed".format(
+        len(succeeded), hs_id, len(file_ops) - len(succeeded)))
+    return succeeded
+
+
+def _bundle_candidate(f):
+    """
+    Download a planned concrete file if needed and tell whether it is small enough to go in a bundle
+    :param f: file dict of an add_file op
+    :return: bool
+    """
+    if f["file_type"] == "ReferencedFile":
+        return False
+    if not f.get("downloaded"):
+        try:
+            fetch_file(f)
+        except Exception:
+            # _add_file tries again and logs the error
+            return False
+    return f["file_type"] != "ReferencedFile" and 0 <= f["file_size_mb"] <= BUNDLE_MAX_FILE_MB
+
+
+def _add_file_bundle(hs, hs_id, files):
+    """
+    Upload downloaded concrete files as one zip and unzip it on HS in place (file names are kept)
+    :param hs: hs obj
+    :param hs_id: resource id
+    :param files: file dicts of add_file ops
+    :return: set of file names on HS now: all on success, those the unzip got to on failure, none for a single file
+    """
+    if len(files) < 2:
+        return set()
+    bundle_dir = tempfile.mkdtemp()
+    zip_name = "czo2hs_bundle_{}.zip".format(uuid.uuid4().hex)
+    zip_path = os.path.join(bundle_dir, zip_name)
+    try:
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for f in files:
+                zf.write(f["path_or_url"], arcname=f["file_name"])
+        size_mb = float(os.path.getsize(zip_path)) / MB_TO_BYTE
+        hs.addResourceFile(hs_id, zip_path)
+        # returns the raw response; HTTP errors don't raise
+        unzip_response = hs.resource(hs_id).functions.unzip({"zip_with_rel_path": zip_name,
+                                                             "remove_original_zip": "true",
+                                                             "overwrite": "false"})
+        _check_response(unzip_response, "Unzip of {}".format(zip_name))
+        logging.info("Uploaded {} files as {}: {:.2f} MB ({:.2f} MB unzipped)".format(
+            len(files), zip_name, size_mb, sum(f["file_size_mb"] for f in files)))
+        return set(f["file_name"] for f in files)
+    except Exception as ex:
+        logging.warning("Failed to upload {} files as {}; uploading them one by one: {}".format(
+            len(files), zip_name, ex))
+        try:
+            file_names = get_resource_file_names(hs, hs_id)
+            if zip_name in file_names:
+                hs.deleteResourceFile(hs_id, zip_name)
+            return set(f["file_name"] for f in files if f["file_name"] in file_names)
+        except Exception:
+            return set()
+    finally:
+        shutil.rmtree(bundle_dir, ignore_errors=True)
+
+
+def _stream_upload(hs, hs_id, f):
+    """
+    Upload a concrete file straight from its source (see file_ops.SourceStream)
+    :param hs: hs obj
+    :param hs_id: resource id
+    :param f: file dict of an add_file op; file_md5 and file_size_mb are set on success
+    :return: response of addResourceFile; None if the file wasn't streamed and has to be downloaded
+    """
+    url = f["original_url"]
+    try:
+        stream = open_source_stream(url)
+    except Exception as ex:
+        logging.warning("Can't stream {}; downloading it: {}".format(url, ex))
+        return None
+    if stream is None:
+        return None
+    try:
+        file_add_respone = hs.addResourceFile(hs_id, stream, resource_filename=f["file_name"])
+        if not stream.complete():
+            raise IOError("Source ended after {} of {} bytes".format(stream.tell(), stream.len))
+    except Exception as ex:
+        # a stream can't be sent twice; the disk copy can
+        logging.warning("Streaming upload of {} failed; downloading it: {}".format(url, ex))
+        try:
+            if f["file_name"] in get_resource_file_names(hs, hs_id):
+                hs.deleteResourceFile(hs_id, f["file_name"])
+        except Exception:
+            pass
+        return None
+    finally:
+        stream.close()
+    logging.info("Streamed {} --> {} {:.2f} MB".format(url, hs_id, float(stream.len) / MB_TO_BYTE))
+    f["file_md5"] = stream.md5.hexdigest()
+    f["streamed"] = True
+    if f["file_size_mb"] < 0:
+        f["file_size_mb"] = float(stream.len) / MB_TO_BYTE
+    return file_add_respone
+
+
+def _add_file(hs, hs_id, f, migration_log, file_ops=None, hs_file_path=None):
+    """
+    Add a planned file to a HS resource (streaming or downloading it first if the plan didn't download it)
+    :param hs: hs obj
+    :param hs_id: resource id
+    :param f: file dict of an add_file op
+    :param migration_log: migration log dict
+    :param file_ops: list to defer setting file type and metadata to (see run_file_ops); None to set them now
+    :param hs_file_path: path of a concrete file uploaded already (see _add_file_bundle)
+    :return: True if the file was added as planned
+    """
+    _success_file = True
+    try:
+        file_add_respone = None
+        if f["file_type"] != "ReferencedFile" and not f.get("downloaded"):
+            if STREAM_UPLOADS and hs_file_path is None:
+                file_add_respone = _stream_upload(hs, hs_id, f)
+            if file_add_respone is None:
+                fetch_file(f)
+
+        logging.info("Creating file: {}".format(str(f)))
+        if f["file_type"] == "ReferencedFile":
+            path_value = ""
+            kw = {"pid": hs_id, "path": path_value, "name": f['file_name'],
+                  "ref_url": f['path_or_url'], "validate": False}
+            private_flag = f["file_name"].startswith("PRIVATE_")
+            try:
+                if f.get("dead_url") or get_dead_url_registry().is_dead(f['path_or_url']):
+                    # skip straight to the NOT_RESOLVING_URL fallback below
+                    raise DeadUrlError("Known dead url {}".format(f['path_or_url']))
+                max_tries = 1 if private_flag else 4
+                resp_dict = retry_func(hs.createReferencedFile, max_tries=max_tries, kwargs=kw)
+                # log successful ref file
+                migration_log["ref_file_list"].append(f)
+            except Exception:
+                # change failing RefContentFile URL to HS homepage
+                kw["ref_url"] = "https://www.hydroshare.org/"
+                if not private_flag:
+                    # add prefix "NOT_RESOLVING_URL_" to filename
+                    kw["name"] = "NOT_RESOLVING_URL_{}".format(kw["name"])
+                    # log not-resolving ref file
+                    migration_log["bad_ref_file_list"].append(f)
+                    _success_file = False
+                resp_dict = retry_func(hs.createReferencedFile, kwargs=kw)
+
+            file_id = resp_dict["file_id"]
+            set_file_type = False
+
+        else:
+            try:
+                if hs_file_path is None:
+                    if file_add_respone is None:
+                        # upload other files with auto file type detection
+                        file_add_respone = hs.addResourceFile(hs_id, f["path_or_url"])
+                    # file path in HS res
+                    hs_file_path = file_add_respone["file_path"]
+            finally:
+                if f.get("downloaded"):
+                    release_staged_file(f["original_url"])
+                    remove_download(f["path_or_url"])
+
+            # record map files
+            if f["tag"] == "map" and hs_file_path.lower().endswith(('.jpg', '.jpeg', '.bmp', '.png')):
+                migration_log["maps"].append(hs_file_path)
+
+            # This will be simplified by new hs_restclient PR
+            # find file id
+            #file_id = get_file_id_by_name(hs, hs_id, f["file_name"])
+            file_id = hs_file_path
+            set_file_type = True
+
+            # log concrete file
+            migration_log["concrete_file_list"].append(f)
+
+        file_op = {"file_name": f["file_name"], "file_id": file_id, "set_file_type": set_file_type,
+                   "metadata": f["metadata"]}
+        if file_ops is None:
+            _run_file_op(hs, hs_id, file_op)
+        else:
+            file_ops.append(file_op)
+    except Exception as ex_file:
+        _success_file = False
+        extra_msg = "Failed upload file to HS {}: ".format(json.dumps(f))
+        log_exception(ex_file, migration_log=migration_log, extra_msg=extra_msg)
+    return _success_file
+
+
+def get_op_key(op):
+    """
+    Key of a plan op in the migration journal; stable across runs even if files are added or dropped
+    :param op: op dict
+    :return: str
+    """
+    if op["op"] == "update_metadata":
+        return "update_metadata:{}".format(op["message"])
+    if op["op"] == "add_file":
+        return "add_file:{}:{}".format(op["file"]["original_url"], op["file"]["file_name"])
+    if op["op"] == "delete_file":
+        return "delete_file:{}".format(op["file_name"])
+    if op["op"] == "update_metadata_batch":
+        return "update_metadata_batch:{}".format(",".join(section["message"] for section in op["sections"]))
+    return op["op"]
+
+
+def _log_lengths(migration_log):
+    return dict((k, len(migration_log[k])) for k in JOURNAL_LOG_LISTS)
+
+
+def _log_delta(migration_log, lengths):
+    return dict((k, migration_log[k][lengths[k]:]) for k in JOURNAL_LOG_LISTS if len(migration_log[k]) > lengths[k])
+
+
+def apply_hs_res_plan(plan, czo_hs_account_obj, journal=None, hs_index=None):
+    """
+    Create a HydroShare resource by running the ops of a plan from plan_hs_res_from_czo_row
+    With a journal each op that took effect is recorded, and ops recorded by an earlier run are skipped
+    (a resource created earlier is continued, not created again)
+    With an index a resource already on HS for the czo_id is updated in place: title and metadata are
+    overwritten and only files not on the resource yet are added
+    :param plan: plan dict
+    :param czo_hs_account_obj: CZOHSAccount obj
+    :param journal: MigrationJournal or None
+    :param hs_index: HSResourceIndex or None
+    :return: {"success": False,
+                 "czo_id": -1,
+                 "hs_id": -1,
+                 "ref_file_list": [],
+                 "concrete_file_list": [],
+                 "error_msg": "success",
+                 }
+    """
+
+    migration_log = {"success": False,
+                   "czo_id": plan["czo_id"],
+                   "hs_id": -1,
+                   "ref_file_list": [],
+                   "bad_ref_file_list": [],
+                   "concrete_file_list": [],
+                   "error_msg_list": list(plan["error_msg_list"]),
+                   "uname": None,
+                   "public": False,
+                   "maps":[],
+                   "file_op_failures": [],
+                   }
+
+    _success = False
+    try:
+        if not plan["ok"]:
+            # error logged when planning
+            return migration_log
+
+        # delta plans (see delta.py) are journaled apart from the migration of the row
+        journal_id = plan.get("journal_id", plan["czo_id"])
+        done_steps = journal.get_steps(journal_id) if journal is not None else {}
+        uname = plan["uname"]
+        hs_id = None
+        if "create_resource" in done_steps:
+            # resume: keep the owner of the resource created earlier
+            uname = done_steps["create_resource"]["uname"]
+            hs_id = done_steps["create_resource"]["hs_id"]
+            migration_log["hs_id"] = hs_id
+            migration_log["uname"] = uname
+            logging.info("Resuming CZO_ID {} on HS resource {}: {} steps done".format(
+                plan["czo_id"], hs_id, len(done_steps)))
+        existing = None
+        if hs_id is None and hs_index is not None:
+            existing = hs_index.get(plan["czo_id"])
+        if existing is not None:
+            uname = existing["uname"]
+            hs_id = existing["hs_id"]
+            migration_log["hs_id"] = hs_id
+            migration_log["uname"] = uname
+            logging.info("Updating existing HS resource {} of CZO_ID {}".format(hs_id, plan["czo_id"]))
+        hs = czo_hs_account_obj.get_hs_by_uname(uname)
+        existing_file_names = get_resource_file_names(hs, hs_id) if existing is not None else None
+        _success_metadata = True
+        _success_file = plan["file_errors"] == 0
+        ops = _batch_metadata_ops(plan["ops"], done_steps) if METADATA_BATCH_UPDATE else plan["ops"]
+        file_ops = [] if FILE_OPS_BATCH else None
+
+        def _flush_file_ops():
+            # set file types/metadata of the files added so far
+            succeeded = run_file_ops(hs, hs_id, file_ops, migration_log)
+            if journal is not None:
+                for file_op in succeeded:
+                    journal.record_step(journal_id, "file_op:{}".format(file_op["file_id"]), hs_id,
+                                        migration_log["uname"])
+            all_succeeded = len(succeeded) == len(file_ops)
+            del file_ops[:]
+            return all_succeeded
+
+        bundle = [] if FILE_BUNDLE else None
+
+        def _add_one_file(key, f, hs_file_path=None):
+            # add a file and journal it; the file is on HS if it was logged (even as NOT_RESOLVING_URL)
+            lengths = _log_lengths(migration_log)
+            n_file_ops = len(file_ops) if file_ops is not None else 0
+            ok = _add_file(hs, hs_id, f, migration_log, file_ops=file_ops, hs_file_path=hs_file_path)
+            delta = _log_delta(migration_log, lengths)
+            if journal is not None and len(delta) > 0:
+                data = file_ops[-1] if file_ops is not None and len(file_ops) > n_file_ops else None
+                journal.record_step(journal_id, key, hs_id, migration_log["uname"], ok=ok, log_delta=delta,
+                                    data=data)
+            return ok
+
+        def _flush_bundle():
+            # upload the small files collected so far
+            on_hs = _add_file_bundle(hs, hs_id, [f for _, f in bundle])
+            all_succeeded = True
+            for key, f in bundle:
+                hs_file_path = f["file_name"] if f["file_name"] in on_hs else None
+                all_succeeded = _add_one_file(key, f, hs_file_path=hs_file_path) and all_succeeded
+            del bundle[:]
+            return all_succeeded
+
+        for op in ops:
+            if op["op"] != "add_file" and bundle:
+                _success_file = _flush_bundle() and _success_file
+            if op["op"] != "add_file" and file_ops:
+                _success_file = _flush_file_ops() and _success_file
+
+            key = get_op_key(op)
+            if key in done_steps:
+                step = done_steps[key]
+                for k, items in step["log"].items():
+                    migration_log[k].extend(items)
+                if op["op"] == "add_file":
+                    _success_file = step["ok"] and _success_file
+                    # file added by an earlier run that stopped before its type/metadata were set
+                    file_op = step.get("data")
+                    if file_op is not None and "file_op:{}".format(file_op["file_id"]) not in done_steps:
+                        if file_ops is None:
+                            _run_file_op(hs, hs_id, file_op)
+                        else:
+                            file_ops.append(file_op)
+                elif op["op"] == "make_public":
+                    migration_log["public"] = True
                 continue
-            elif f is None:
+
+            if op["op"] == "add_file" and existing_file_names is not None and \
+                    len(_names_on_resource(op["file"]["file_name"], existing_file_names)) > 0:
+                logging.info("File {} is on {} already".format(op["file"]["file_name"], hs_id))
                 continue
-            try:
-                logging.info("Creating file: {}".format(str(f)))
-                if f["file_type"] == "ReferencedFile":
-                    path_value = ""
-                    kw = {"pid": hs_id, "path": path_value, "name": f['file_name'],
-                          "ref_url": f['path_or_url'], "validate": False}
-                    private_flag = f["file_name"].startswith("PRIVATE_")
-                    try:
-                        max_tries = 1 if private_flag else 4
-                        resp_dict = retry_func(hs.createReferencedFile, max_tries=max_tries, kwargs=kw)
-                        # log successful ref file
-                        migration_log["ref_file_list"].append(f)
-                    except Exception:
-                        # change failing RefContentFile URL to HS homepage
-                        kw["ref_url"] = "https://www.hydroshare.org/"
-                        if not private_flag:
-                            # add prefix "NOT_RESOLVING_URL_" to filename
-                            kw["name"] = "NOT_RESOLVING_URL_{}".format(kw["name"])
-                            # log not-resolving ref file
-                            migration_log["bad_ref_file_list"].append(f)
-                            _success_file = False
-                        resp_dict = retry_func(hs.createReferencedFile, kwargs=kw)
-
-                    file_id = resp_dict["file_id"]
 
+            lengths = _log_lengths(migration_log)
+            _done = True
+            if op["op"] == "create_resource" and existing is not None:
+                _success_section, _ = _update_core_metadata(hs, hs_id, {"title": op["title"]}, message="Title",
+                                                            migration_log=migration_log)
+                _success_metadata = _success_metadata and bool(_success_section)
+
+            elif op["op"] == "create_resource":
+                hs_id = hs.createResource(op["resource_type"],
+                                          op["title"],
+                                          )
+                migration_log["hs_id"] = hs_id
+                migration_log["uname"] = "{}".format(hs.auth.username)  # export owner of this hs res
+                logging.info('HS resource created at: {hs_id}'.format(hs_id=hs_id))
+                if hs_index is not None:
+                    hs_index.add(plan["czo_id"], hs_id, migration_log["uname"], title=op["title"])
+
+            elif op["op"] == "scimeta_custom":
+                # update Extended Metadata
+                hs.resource(hs_id).scimeta.custom(op["metadata"])
+
+            elif op["op"] == "update_metadata":
+                _success_section, _ = _update_core_metadata(hs, hs_id,
+                                                            op["metadata"],
+                                                            message=op["message"],
+                                                            migration_log=migration_log)
+                _success_metadata = _success_metadata and bool(_success_section)
+                _done = bool(_success_section)
+
+            elif op["op"] == "update_metadata_batch":
+                failed = _update_core_metadata_bisect(hs, hs_id, op["sections"], migration_log=migration_log)
+                _success_metadata = _success_metadata and len(failed) == 0
+                # journaled section by section
+                _done = False
+                if journal is not None:
+                    for section in op["sections"]:
+                        if section["message"] not in failed:
+                            journal.record_step(journal_id, get_op_key(section), hs_id, migration_log["uname"])
+
+            elif op["op"] == "add_file":
+                # copy so the plan keeps the planned file (apply may download it or turn it into a ReferencedFile)
+                f = dict(op["file"])
+                # journaled by _add_one_file
+                _done = False
+                if bundle is not None and _bundle_candidate(f):
+                    bundle.append((key, f))
+                    if len(bundle) >= BUNDLE_MAX_FILES or \
+                            sum(f_["file_size_mb"] for _, f_ in bundle) >= BUNDLE_MAX_MB:
+                        _success_file = _flush_bundle() and _success_file
                 else:
-                    # upload other files with auto file type detection
-                    file_add_respone = hs.addResourceFile(hs_id, f["path_or_url"])
+                    _success_file = _add_one_file(key, f) and _success_file
+
+            elif op["op"] == "delete_file":
+                names = _names_on_resource(op["file_name"], existing_file_names or set())
+                if len(names) == 0:
+                    logging.warning("File {} is not on {}".format(op["file_name"], hs_id))
+                for name in names:
+                    hs.deleteResourceFile(hs_id, name)
+                    existing_file_names.discard(name)
+                    logging.info("Deleted file {} from {}".format(name, hs_id))
+
+            elif op["op"] == "make_public":
+                try:
+                    hs.setAccessRules(hs_id, public=True)
+                    logging.info("Resource is made Public")
+                    migration_log["public"] = True
+                except Exception:
+                    logging.error("Failed to make Resource Public")
+                    _done = False
 
-                    # file path in HS res
-                    hs_file_path = file_add_respone["file_path"]
+            else:
+                raise Exception("Unknown op {}".format(op["op"]))
 
-                    # record map files
-                    if f["tag"] == "map" and hs_file_path.lower().endswith(('.jpg', '.jpeg', '.bmp', '.png')):
-                        migration_log["maps"].append(hs_file_path)
-
-                    try:
-                        tmpfile_folder_path = os.path.dirname(f["path_or_url"])
-                        assert(tmpfile_folder_path.startswith(tempfile.gettempdir()))
-                        logging.info("DELTREE {}".format(tmpfile_folder_path))
-                        shutil.rmtree(tmpfile_folder_path)
-                    except Exception:
-                        pass
-
-                    try:
-                        # set Content Type to file
-                        options = {
-                            "file_path": hs_file_path,
-                            "hs_file_type": "SingleFile"
-                        }
-                        hs.resource(hs_id).functions.set_file_type(options)
-
-                        # This will be simplified by new hs_restclient PR
-                        # find file id
-                        #file_id = get_file_id_by_name(hs, hs_id, f["file_name"])
-                        file_id = hs_file_path
-                    except Exception:
-                        pass
-
-                    # log concrete file
-                    migration_log["concrete_file_list"].append(f)
-
-                hs.resource(hs_id).files.metadata(file_id, f["metadata"])
-            except Exception as ex_file:
-                _success_file = False
-                extra_msg = "Failed upload file to HS {}: ".format(json.dumps(f))
-                log_exception(ex_file, migration_log=migration_log, extra_msg=extra_msg)
+            if journal is not None and _done:
+                journal.record_step(journal_id, key, hs_id, migration_log["uname"],
+                                    log_delta=_log_delta(migration_log, lengths))
 
-        # make the resource public
-        try:
-            hs.setAccessRules(hs_id, public=True)
-            logging.info("Resource is made Public")
-            migration_log["public"] = True
-        except Exception:
-            logging.error("Failed to make Resource Public")
+        if bundle:
+            _success_file = _flush_bundle() and _success_file
+        if file_ops:
+            _success_file = _flush_file_ops() and _success_file
 
         # science_metadata_json = hs.getScienceMetadata(hs_id)
         # print (json.dumps(science_metadata_json, sort_keys=True, indent=4))
 
-        logging.info("Done with NO.{index} CZO_ID: {czo_id}".format(index=index, czo_id=czo_id))
-        if _success_abstract and _success_keyword and \
-                _success_coverage and _success_creator and _success_file and \
-                _success_grants and _success_relations:
+        logging.info("Done with NO.{index} CZO_ID: {czo_id}".format(index=plan["index"], czo_id=plan["czo_id"]))
+        if _success_metadata and _success_file:
             _success = True
 
     except Exception as ex:
         _success = False
-        extra_msg = "Failed to migrate CZO dict {}: ".format(json.dumps(czo_res_dict))
+        extra_msg = "Failed to migrate CZO_ID {}: ".format(plan["czo_id"])
         log_exception(ex, migration_log=migration_log, extra_msg=extra_msg)
 
     finally:
         migration_log["success"] = _success
         return migration_log
+
+
+def create_hs_res_from_czo_row(czo_res_dict, czo_hs_account_obj, index=-99, file_rows=None, journal=None,
+                               hs_index=None):
+    """
+    Create a HydroShare resource from a CZO data row: plan and apply in one go
+    :param czo_res_dict: dict of CZO data row
+    :param czo_hs_account_obj: CZOHSAccount obj
+    :param index: row number (for logging)
+    :param file_rows: files table rows of the CZO row (see czo_data.get_files); built from czo_res_dict if None
+    :param journal: MigrationJournal or None (see apply_hs_res_plan)
+    :param hs_index: HSResourceIndex or None (see apply_hs_res_plan)
+    :return: migration log dict (see apply_hs_res_plan)
+    """
+    plan = plan_hs_res_from_czo_row(czo_res_dict, czo_hs_account_obj, index=index, file_rows=file_rows)
+    return apply_hs_res_plan(plan, czo_hs_account_obj, journal=journal, hs_index=hs_index)
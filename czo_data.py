@@ -0,0 +1,297 @@
+import itertools
+import logging
+import os
+import re
+import threading
+import uuid
+from urllib.parse import unquote
+
+import numpy as np
+import pandas as pd
+import validators
+
+try:
+    import pyarrow as pa
+except ImportError:
+    # optional: without pyarrow the csv is parsed on every run
+    pa = None
+
+from file_ops import SUPPORTED_EXTENSIONS
+from settings import CZO_DATA_CSV, SNAPSHOT_DIR
+from util import hash_file
+
+COMPONENT_FILES_COLUMN = 'COMPONENT_FILES-location$topic$url$data_level$private$doi$metadata_url'
+COMPONENT_FIELDS = ["location", "topic", "url", "data_level", "private", "doi", "metadata_url"]
+
+# kind: "component" / "metadata" (metadata_url of the component before it) / "map" / "kml"
+# tag: "map" for map_uploads and kml_files; extension_class: "supported" / "unsupported" / "invalid" (url)
+FILES_TABLE_COLUMNS = ["czo_id", "seq", "kind"] + COMPONENT_FIELDS + \
+                      ["is_private", "tag", "url_valid", "extension_class", "parse_ok"]
+
+# bump when the tables written to snapshots change so old snapshots are ignored
+SNAPSHOT_VERSION = 1
+
+_EXTENSION_PATTERN = "(?:{})$".format("|".join(re.escape(ext) for ext in SUPPORTED_EXTENSIONS))
+
+_czo_datasets = {}
+_czo_datasets_lock = threading.Lock()
+
+
+def explode_packed(row_pos, packed):
+    """
+    Split "|"-packed strings into one row per item
+    :param row_pos: array of positions of the csv rows
+    :param packed: Series of packed strings (same length)
+    :return: DataFrame with columns _row, _item_no, item
+    """
+    packed = packed.fillna("").astype(str).str.strip()
+    keep = (packed.str.len() > 0) & (~packed.str.lower().isin(["nan", "na", "n/a", r"n\a", "none"]))
+    packed = packed[keep]
+    parts = packed.str.split("|")
+    lengths = parts.str.len().values.astype(int)
+    items = list(itertools.chain.from_iterable(parts.values))
+    # object even when empty so that .str works on the item column of rows without items
+    item = np.array([i.strip() for i in items], dtype=object)
+    return pd.DataFrame({"_row": np.repeat(np.asarray(row_pos)[keep.values], lengths),
+                         "_item_no": np.arange(len(items)) - np.repeat(np.cumsum(lengths) - lengths, lengths),
+                         "item": item},
+                        columns=["_row", "_item_no", "item"])
+
+
+def _missing_as_none(files):
+    # missing values of text columns as None, both when built (None and NaN mixed) and from a snapshot
+    for column in files.columns:
+        if files[column].dtype == object:
+            files[column] = [None if v is None or (isinstance(v, float) and np.isnan(v)) else v
+                             for v in files[column]]
+    return files
+
+
+def build_files_table(czo_df):
+    """
+    Normalize the packed file fields (COMPONENT_FILES, map_uploads, kml_files) of all rows into one table
+    with a row per file, in the order migration processes them: each component file followed by its metadata
+    file, then maps, then kml files
+    :param czo_df: DataFrame of the CZO csv
+    :return: DataFrame with FILES_TABLE_COLUMNS
+    """
+    row_pos = np.arange(czo_df.shape[0])
+    czo_ids = czo_df["czo_id"].values
+
+    components = explode_packed(row_pos, czo_df[COMPONENT_FILES_COLUMN])
+    fields = components["item"].str.split("$", expand=True).reindex(columns=range(len(COMPONENT_FIELDS)))
+    fields = fields.astype(object)
+    fields.columns = COMPONENT_FIELDS
+    components = pd.concat([components, fields], axis=1)
+    components["parse_ok"] = components["item"].str.count(r"\$") >= len(COMPONENT_FIELDS) - 1
+    components.loc[~components["parse_ok"], COMPONENT_FIELDS] = None
+    components["url"] = components["url"].str.strip()
+    components["metadata_url"] = components["metadata_url"].str.strip()
+    components["kind"] = "component"
+    components["tag"] = None
+    components["_group"] = 0
+    components["_sub"] = 0
+
+    metadata = components[components["parse_ok"]].copy()
+    metadata["kind"] = "metadata"
+    metadata["url"] = metadata["metadata_url"]
+    metadata["_sub"] = 1
+
+    others = []
+    for group, (column, kind) in enumerate([("map_uploads", "map"), ("kml_files", "kml")], start=1):
+        other = explode_packed(row_pos, czo_df.get(column, pd.Series([None] * len(row_pos), index=czo_df.index)))
+        other["url"] = other["item"]
+        other["kind"] = kind
+        other["tag"] = "map"
+        other["parse_ok"] = True
+        other["_group"] = group
+        other["_sub"] = 0
+        others.append(other)
+
+    files = pd.concat([components, metadata] + others, ignore_index=True, sort=False)
+    files = files.sort_values(["_row", "_group", "_item_no", "_sub"]).reset_index(drop=True)
+    files["czo_id"] = czo_ids[files["_row"].values.astype(int)] if files.shape[0] > 0 else []
+    files["seq"] = files.groupby("_row").cumcount()
+    files["is_private"] = files["private"].fillna("").str.lower() == "y"
+
+    urls = files["url"].fillna("")
+    files["url_valid"] = urls.map(lambda url: bool(validators.url(url)))
+    path_parts = urls.map(unquote).str.split("/")
+    file_names = path_parts.str[-1].fillna("")
+    file_names = file_names.where(file_names.str.len() > 0, path_parts.str[-2].fillna(""))
+    supported = file_names.str.lower().str.contains(_EXTENSION_PATTERN)
+    files["extension_class"] = np.where(~files["url_valid"], "invalid",
+                                        np.where(supported, "supported", "unsupported"))
+    return _missing_as_none(files[FILES_TABLE_COLUMNS].copy())
+
+
+def read_czo_csv(csv_path):
+    """
+    Parse the CZO csv; rows without czo_id are dropped and czo_id is int
+    :param csv_path: path to csv
+    :return: DataFrame
+    """
+    # some exports start with a BOM
+    df = pd.read_csv(csv_path, encoding='utf-8-sig')
+    if df["czo_id"].isnull().any():
+        logging.warning("Dropped {} rows without czo_id in {}".format(df["czo_id"].isnull().sum(), csv_path))
+        df = df[df["czo_id"].notnull()].copy()
+    df["czo_id"] = df["czo_id"].astype(int)
+    return df
+
+
+def _snapshot_paths(csv_path, snapshot_dir):
+    # keyed by content so an edited (or replaced) csv never hits a stale snapshot
+    key = "{}_{}_v{}".format(os.path.splitext(os.path.basename(csv_path))[0], hash_file(csv_path),
+                             SNAPSHOT_VERSION)
+    return os.path.join(snapshot_dir, key + ".data.arrow"), os.path.join(snapshot_dir, key + ".files.arrow")
+
+
+def _write_arrow(df, path):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    tmp_path = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        writer = pa.RecordBatchFileWriter(sink, table.schema)
+        writer.write_table(table)
+        writer.close()
+    os.replace(tmp_path, path)
+
+
+def _read_arrow(path):
+    with pa.memory_map(path, 'r') as source:
+        return pa.RecordBatchFileReader(source).read_all().to_pandas()
+
+
+def load_czo_tables(csv_path, snapshot_dir=SNAPSHOT_DIR):
+    """
+    Dataset and files tables of the CZO csv, from a columnar snapshot (Arrow IPC files, memory-mapped)
+    if one was written for this exact csv before, otherwise parsed from the csv and snapshotted.
+    Snapshots need the optional pyarrow package; set SNAPSHOT_DIR to None to always parse the csv.
+    :param csv_path: path to csv
+    :param snapshot_dir: dir of snapshots
+    :return: (dataset DataFrame, files table DataFrame)
+    """
+    if pa is None or snapshot_dir is None:
+        df = read_czo_csv(csv_path)
+        return df, build_files_table(df)
+
+    data_path, files_path = _snapshot_paths(csv_path, snapshot_dir)
+    if os.path.isfile(data_path) and os.path.isfile(files_path):
+        try:
+            df = _read_arrow(data_path)
+            # arrow hands back missing strings as None; the csv parser (and so all parsing codes) uses NaN
+            df = df.where(df.notnull(), np.nan)
+            logging.info("Loaded snapshot {}".format(data_path))
+            return df, _missing_as_none(_read_arrow(files_path))
+        except Exception as ex:
+            logging.warning("Ignored unreadable snapshot {}: {}".format(data_path, ex))
+
+    df = read_czo_csv(csv_path)
+    files = build_files_table(df)
+    try:
+        if not os.path.exists(snapshot_dir):
+            os.makedirs(snapshot_dir)
+        _write_arrow(df, data_path)
+        _write_arrow(files, files_path)
+        logging.info("Saved snapshot {}".format(data_path))
+    except Exception as ex:
+        logging.warning("Failed to save snapshot of {}: {}".format(csv_path, ex))
+    return df, files
+
+
+class CZORecord(object):
+    """
+    One read-only row of the CZO csv
+    Values sit in a tuple; the column --> position map is shared by all records of a dataset.
+    Supports row["title"] / row.get("title") like the dicts it replaces; to_dict() gives a mutable copy.
+    """
+    __slots__ = ("_columns", "_values")
+
+    def __init__(self, columns, values):
+        self._columns = columns
+        self._values = values
+
+    @property
+    def czo_id(self):
+        return self._values[self._columns["czo_id"]]
+
+    def __getitem__(self, key):
+        return self._values[self._columns[key]]
+
+    def get(self, key, default=None):
+        i = self._columns.get(key)
+        return default if i is None else self._values[i]
+
+    def keys(self):
+        return self._columns.keys()
+
+    def to_dict(self):
+        """
+        Same as DataFrame.to_dict(orient='records') of the row
+        :return: dict column --> value
+        """
+        return dict((key, self._values[i]) for key, i in self._columns.items())
+
+
+class CZODataset(object):
+    """
+    CZO csv parsed once into immutable records indexed by czo_id, plus the normalized files table
+    (see build_files_table) of all rows; both come from a snapshot when available (see load_czo_tables)
+    """
+
+    def __init__(self, csv_path, snapshot_dir=SNAPSHOT_DIR):
+        self.csv_path = csv_path
+        df, self.files = load_czo_tables(csv_path, snapshot_dir=snapshot_dir)
+        self.data = df
+        self.columns = tuple(df.columns)
+        columns = dict((c, i) for i, c in enumerate(self.columns))
+
+        records = [CZORecord(columns, values) for values in df.itertuples(index=False, name=None)]
+        self._records = tuple(records)
+        self._by_czo_id = dict((record.czo_id, record) for record in records)
+
+        self._files_by_czo_id = {}
+        for f in self.files.to_dict(orient='records'):
+            self._files_by_czo_id.setdefault(f["czo_id"], []).append(f)
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __contains__(self, czo_id):
+        return czo_id in self._by_czo_id
+
+    def __getitem__(self, czo_id):
+        return self._by_czo_id[czo_id]
+
+    def get(self, czo_id, default=None):
+        return self._by_czo_id.get(czo_id, default)
+
+    def czo_ids(self):
+        """
+        :return: list of czo_id in csv order
+        """
+        return [record.czo_id for record in self._records]
+
+    def get_dict(self, czo_id):
+        """
+        :param czo_id: czo_id
+        :return: mutable dict of the row (KeyError if czo_id is unknown)
+        """
+        return self._by_czo_id[czo_id].to_dict()
+
+    def get_files(self, czo_id):
+        """
+        :param czo_id: czo_id
+        :return: list of files table rows (dicts) of czo_id in migration order
+        """
+        return [dict(f) for f in self._files_by_czo_id.get(czo_id, [])]
+
+
+def get_czo_dataset(csv_path=CZO_DATA_CSV):
+    with _czo_datasets_lock:
+        if csv_path not in _czo_datasets:
+            _czo_datasets[csv_path] = CZODataset(csv_path)
+        return _czo_datasets[csv_path]
@@ -0,0 +1,174 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+import requests
+
+from retry_policy import RetryError, DeadUrlError
+from settings import DEAD_URL_REGISTRY, DEAD_URL_TTL_HOURS, DEAD_URL_SEED_FILES
+from utils_logging import text_emphasis
+
+_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS dead_urls (
+           url TEXT PRIMARY KEY,
+           reason TEXT,
+           failures INTEGER NOT NULL,
+           first_seen REAL NOT NULL,
+           last_seen REAL NOT NULL,
+           expires_at REAL)""",
+]
+
+# responses that say the url is gone for good
+DEAD_URL_STATUS_CODES = (404, 410)
+
+_dead_url_registry = None
+_dead_url_registry_lock = threading.Lock()
+
+
+def is_dead_url_error(ex):
+    """
+    Errors that say the url itself is broken, so asking again later in this or the next run is pointless:
+    HTTP 404/410 and malformed urls
+    DNS and connection errors are not: a resolver or network blip would mark every url of a host dead
+    :param ex: exception, possibly a RetryError wrapping the last attempt's exception
+    :return: bool
+    """
+    if isinstance(ex, RetryError):
+        ex = ex.last_exception
+    if isinstance(ex, DeadUrlError):
+        return True
+    if isinstance(ex, requests.exceptions.HTTPError) and ex.response is not None:
+        return ex.response.status_code in DEAD_URL_STATUS_CODES
+    if isinstance(ex, (requests.exceptions.InvalidURL, requests.exceptions.MissingSchema,
+                       requests.exceptions.InvalidSchema)):
+        return True
+    return False
+
+
+class DeadUrlRegistry(object):
+    """
+    Persistent negative cache of source urls that failed terminally (404, 410, malformed url)
+    Entries expire after ttl_hours so urls that come back get another chance; so do urls listed in the
+    hand-maintained seed files.
+    """
+
+    def __init__(self, db_path, ttl_hours, seed_files=None):
+        self.db_path = db_path
+        self.ttl_sec = ttl_hours * 3600
+        self.seed_files = seed_files if seed_files else []
+        self._lock = threading.RLock()
+        self._conn = None
+        self._conn_pid = None
+        self._stats = Counter()
+
+    def _get_conn(self):
+        if self._conn is None or self._conn_pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=60, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            for stmt in _SCHEMA:
+                conn.execute(stmt)
+            conn.commit()
+            self._conn = conn
+            self._conn_pid = os.getpid()
+            self._seed()
+        return self._conn
+
+    def _seed(self):
+        now = time.time()
+        # entries of older versions: permanent ones seeded from notfound.txt, which also listed valid urls,
+        # and ones recorded for DNS/connection errors or 4xx other than 404/410
+        self._conn.execute("DELETE FROM dead_urls WHERE expires_at IS NULL OR reason LIKE 'ConnectionError%' OR "
+                           "(reason LIKE 'HTTPError%' AND reason NOT LIKE 'HTTPError: 404%' "
+                           "AND reason NOT LIKE 'HTTPError: 410%')")
+        for seed_file in self.seed_files:
+            if not os.path.isfile(seed_file):
+                continue
+            with open(seed_file, 'r') as f:
+                # skip counts, comments and anything else that is not a url
+                urls = [line.strip() for line in f if line.strip().lower().startswith(("http://", "https://"))]
+            self._conn.executemany("INSERT OR IGNORE INTO dead_urls (url, reason, failures, first_seen, last_seen, "
+                                   "expires_at) VALUES (?, ?, 0, ?, ?, ?)",
+                                   [(url, "listed in {}".format(seed_file), now, now, now + self.ttl_sec)
+                                    for url in urls])
+        self._conn.commit()
+
+    def get(self, url):
+        """
+        :param url: source url
+        :return: {"url", "reason", "failures", "first_seen", "last_seen", "expires_at"};
+                 None if not (or no longer) dead
+        """
+        with self._lock:
+            conn = self._get_conn()
+            row = conn.execute("SELECT * FROM dead_urls WHERE url = ?", (url,)).fetchone()
+            if row is None:
+                return None
+            if row["expires_at"] is not None and row["expires_at"] < time.time():
+                conn.execute("DELETE FROM dead_urls WHERE url = ?", (url,))
+                conn.commit()
+                return None
+            return dict(row)
+
+    def is_dead(self, url):
+        dead = self.get(url) is not None
+        if dead:
+            with self._lock:
+                self._stats["skipped"] += 1
+        return dead
+
+    def add(self, url, reason):
+        """
+        Record a terminal failure of url; it stays dead for ttl_hours from now
+        :param url: source url
+        :param reason: error message
+        :return: None
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._get_conn()
+            row = conn.execute("SELECT expires_at FROM dead_urls WHERE url = ?", (url,)).fetchone()
+            if row is None:
+                conn.execute("INSERT INTO dead_urls (url, reason, failures, first_seen, last_seen, expires_at) "
+                             "VALUES (?, ?, 1, ?, ?, ?)", (url, reason, now, now, now + self.ttl_sec))
+            else:
+                conn.execute("UPDATE dead_urls SET reason = ?, failures = failures + 1, last_seen = ?, expires_at = ? "
+                             "WHERE url = ?", (reason, now, now + self.ttl_sec, url))
+            conn.commit()
+            self._stats["added"] += 1
+        logging.warning("Marked dead url {}: {}".format(url, reason))
+
+    def record_failure(self, url, ex):
+        """
+        Add url to the registry if ex says the url is broken
+        :param url: source url
+        :param ex: exception raised while fetching url
+        :return: True if url was recorded as dead
+        """
+        if not is_dead_url_error(ex):
+            return False
+        last_ex = ex.last_exception if isinstance(ex, RetryError) else ex
+        self.add(url, "{}: {}".format(type(last_ex).__name__, last_ex))
+        return True
+
+    def count(self):
+        with self._lock:
+            return self._get_conn().execute("SELECT COUNT(*) FROM dead_urls").fetchone()[0]
+
+    def log_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        logging.info(text_emphasis("Summary on Dead URLs"))
+        logging.info("{} known dead urls; {} newly found in this run; {} lookups skipped".format(
+            self.count(), stats.get("added", 0), stats.get("skipped", 0)))
+
+
+def get_dead_url_registry():
+    global _dead_url_registry
+    with _dead_url_registry_lock:
+        if _dead_url_registry is None:
+            _dead_url_registry = DeadUrlRegistry(DEAD_URL_REGISTRY, DEAD_URL_TTL_HOURS,
+                                                 seed_files=DEAD_URL_SEED_FILES)
+        return _dead_url_registry
@@ -0,0 +1,147 @@
+import logging
+
+import pandas as pd
+
+from api_helpers import plan_hs_res_from_czo_row, get_files
+from czo_data import COMPONENT_FILES_COLUMN
+from utils_logging import text_emphasis
+
+# columns that go into the files table; compared file by file instead
+FILE_COLUMNS = [COMPONENT_FILES_COLUMN, "map_uploads", "kml_files"]
+# a file is replaced if any of these change (they all end up on HS)
+FILE_KEY_COLUMNS = ["kind", "url", "location", "topic", "private", "doi"]
+# plan ops that only touch resource-level metadata
+METADATA_OPS = ["scimeta_custom", "update_metadata"]
+
+# change: "added" / "removed" (rows), "metadata" (detail: column), "file_added" / "file_removed" (detail: url)
+DELTA_REPORT_COLUMNS = ["czo_id", "change", "detail"]
+
+
+def _normalize(df):
+    # csv values as text, so that 1 / 1.0 or NaN / "" of different exports compare equal
+    return df.apply(lambda col: col.where(col.notnull(), "").astype(str).str.strip().str.replace(r"\.0$", ""))
+
+
+def _report(czo_ids, change, details):
+    return pd.DataFrame({"czo_id": list(czo_ids), "change": change, "detail": list(details)},
+                        columns=DELTA_REPORT_COLUMNS)
+
+
+def diff_exports(old_dataset, new_dataset):
+    """
+    Compare two CZO exports by czo_id: rows added / removed, metadata columns changed and component/map/kml
+    file urls added / removed (a file whose location, topic, private flag or doi changed counts as removed
+    and added)
+    :param old_dataset: CZODataset of the export migrated before
+    :param new_dataset: CZODataset of the new export
+    :return: report DataFrame (DELTA_REPORT_COLUMNS), one row per change
+    """
+    old_ids = set(old_dataset.czo_ids())
+    new_ids = set(new_dataset.czo_ids())
+    common_ids = sorted(old_ids & new_ids)
+    report = [_report(sorted(new_ids - old_ids), "added", [""] * len(new_ids - old_ids)),
+              _report(sorted(old_ids - new_ids), "removed", [""] * len(old_ids - new_ids))]
+
+    columns = [c for c in new_dataset.columns if c in old_dataset.columns and c not in FILE_COLUMNS + ["czo_id"]]
+    for c in sorted(set(old_dataset.columns) ^ set(new_dataset.columns)):
+        logging.warning("Column {} is only in one of the exports; not compared".format(c))
+    old_df = old_dataset.data.drop_duplicates("czo_id", keep="last").set_index("czo_id").loc[common_ids, columns]
+    new_df = new_dataset.data.drop_duplicates("czo_id", keep="last").set_index("czo_id").loc[common_ids, columns]
+    changed = (_normalize(old_df) != _normalize(new_df)).stack()
+    changed = changed[changed]
+    report.append(_report(changed.index.get_level_values(0), "metadata", changed.index.get_level_values(1)))
+
+    old_files = old_dataset.files[old_dataset.files["czo_id"].isin(common_ids)]
+    new_files = new_dataset.files[new_dataset.files["czo_id"].isin(common_ids)]
+    files = _normalize(old_files[["czo_id"] + FILE_KEY_COLUMNS]).drop_duplicates().merge(
+        _normalize(new_files[["czo_id"] + FILE_KEY_COLUMNS]).drop_duplicates(), how="outer", indicator=True)
+    files = files[files["url"].str.len() > 0]
+    for side, change in [("left_only", "file_removed"), ("right_only", "file_added")]:
+        side_files = files[files["_merge"] == side]
+        report.append(_report(side_files["czo_id"].astype(int), change, side_files["url"]))
+
+    return pd.concat(report, ignore_index=True).sort_values(["czo_id", "change"]).reset_index(drop=True)
+
+
+def _metadata_ops(plan):
+    ops = [op for op in plan["ops"] if op["op"] in METADATA_OPS]
+    title = [op["title"] for op in plan["ops"] if op["op"] == "create_resource"]
+    if len(title) > 0:
+        ops.insert(0, {"op": "update_metadata", "message": "Title", "metadata": {"title": title[0]}})
+    return ops
+
+
+def plan_delta_row(czo_id, changes, old_dataset, new_dataset, czo_accounts, index=-99, delta_id="delta"):
+    """
+    Plan the updates of an existing resource for a changed row: the metadata ops whose payload differs between
+    the exports, add_file ops for new urls and delete_file ops for urls no longer listed
+    :param czo_id: czo_id
+    :param changes: report rows (dicts) of czo_id
+    :param old_dataset: CZODataset of the export migrated before
+    :param new_dataset: CZODataset of the new export
+    :param czo_accounts: CZOHSAccount obj
+    :param index: row number (for logging)
+    :param delta_id: journal namespace of this delta (so steps of earlier runs of the row aren't taken as done)
+    :return: plan dict (see api_helpers.plan_hs_res_from_czo_row) without create_resource and make_public
+    """
+    new_row = new_dataset.get_dict(czo_id)
+    ops = []
+    if any(change["change"] == "metadata" for change in changes):
+        old_ops = _metadata_ops(plan_hs_res_from_czo_row(old_dataset.get_dict(czo_id), czo_accounts, index=index,
+                                                         file_rows=[]))
+        ops = [op for op in _metadata_ops(plan_hs_res_from_czo_row(new_row, czo_accounts, index=index,
+                                                                   file_rows=[]))
+               if op not in old_ops]
+
+    added_urls = set(change["detail"] for change in changes if change["change"] == "file_added")
+    removed_urls = set(change["detail"] for change in changes if change["change"] == "file_removed")
+    # all files of the row are planned so that added ones get the names migration gives them,
+    # but only the added ones are looked up (HEAD)
+    plan = plan_hs_res_from_czo_row(new_row, czo_accounts, index=index,
+                                    file_rows=new_dataset.get_files(czo_id) if len(added_urls) > 0 else [],
+                                    check_urls=added_urls)
+    if len(removed_urls) > 0:
+        # names the files got on HS, from the file list of the export they were migrated from
+        for f in get_files(old_dataset.get_files(czo_id), download=False, check_urls=set()):
+            if isinstance(f, dict) and f["original_url"] in removed_urls:
+                ops.append({"op": "delete_file", "file_name": f["file_name"]})
+    ops.extend(op for op in plan["ops"] if op["op"] == "add_file" and op["file"]["original_url"] in added_urls)
+
+    plan["ops"] = ops
+    plan["journal_id"] = "{}:{}".format(delta_id, czo_id)
+    return plan
+
+
+def plan_delta(report, old_dataset, new_dataset, czo_accounts, hs_index, delta_id="delta"):
+    """
+    Split the changes of a delta into new rows to migrate and plans to update existing resources
+    Rows removed from the export are only reported; their resources are left on HS.
+    :param report: report DataFrame from diff_exports
+    :param old_dataset: CZODataset of the export migrated before
+    :param new_dataset: CZODataset of the new export
+    :param czo_accounts: CZOHSAccount obj
+    :param hs_index: HSResourceIndex to find the resources of changed rows
+    :param delta_id: journal namespace of this delta
+    :return: (list of czo_ids to migrate as new resources, list of update plans)
+    """
+    logging.info(text_emphasis("Delta Migration"))
+    counts = report.groupby("change")["czo_id"].nunique()
+    logging.info("Rows: {}".format("; ".join("{} {}".format(n, change) for change, n in counts.items())))
+
+    new_czo_ids = report.loc[report["change"] == "added", "czo_id"].tolist()
+    plans = []
+    changed = report[report["change"].isin(["metadata", "file_added", "file_removed"])]
+    for index, (czo_id, changes) in enumerate(changed.groupby("czo_id"), start=1):
+        if hs_index.get(czo_id) is None:
+            logging.warning("CZO_ID {} changed but has no HS resource; migrating it as new".format(czo_id))
+            new_czo_ids.append(czo_id)
+            continue
+        plan = plan_delta_row(czo_id, changes.to_dict(orient="records"), old_dataset, new_dataset, czo_accounts,
+                              index=index, delta_id=delta_id)
+        if len(plan["ops"]) > 0 or not plan["ok"]:
+            plans.append(plan)
+    for czo_id in report.loc[report["change"] == "removed", "czo_id"]:
+        logging.warning("CZO_ID {} is not in the new export; HS resource {} left as is".format(
+            czo_id, hs_index.get_hs_id(czo_id)))
+    logging.info("{} new rows; {} resources to update".format(len(new_czo_ids), len(plans)))
+    return sorted(new_czo_ids), plans
@@ -3,20 +3,14 @@ import time
 from utils_logging import text_emphasis, elapsed_time, log_uploaded_file_stats
 import glob
 import os
-import requests
+from czo_data import get_czo_dataset
 
 
 def main():
-    czo_data = pd.read_csv('./data/CZO-datasets-metadata-2019-10-29.csv')
-    df_rows = czo_data[['CZOS', 'COMPONENT_FILES-location$topic$url$data_level$private$doi$metadata_url']]
-    data = []
-    for k, idx in enumerate(df_rows.index):
-        # line = (df_rows['CZOS'][idx], df_rows['COMPONENT_FILES-location$topic$url$data_level$private$doi$metadata_url'][idx].split('|')[2].split('|'))
-        fdata = df_rows['COMPONENT_FILES-location$topic$url$data_level$private$doi$metadata_url'][idx].split('|')
-        for item in fdata:
-            line = (df_rows['CZOS'][idx], item.split('$')[2])
-            data.append(line)
-    df = pd.DataFrame.from_records(data, columns=['czo', 'files'])
+    czo_dataset = get_czo_dataset('./data/CZO-datasets-metadata-2019-10-29.csv')
+    czo_data, files = czo_dataset.data, czo_dataset.files
+    files = files[(files["kind"] == "component") & files["parse_ok"]].merge(czo_data[['czo_id', 'CZOS']], on='czo_id')
+    df = pd.DataFrame({'czo': files['CZOS'].values, 'files': files['url'].values}, columns=['czo', 'files'])
     dg = df.groupby('files').first()
 
     conf_name = []
@@ -90,7 +84,7 @@ if __name__ == "__main__":
     #     e = f.read().splitlines()
     #
     # for item in e:
-    #     res = requests.get(item)
+    #     res = get_http_client().get(item)
     #     if not res.status_code == 200:
     #         print(item, res)
 
@@ -0,0 +1,197 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from settings import CACHED_FILE_DIR, CACHE_MAX_SIZE_MB, MB_TO_BYTE
+from util import hash_string, hash_file
+
+_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS blobs (
+           content_hash TEXT PRIMARY KEY,
+           size INTEGER NOT NULL,
+           last_access REAL NOT NULL)""",
+    """CREATE TABLE IF NOT EXISTS urls (
+           url TEXT PRIMARY KEY,
+           content_hash TEXT NOT NULL,
+           content_type TEXT,
+           etag TEXT,
+           last_modified TEXT,
+           fetched_at REAL NOT NULL)""",
+    "CREATE INDEX IF NOT EXISTS blobs_last_access ON blobs (last_access)",
+    "CREATE INDEX IF NOT EXISTS urls_content_hash ON urls (content_hash)",
+]
+
+# last access of a blob is only written when the stored one is older than this, so lookups don't all commit
+ACCESS_UPDATE_SEC = 10 * 60
+
+_file_caches = {}
+_file_caches_lock = threading.Lock()
+
+
+class FileCache(object):
+    """
+    Content-addressed cache of downloaded source files shared by predownload.py and file_ops.py
+    Nothing is created on disk before the first put(); lookups in a cache that doesn't exist find nothing.
+    url --> content hash (md5 of body) --> blob file; identical bodies served from different urls share one blob.
+    A SQLite manifest next to the blobs records size, content type, validators (ETag/Last-Modified),
+    fetch time and last access; least recently used blobs are evicted beyond max_size_mb.
+    """
+
+    def __init__(self, base_dir, max_size_mb=0):
+        self.base_dir = base_dir
+        self.blob_dir = os.path.join(base_dir, "blobs")
+        self.manifest_path = os.path.join(base_dir, "manifest.sqlite3")
+        self.max_size_byte = max_size_mb * MB_TO_BYTE
+        self._lock = threading.RLock()
+        self._conn = None
+        self._conn_pid = None
+
+    def _get_conn(self, create=True):
+        # one connection per process (predownload runs several); threads share it under self._lock
+        # with create False the cache isn't created on disk by a lookup: None if there is no manifest yet
+        if self._conn is None or self._conn_pid != os.getpid():
+            if not create and not os.path.isfile(self.manifest_path):
+                return None
+            if not os.path.exists(self.blob_dir):
+                os.makedirs(self.blob_dir)
+            conn = sqlite3.connect(self.manifest_path, timeout=60, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            for stmt in _SCHEMA:
+                conn.execute(stmt)
+            conn.commit()
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def blob_path(self, content_hash):
+        return os.path.join(self.blob_dir, content_hash[:2], content_hash)
+
+    def get(self, url):
+        """
+        Look up a url and mark its blob as recently used (to within ACCESS_UPDATE_SEC)
+        :param url: source url
+        :return: {"path", "size", "content_hash", "content_type", "etag", "last_modified", "fetched_at"} or None
+        """
+        with self._lock:
+            conn = self._get_conn(create=False)
+            if conn is None:
+                return self._adopt_legacy_file(url)
+            row = conn.execute("SELECT u.url, u.content_hash, u.content_type, u.etag, u.last_modified, "
+                               "u.fetched_at, b.size, b.last_access FROM urls u JOIN blobs b ON u.content_hash = b.content_hash "
+                               "WHERE u.url = ?", (url,)).fetchone()
+            if row is None:
+                return self._adopt_legacy_file(url)
+            f_path = self.blob_path(row["content_hash"])
+            if not os.path.isfile(f_path):
+                # blob removed behind our back
+                conn.execute("DELETE FROM urls WHERE content_hash = ?", (row["content_hash"],))
+                conn.execute("DELETE FROM blobs WHERE content_hash = ?", (row["content_hash"],))
+                conn.commit()
+                return None
+            now = time.time()
+            if now - row["last_access"] > ACCESS_UPDATE_SEC:
+                conn.execute("UPDATE blobs SET last_access = ? WHERE content_hash = ?", (now, row["content_hash"]))
+                conn.commit()
+            entry = dict(row)
+            del entry["last_access"]
+            entry["path"] = f_path
+            return entry
+
+    def put(self, url, f_path, content_hash, size, content_type=None, etag=None, last_modified=None):
+        """
+        Move a downloaded file into the cache
+        :param url: source url
+        :param f_path: downloaded file, moved (or dropped if the body is already cached under another url)
+        :param content_hash: md5 hex digest of the body
+        :param size: size in bytes
+        :param content_type: Content-Type response header
+        :param etag: ETag response header
+        :param last_modified: Last-Modified response header
+        :return: path to blob
+        """
+        blob = self.blob_path(content_hash)
+        now = time.time()
+        with self._lock:
+            conn = self._get_conn()
+            if not os.path.exists(os.path.dirname(blob)):
+                os.makedirs(os.path.dirname(blob))
+            if os.path.isfile(blob):
+                os.remove(f_path)
+            else:
+                os.replace(f_path, blob)
+            conn.execute("INSERT OR REPLACE INTO blobs (content_hash, size, last_access) VALUES (?, ?, ?)",
+                         (content_hash, size, now))
+            conn.execute("INSERT OR REPLACE INTO urls (url, content_hash, content_type, etag, last_modified, "
+                         "fetched_at) VALUES (?, ?, ?, ?, ?, ?)",
+                         (url, content_hash, content_type, etag, last_modified, now))
+            conn.commit()
+        self.evict()
+        return blob
+
+    def touch(self, url):
+        """
+        Mark a cached url as fresh again after the origin confirmed it unchanged (HTTP 304)
+        :param url: source url
+        :return: None
+        """
+        with self._lock:
+            conn = self._get_conn(create=False)
+            if conn is None:
+                return
+            conn.execute("UPDATE urls SET fetched_at = ? WHERE url = ?", (time.time(), url))
+            conn.commit()
+
+    def count(self):
+        with self._lock:
+            conn = self._get_conn(create=False)
+            return 0 if conn is None else conn.execute("SELECT COUNT(*) FROM urls").fetchone()[0]
+
+    def total_size(self):
+        with self._lock:
+            conn = self._get_conn(create=False)
+            return 0 if conn is None else conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+    def evict(self):
+        """
+        Remove least recently used blobs (and the urls pointing at them) until the cache fits max_size_mb
+        :return: number of blobs evicted
+        """
+        if self.max_size_byte <= 0:
+            return 0
+        evicted = 0
+        with self._lock:
+            conn = self._get_conn()
+            total = self.total_size()
+            if total <= self.max_size_byte:
+                return 0
+            rows = conn.execute("SELECT content_hash, size FROM blobs ORDER BY last_access ASC").fetchall()
+            for row in rows:
+                if total <= self.max_size_byte:
+                    break
+                conn.execute("DELETE FROM urls WHERE content_hash = ?", (row["content_hash"],))
+                conn.execute("DELETE FROM blobs WHERE content_hash = ?", (row["content_hash"],))
+                f_path = self.blob_path(row["content_hash"])
+                if os.path.isfile(f_path):
+                    os.remove(f_path)
+                total -= row["size"]
+                evicted += 1
+            conn.commit()
+        logging.info("Cache evicted {} files; {:.2f} MB left".format(evicted, float(total) / MB_TO_BYTE))
+        return evicted
+
+    def _adopt_legacy_file(self, url):
+        # files predownloaded before the manifest existed sit in base_dir named md5(url)
+        legacy_path = os.path.join(self.base_dir, hash_string(url))
+        if not os.path.isfile(legacy_path):
+            return None
+        self.put(url, legacy_path, hash_file(legacy_path, chunk_size=MB_TO_BYTE), os.path.getsize(legacy_path))
+        return self.get(url)
+
+
+def get_file_cache(base_dir=CACHED_FILE_DIR):
+    with _file_caches_lock:
+        if base_dir not in _file_caches:
+            _file_caches[base_dir] = FileCache(base_dir, max_size_mb=CACHE_MAX_SIZE_MB)
+        return _file_caches[base_dir]
@@ -1,26 +1,78 @@
+import json
 import logging
 import os
+import shutil
 import tempfile
+import threading
+import time
 import uuid
 import hashlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import unquote
-import uuid
-import requests
 import validators
 
-from settings import BIG_FILE_SIZE_MB, MB_TO_BYTE, headers, USE_CACHED_FILES, CACHED_FILE_DIR, MORE_TMP
+from settings import BIG_FILE_SIZE_MB, MB_TO_BYTE, headers, USE_CACHED_FILES, CACHED_FILE_DIR, \
+    SEGMENTED_DOWNLOAD, SEGMENTED_MIN_MB
 from util import retry_func
+from file_cache import get_file_cache
+from rate_limit import get_rate_limiter
+from http_client import get_http_client
+from dead_urls import get_dead_url_registry
+from staging import get_staging_area
+from retry_policy import RetryError, DeadUrlError
+
+CHUNK_SIZE_BYTE = MB_TO_BYTE
+# smallest byte range of a segmented download
+MIN_SEGMENT_BYTE = 4 * MB_TO_BYTE
+
+# files with these extensions are downloaded and uploaded to HS; others become ReferencedFile
+SUPPORTED_EXTENSIONS = (".hdr", ".docx", ".csv", ".txt", ".pdf",
+                        ".xlsx", ".xls", ".dat", ".zip", ".7z",
+                        ".kml", ".kmz", ".rdb", ".jpg", ".jpeg",
+                        ".png")
+
+# usage of predownloaded files (CACHED_FILE_DIR), reported in the migration summary
+_cache_stats = Counter()
+_cache_stats_lock = threading.Lock()
+
+# FilePrefetcher (see pipeline.py) whose staged files download_file takes over; None if not prefetching
+_prefetcher = None
+
+
+def set_prefetcher(prefetcher):
+    global _prefetcher
+    _prefetcher = prefetcher
+
+
+def release_staged_file(url):
+    """
+    Tell the prefetcher a file it staged has been uploaded so its bytes stop counting against the staging budget
+    :param url: source url
+    :return: None
+    """
+    if _prefetcher is not None:
+        _prefetcher.release(url)
+
+
+def _check_dead_url(url):
+    if get_dead_url_registry().is_dead(url):
+        raise DeadUrlError("Known dead url {}".format(url))
 
 
 def check_file_size_mb(url):
 
+    _check_dead_url(url)
+
     if USE_CACHED_FILES:
         _, f_size_byte = get_cached_file(url)
         if f_size_byte is not None:
             return f_size_byte / MB_TO_BYTE
 
-    # sending headers is very important or in some cases requests.get() wont download the actual file content/binary
-    res = requests.head(url, allow_redirects=True, headers=headers)
+    res = get_http_client().head(url, allow_redirects=True)
+    if res.status_code == 429 or res.status_code >= 500:
+        # let retry_func try again once the host is allowed again
+        res.raise_for_status()
     f_size_str = res.headers.get('content-length')
     if f_size_str is None:
         logging.warning("Can't detect file size in HTTP header {}".format(url))
@@ -30,36 +82,399 @@ def check_file_size_mb(url):
     return f_size_mb
 
 
-def download_file(url, file_name):
+def _link_cached_file(f_path, save_to):
+    """
+    Expose a cached file under another name, without copying any bytes if possible
+    Hardlink; copy if cache and MORE_TMP are on different file systems (a symlink would break once
+    the cache evicts the blob, which another process may do while the file is uploaded)
+    :param f_path: path to cached file
+    :param save_to: path the file is wanted at
+    :return: True if the file was copied, False if linked
+    """
+    try:
+        os.link(f_path, save_to)
+        return False
+    except OSError:
+        shutil.copyfile(f_path, save_to)
+        return True
+
+
+def _count_cache_usage(hits=0, misses=0, bytes_saved=0):
+    with _cache_stats_lock:
+        _cache_stats["hits"] += hits
+        _cache_stats["misses"] += misses
+        _cache_stats["bytes_saved"] += bytes_saved
+
+
+def get_cache_stats():
+    """
+    Usage of predownloaded files by download_file in this run
+    :return: {"hits": int, "misses": int, "bytes_saved": int}
+    """
+    with _cache_stats_lock:
+        return {"hits": _cache_stats["hits"],
+                "misses": _cache_stats["misses"],
+                "bytes_saved": _cache_stats["bytes_saved"]}
+
+
+class BigFileInterrupted(Exception):
+    """
+    Raised when a download grows past its size limit
+    """
+    pass
+
+
+def _range_download_size(response, max_size_byte):
+    """
+    :param response: 200 response of a streamed GET
+    :param max_size_byte: size limit of the download
+    :return: file size if the file can be downloaded in segments: the server accepts byte ranges, the body isn't
+             compressed and has a Content-Length of SEGMENTED_MIN_MB to max_size_byte; else None
+    """
+    if not SEGMENTED_DOWNLOAD or response.status_code != 200:
+        return None
+    if response.headers.get("accept-ranges", "").lower() != "bytes":
+        return None
+    if response.headers.get("content-encoding", "identity").lower() != "identity":
+        return None
+    size = response.headers.get("content-length")
+    if size is None or not size.isdigit():
+        return None
+    size = int(size)
+    if size < SEGMENTED_MIN_MB * MB_TO_BYTE or (max_size_byte is not None and size > max_size_byte):
+        return None
+    return size
+
+
+def _download_segments(url, save_to, response, size, segments, on_chunk=None, verify=True):
+    """
+    Download a file as byte ranges in parallel into a preallocated file; the open response serves the first range
+    :param url: URL to remote file
+    :param save_to: local path to write to
+    :param response: streamed 200 response of url
+    :param size: Content-Length of response
+    :param segments: number of ranges
+    :param on_chunk: optional callback(chunk) per chunk written (called from several threads)
+    :param verify: check HTTPS certificate
+    :return: same as stream_to_file
+    """
+    bounds = [(i * size // segments, (i + 1) * size // segments) for i in range(segments)]
+    failed = threading.Event()
+
+    def _download_range(i):
+        start, end = bounds[i]
+        range_response = response if i == 0 else None
+        written = 0
+        try:
+            if i > 0:
+                request_headers = dict(headers)
+                request_headers["Range"] = "bytes={}-{}".format(start, end - 1)
+                range_response = get_http_client().get(url, stream=True, headers=request_headers, verify=verify)
+                range_response.raise_for_status()
+                if range_response.status_code != 206 or \
+                        not range_response.headers.get("content-range", "").startswith("bytes {}-".format(start)):
+                    get_rate_limiter().disable_segments(url)
+                    raise IOError("Range request not honored @ {}".format(url))
+            with open(save_to, 'r+b') as f:
+                f.seek(start)
+                for chunk in range_response.iter_content(chunk_size=CHUNK_SIZE_BYTE):
+                    if failed.is_set():
+                        # another range failed; the download is retried as a whole
+                        return
+                    chunk = chunk[:end - start - written]
+                    f.write(chunk)
+                    written += len(chunk)
+                    if on_chunk is not None:
+                        on_chunk(chunk)
+                    if written == end - start:
+                        break
+            if written != end - start:
+                raise IOError("Range {}-{} ended after {} bytes @ {}".format(start, end - 1, written, url))
+        except Exception:
+            failed.set()
+            raise
+        finally:
+            if i > 0 and range_response is not None:
+                range_response.close()
+
+    logging.info("Downloading {:.2f} MB in {} segments {}".format(float(size) / MB_TO_BYTE, segments, url))
+    try:
+        with open(save_to, 'wb') as f:
+            f.truncate(size)
+        with ThreadPoolExecutor(max_workers=segments) as executor:
+            futures = [executor.submit(_download_range, i) for i in range(segments)]
+        for future in futures:
+            future.result()
+        if os.path.getsize(save_to) != size:
+            raise IOError("Assembled {} bytes of {} @ {}".format(os.path.getsize(save_to), size, url))
+    except Exception:
+        # a file with holes is no use to a resumed download
+        if os.path.isfile(save_to):
+            os.remove(save_to)
+        raise
+
+    md5 = hashlib.md5()
+    with open(save_to, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE_BYTE), b""):
+            md5.update(chunk)
+    return {"size": size, "md5": md5.hexdigest(),
+            "content_type": response.headers.get("content-type"),
+            "etag": response.headers.get("etag"),
+            "last_modified": response.headers.get("last-modified"),
+            "not_modified": False}
+
+
+def _validator_path(save_to):
+    return save_to + ".validator"
+
+
+def _save_validator(save_to, response):
+    # ETag / Last-Modified of the response a partial file comes from, for If-Range when resuming it
+    with open(_validator_path(save_to), 'w') as f:
+        json.dump({"etag": response.headers.get("etag"), "last_modified": response.headers.get("last-modified")}, f)
+
+
+def _load_if_range(save_to):
+    """
+    :param save_to: partially written file
+    :return: If-Range value for resuming it (strong ETag, else Last-Modified); None if there is none
+    """
+    try:
+        with open(_validator_path(save_to), 'r') as f:
+            validator = json.load(f)
+    except (IOError, ValueError):
+        return None
+    etag = validator.get("etag")
+    if etag is not None and not etag.startswith("W/"):
+        # weak ETags can't be used with If-Range
+        return etag
+    return validator.get("last_modified")
+
+
+def _remove_validator(save_to):
+    if os.path.isfile(_validator_path(save_to)):
+        os.remove(_validator_path(save_to))
+
+
+def stream_to_file(url, save_to, max_size_byte=None, on_chunk=None, verify=True, resume=False,
+                   etag=None, last_modified=None):
+    """
+    Stream a remote file to disk in fixed-size chunks, hashing the bytes on the way
+    With SEGMENTED_DOWNLOAD a file the server can serve in byte ranges is downloaded in parallel ranges instead
+    (see _download_segments); their number per host follows its throughput (HostRateLimiter.report_segmented)
+    :param url: URL to remote file
+    :param save_to: local path to write to
+    :param max_size_byte: raise BigFileInterrupted once more bytes than this arrive; None for no limit
+    :param on_chunk: optional callback(chunk) per chunk written
+    :param verify: check HTTPS certificate
+    :param resume: continue a partially written save_to with a HTTP Range request, if-range the remote file is
+                   still the one it was started from (else it is downloaded again from the start)
+    :param etag: ETag of a cached copy, sent as If-None-Match
+    :param last_modified: Last-Modified of a cached copy, sent as If-Modified-Since
+    :return: {"size": number of bytes, "md5": hex digest, "content_type", "etag", "last_modified": response headers,
+              "not_modified": True if server answered 304 to the conditional request (nothing written)}
+    """
+    # sending headers is very important or in some cases requests.get() wont download the actual file content/binary
+    request_headers = dict(headers)
+    if etag is not None:
+        request_headers["If-None-Match"] = etag
+    if last_modified is not None:
+        request_headers["If-Modified-Since"] = last_modified
+    offset = 0
+    if resume and os.path.isfile(save_to):
+        offset = os.path.getsize(save_to)
+        if_range = _load_if_range(save_to)
+        if offset > 0 and if_range is None:
+            # nothing to tell whether the remote file changed since; start over
+            logging.info("Can't resume {} (no ETag/Last-Modified); downloading it again".format(url))
+            offset = 0
+        if offset > 0:
+            request_headers["Range"] = "bytes={}-".format(offset)
+            request_headers["If-Range"] = if_range
+
+    _start = time.time()
+    response = get_http_client().get(url, stream=True, headers=request_headers, verify=verify)
+    transferred = 0
+    try:
+        if response.status_code == 304:
+            return {"size": 0, "md5": None, "content_type": None, "etag": etag, "last_modified": last_modified,
+                    "not_modified": True}
+        if response.status_code == 416 and offset > 0:
+            # partial file doesn't fit the remote one anymore; start over
+            os.remove(save_to)
+            _remove_validator(save_to)
+            return stream_to_file(url, save_to, max_size_byte=max_size_byte, on_chunk=on_chunk, verify=verify,
+                                  etag=etag, last_modified=last_modified)
+        response.raise_for_status()
+        range_size = _range_download_size(response, max_size_byte) if offset == 0 else None
+        segments = 0 if range_size is None else \
+            min(get_rate_limiter().get_segments(url), range_size // MIN_SEGMENT_BYTE)
+        if segments > 1:
+            stream_info = _download_segments(url, save_to, response, range_size, segments, on_chunk, verify)
+            _remove_validator(save_to)
+            transferred = stream_info["size"]
+            get_rate_limiter().report_segmented(url, segments, transferred, time.time() - _start)
+            return stream_info
+        md5 = hashlib.md5()
+        size = 0
+        mode = 'wb'
+        if offset > 0 and response.status_code == 206:
+            # resuming: hash the bytes already on disk then append the rest
+            with open(save_to, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE_BYTE), b""):
+                    md5.update(chunk)
+            size = offset
+            mode = 'ab'
+            logging.info("Resuming download at {:.2f} MB {}".format(float(offset) / MB_TO_BYTE, url))
+        else:
+            if offset > 0:
+                # 200 to If-Range: the remote file changed, so the partial one is stale
+                logging.info("Remote file changed; downloading it again {}".format(url))
+            if resume:
+                _save_validator(save_to, response)
+        with open(save_to, mode) as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE_BYTE):
+                size += len(chunk)
+                transferred += len(chunk)
+                if max_size_byte is not None and size > max_size_byte:
+                    _remove_validator(save_to)
+                    raise BigFileInterrupted("Big File Interrupted @ {}".format(url))
+                f.write(chunk)
+                md5.update(chunk)
+                if on_chunk is not None:
+                    on_chunk(chunk)
+        _remove_validator(save_to)
+        if segments == 1:
+            get_rate_limiter().report_segmented(url, 1, size, time.time() - _start)
+    finally:
+        response.close()
+        get_rate_limiter().report(url, nbytes=transferred, seconds=time.time() - _start)
+    return {"size": size, "md5": md5.hexdigest(),
+            "content_type": response.headers.get("content-type"),
+            "etag": response.headers.get("etag"),
+            "last_modified": response.headers.get("last-modified"),
+            "not_modified": False}
+
+
+class SourceStream(object):
+    """
+    Read-only file object over the body of a source response, for hs.addResourceFile: the multipart encoder
+    pulls a few KB at a time, which are read from the socket as asked for, so the file is never written to disk
+    and never held in memory whole; the bytes are hashed on the way
+    """
+
+    def __init__(self, url, response, size):
+        self.url = url
+        self.response = response
+        self.len = size  # the multipart encoder takes the upload length from here
+        self.md5 = hashlib.md5()
+        self._read = 0
+        self._start = time.time()
+
+    def read(self, size=-1):
+        # raw body: the response has no Content-Encoding (see open_source_stream), so these are the file bytes
+        data = self.response.raw.read() if size is None or size < 0 else self.response.raw.read(size)
+        self._read += len(data)
+        self.md5.update(data)
+        return data
+
+    def tell(self):
+        return self._read
+
+    def close(self):
+        self.response.close()
+        get_rate_limiter().report(self.url, nbytes=self._read, seconds=time.time() - self._start)
+
+    def complete(self):
+        return self._read == self.len
+
+
+def open_source_stream(url):
+    """
+    Open a source file for a streaming upload (see SourceStream)
+    :param url: URL to remote file
+    :return: SourceStream; None if the file should be downloaded instead: it is cached or prefetched,
+             or the response has no Content-Length, is compressed or is bigger than BIG_FILE_SIZE_MB
+    """
+    _check_dead_url(url)
+    if USE_CACHED_FILES and get_cached_file(url)[0] is not None:
+        return None
+    if _prefetcher is not None:
+        return None
+
+    response = get_http_client().get(url, stream=True, headers=headers)
+    stream = None
+    try:
+        response.raise_for_status()
+        size = response.headers.get("content-length")
+        encoding = response.headers.get("content-encoding", "identity").lower()
+        if size is not None and encoding == "identity" and int(size) <= BIG_FILE_SIZE_MB * MB_TO_BYTE:
+            stream = SourceStream(url, response, int(size))
+    finally:
+        if stream is None:
+            response.close()
+    return stream
+
+
+def download_file(url, file_name, size_byte=0):
     """
        Download a remote czo file to local
        :param url: URL to remote CZ file
-       :param save_to: local path to store the file
-       :return: None
+       :param file_name: filename to save the file as
+       :param size_byte: expected size, waited for in the staging area quota; 0 if unknown
+       :return: {"path": local path, "size": bytes, "md5": hex digest or None};
+                None if the file turned out bigger than BIG_FILE_SIZE_MB
     """
     # TODO try catch and log
-    # TODO handle for rate limiting
 
-    guid4 = str(uuid.uuid4())
-    save_to = os.path.join(MORE_TMP, guid4)
-    if not os.path.exists(save_to):
-        os.mkdir(save_to)
-    save_to = os.path.join(save_to, file_name)
+    _check_dead_url(url)
+    staging_area = get_staging_area()
 
     if USE_CACHED_FILES:
-        a=1
-        # f_path, _ = get_cached_file(url)
-        # if f_path is not None:
-        #     f_path = os.path.abspath(f_path)
-        #     os.symlink(f_path, save_to)  # target must be a absolute path
-        #     logging.info("Using local cache {} --> {}".format(save_to, f_path))
-        #     return save_to
-
-    # sending headers is very important or in some cases requests.get() wont download the actual file content/binary
-    response = requests.get(url, stream=True, headers=headers)
-    with open(save_to, 'wb') as f:
-        f.write(response.content)
-    return save_to
+        f_path, f_size = get_cached_file(url)
+        if f_path is not None and f_size <= BIG_FILE_SIZE_MB * MB_TO_BYTE:
+            # a link takes no space in the staging area; a copy is counted once made
+            save_dir = staging_area.new_dir()
+            save_to = os.path.join(save_dir, file_name)
+            if _link_cached_file(f_path, save_to):
+                staging_area.set_size(save_dir, f_size)
+            logging.info("Using local cache {} --> {}".format(save_to, f_path))
+            _count_cache_usage(hits=1, bytes_saved=f_size)
+            return {"path": save_to, "size": f_size, "md5": None}
+        _count_cache_usage(misses=1)
+
+    if _prefetcher is not None:
+        staged = _prefetcher.claim(url)
+        if staged is not None:
+            # counted by the prefetch staging budget until release_staged_file
+            save_to = os.path.join(staging_area.new_dir(), file_name)
+            shutil.move(staged["path"], save_to)
+            logging.info("Using prefetched file {}".format(save_to))
+            return {"path": save_to, "size": staged["size"], "md5": staged["md5"]}
+
+    save_dir = staging_area.new_dir(nbytes=size_byte)
+    save_to = os.path.join(save_dir, file_name)
+    try:
+        # enforce the big-file cutoff while streaming as content-length may have been missing
+        stream_info = stream_to_file(url, save_to, max_size_byte=BIG_FILE_SIZE_MB * MB_TO_BYTE)
+    except BigFileInterrupted as ex:
+        logging.warning(str(ex))
+        staging_area.remove_dir(save_dir)
+        return None
+    except Exception:
+        staging_area.remove_dir(save_dir)
+        raise
+    staging_area.set_size(save_dir, stream_info["size"])
+    return {"path": save_to, "size": stream_info["size"], "md5": stream_info["md5"]}
+
+
+def remove_download(path):
+    """
+    Delete the staging folder download_file saved a file to and give its bytes back to the staging area
+    :param path: local path from download_file
+    :return: None
+    """
+    get_staging_area().remove_dir(os.path.dirname(path))
 
 
 def _append_rstr_to_fname(fn, split_ext=True, rstrl=6, pre_rstr=None):
@@ -91,14 +506,7 @@ def check_extension(filename):
     :param filename: filename
     :return: True: harvest/download;
     """
-    filename = filename.lower()
-    for ext in [".hdr", ".docx", ".csv", ".txt", ".pdf",
-                ".xlsx", ".xls", ".dat", ".zip",  ".7z",
-                ".kml",  ".kmz", ".rdb", ".jpg", ".jpeg",
-                ".png"]:
-        if filename.endswith(ext):
-            return True
-    return False
+    return filename.lower().endswith(SUPPORTED_EXTENSIONS)
 
 
 def handle_special_char(_fn):
@@ -112,7 +520,8 @@ def handle_special_char(_fn):
 
 
 def extract_fileinfo_from_url(f_url, ref_file_name,
-                              file_name_used_dict=None, private_flag=False, skip_invalid_url=False):
+                              file_name_used_dict=None, private_flag=False, skip_invalid_url=False, download=True,
+                              check_size=True):
     """
     case 1: Invalid url --> RefFileType (downstream codes will mark "NOT_RESOLVING")
     case 2: Url ends with a filename with any supported extension and ...
@@ -122,6 +531,12 @@ def extract_fileinfo_from_url(f_url, ref_file_name,
     case 3: Url ends with a filename without supported extension ---> RefFileType
     case 4: Url has no explict filename ---> RefFileType
     case 5: For case 2 ,3 ,4 if private_flag is True ---> RefFileType with prefix "Private_" in file_name
+    case 6: Url is known (or found) to be dead (see dead_urls.py) --> RefFileType with "dead_url" True
+            (downstream codes will mark "NOT_RESOLVING" without calling out)
+    With download=False SingleFileType files are classified from the cache and HEAD requests only and left
+    for fetch_file() to download ("downloaded" False)
+    With check_size=False files with a supported extension are not looked up at all (no HEAD request) and taken
+    as case 2-3; for when only the file name is needed (it doesn't depend on the size)
     """
     ref_filetype = "ReferencedFile"
     regular_filetype = ""
@@ -129,6 +544,7 @@ def extract_fileinfo_from_url(f_url, ref_file_name,
     big_file_flag = False
     path_or_url = f_url
     file_size_mb = -1
+    dead_url = False
 
     if not validators.url(f_url):
         # case 1
@@ -141,11 +557,26 @@ def extract_fileinfo_from_url(f_url, ref_file_name,
         file_name = f_url_decoded.split("/")[-1]
         file_name = f_url_decoded.split("/")[-2] if len(file_name) == 0 else file_name
         supported_extension = check_extension(file_name)
-        if supported_extension:
+        if supported_extension and get_dead_url_registry().is_dead(f_url):
+            # case 6
+            dead_url = True
+            file_type = ref_filetype
+        elif supported_extension and not check_size:
+            # case 2-3 for now
+            file_type = regular_filetype
+        elif supported_extension:
             # case 2-X
-            file_size_mb = retry_func(check_file_size_mb, args=[f_url])
+            try:
+                file_size_mb = retry_func(check_file_size_mb, args=[f_url])
+            except RetryError as ex:
+                if not get_dead_url_registry().record_failure(f_url, ex):
+                    raise
+                # case 6
+                dead_url = True
             big_file_flag = is_big_file(file_size_mb)
-            if big_file_flag:
+            if dead_url:
+                file_type = ref_filetype
+            elif big_file_flag:
                 # case 2-1
                 file_type = ref_filetype
                 file_name = file_name
@@ -166,19 +597,54 @@ def extract_fileinfo_from_url(f_url, ref_file_name,
     # handel duplicate file_name
     file_name = _handle_duplicated_file_name(file_name, file_name_used_dict,
                                              split_ext=supported_extension)
-    # download regular non-big-file to local
-    if file_type == regular_filetype:
-        path_or_url = retry_func(download_file, args=[f_url, file_name])
-
     file_info = {"file_type": file_type,
                  "path_or_url": path_or_url,
                  "file_name": file_name,
                  "big_file_flag": big_file_flag,
                  "file_size_mb": file_size_mb,
+                 "file_md5": None,
+                 "dead_url": dead_url,
+                 "downloaded": False,
                  "original_url": f_url,
                  "metadata": {},
                  "tag": None,
                  }
+    # download regular non-big-file to local
+    if download and check_size and file_type == regular_filetype:
+        fetch_file(file_info)
+    return file_info
+
+
+def fetch_file(file_info):
+    """
+    Download a SingleFileType file classified by extract_fileinfo_from_url; file_info is updated in place:
+    path_or_url becomes the local path, or the file becomes RefFileType if it turned out big (case 2-3 --> 2-1)
+    or dead (case 6)
+    :param file_info: file dict from extract_fileinfo_from_url
+    :return: file_info
+    """
+    f_url = file_info["original_url"]
+    try:
+        size_byte = int(file_info["file_size_mb"] * MB_TO_BYTE) if file_info["file_size_mb"] > 0 else 0
+        download_info = retry_func(download_file, args=[f_url, file_info["file_name"], size_byte])
+    except RetryError as ex:
+        if not get_dead_url_registry().record_failure(f_url, ex):
+            raise
+        # case 6
+        download_info = None
+        file_info["dead_url"] = True
+    if file_info["dead_url"]:
+        file_info["file_type"] = "ReferencedFile"
+    elif download_info is None:
+        # case 2-3 turned out to be case 2-1: size was unknown and download passed BIG_FILE_SIZE_MB
+        file_info["file_type"] = "ReferencedFile"
+        file_info["big_file_flag"] = True
+    else:
+        file_info["path_or_url"] = download_info["path"]
+        file_info["file_md5"] = download_info["md5"]
+        file_info["downloaded"] = True
+        if file_info["file_size_mb"] < 0:
+            file_info["file_size_mb"] = float(download_info["size"]) / MB_TO_BYTE
     return file_info
 
 
@@ -218,15 +684,8 @@ def _handle_duplicated_file_name(file_name, file_name_used_dict, split_ext=True)
     return file_name_new
 
 
-def hash_string(_str):
-        hash_object = hashlib.md5(_str.encode())
-        return hash_object.hexdigest()
-
-
 def get_cached_file(url, base_dir=CACHED_FILE_DIR):
-    hashkey = hash_string(url)
-    f_path = os.path.join(base_dir, hashkey)
-    if os.path.isfile(f_path):
-        f_size = os.path.getsize(f_path)
-        return f_path, f_size
+    entry = get_file_cache(base_dir).get(url)
+    if entry is not None:
+        return entry["path"], entry["size"]
     return None, None
@@ -6,10 +6,13 @@ from collections import OrderedDict
 import pandas as pd
 
 from util import gen_readme
+from staging import row_workspace
+from second_pass import replace_readme
 from settings import CZO_ACCOUNTS, CZO_DATA_CSV, README_COLUMN_MAP_PATH, \
     README_SHOW_MAPS, HS_EXTERNAL_FULL_DOMAIN, NEW_SECOND_PASS
 from api_helpers import _extract_value_from_df_row_dict, string_to_list
 from accounts import CZOHSAccount
+from czo_data import get_czo_dataset
 
 
 def query_lookup_table(czo_id, lookup_data_df, attr="hs_id"):
@@ -39,12 +42,12 @@ def build_maps_md(map_filename, hs_id):
     return md
 
 
-def build_related_dataset_md(res_id, czo_id, czo_data_df=None):
+def build_related_dataset_md(res_id, czo_id, czo_dataset=None):
     res_url = get_resource_landing_page_url(res_id)
     res_title = None
-    if czo_data_df is not None:
+    if czo_dataset is not None:
         try:
-            res_title = get_dict_by_czo_id(czo_id, czo_data_df)["title"]
+            res_title = czo_dataset[czo_id]["title"]
         except:
             pass
     md = "[{res_title}]({url} '{tooltip}')".format(res_title=res_title if res_title is not None else res_id,
@@ -53,16 +56,15 @@ def build_related_dataset_md(res_id, czo_id, czo_data_df=None):
     return md
 
 
-def get_dict_by_czo_id(czo_id, czo_data_df):
-    czo_row_dict = czo_data_df.loc[czo_data_df['czo_id'] == czo_id].to_dict(orient='records')[0]
-    return czo_row_dict
+def get_dict_by_czo_id(czo_id, czo_dataset):
+    return czo_dataset.get_dict(czo_id)
 
 
 def redo_second_pass(czo_csv_path, lookup_csv_path, czo_accounts):
     logging.info("\n\nFix Second Pass Started")
 
     # read czo csv
-    czo_data_df = pd.read_csv(czo_csv_path)
+    czo_dataset = get_czo_dataset(czo_csv_path)
     # read lookup table and set czo_id as index
     lookup_data_df = pd.read_csv(lookup_csv_path, index_col=1)
 
@@ -84,8 +86,12 @@ def redo_second_pass(czo_csv_path, lookup_csv_path, czo_accounts):
         if None not in (hs_id, hs_owner):
 
             logging.info("Updating {0} - {1} by account {2}".format(hs_id, czo_id, hs_owner))
-            hs = czo_accounts.get_hs_by_uname(hs_owner)
-            czo_row_dict = get_dict_by_czo_id(czo_id, czo_data_df)
+            try:
+                hs = czo_accounts.get_hs_by_uname(hs_owner)
+                czo_row_dict = get_dict_by_czo_id(czo_id, czo_dataset)
+            except Exception as ex:
+                logging.error("Skipped {0} - {1}: {2}".format(hs_id, czo_id, str(ex)))
+                continue
 
             related_datasets_md = []
             try:  # update czo_id
@@ -98,7 +104,7 @@ def redo_second_pass(czo_csv_path, lookup_csv_path, czo_accounts):
                                           czo_id_list))
 
                     related_datasets_md = list(map(functools.partial(build_related_dataset_md,
-                                                                     czo_data_df=czo_data_df), hs_id_list,
+                                                                     czo_dataset=czo_dataset), hs_id_list,
                                                                      czo_id_list))
 
                     # update czo_row_dict for readme.md
@@ -130,14 +136,14 @@ def redo_second_pass(czo_csv_path, lookup_csv_path, czo_accounts):
             # generate readme.md file
             if readme_column_map is not None:
 
-                readme_path = gen_readme(czo_row_dict, related_datasets_md)
-
-                try:
-                    file_add_response = hs.addResourceFile(hs_id, readme_path)
-                    logging.info("Creating ReadMe file {}".format(readme_path))
-                    readme_counter += 1
-                except IndexError as index_err:
-                    logging.error('Resource exists hs: {} czo: {} - {} - {}'.format(hs_id, czo_id, readme_path, index_err))
+                with row_workspace("readme-{}".format(czo_id)) as workspace:
+                    try:
+                        readme_path = gen_readme(czo_row_dict, related_datasets_md, workspace.new_dir())
+                        replace_readme(hs, hs_id, readme_path)
+                        logging.info("Creating ReadMe file {}".format(readme_path))
+                        readme_counter += 1
+                    except Exception as ex:
+                        logging.error("Failed to create ReadMe file hs: {} czo: {} - {}".format(hs_id, czo_id, ex))
 
             if not public:
                 try:
@@ -0,0 +1,173 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from settings import HS_RESOURCE_INDEX, HS_URL, PORT
+from utils_logging import text_emphasis
+
+_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS hs_resources (
+           scope TEXT NOT NULL,
+           hs_id TEXT NOT NULL,
+           czo_id INTEGER,
+           uname TEXT NOT NULL,
+           title TEXT,
+           date_last_updated TEXT,
+           scanned_at REAL NOT NULL,
+           PRIMARY KEY (scope, hs_id))""",
+    "CREATE INDEX IF NOT EXISTS hs_resources_czo_id ON hs_resources (scope, czo_id)",
+]
+
+_hs_resource_index = None
+_hs_resource_index_lock = threading.Lock()
+
+
+def _parse_czo_id(extended_metadata):
+    try:
+        return int(float(extended_metadata["czo_id"]))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class HSResourceIndex(object):
+    """
+    Local index czo_id --> HydroShare resource, built from the extended metadata ("czo_id") of the resources
+    owned by the CZO accounts; lets reruns update existing resources instead of creating duplicates.
+    refresh() lists the resources of each account once and only reads the extended metadata of resources
+    that are new or changed (date_last_updated) since the last scan.
+    Entries of another HydroShare server (scope) are kept apart.
+    """
+
+    def __init__(self, db_path, scope):
+        self.db_path = db_path
+        self.scope = scope
+        self._lock = threading.RLock()
+        self._conn = None
+        self._conn_pid = None
+
+    def _get_conn(self):
+        if self._conn is None or self._conn_pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=60, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            for stmt in _SCHEMA:
+                conn.execute(stmt)
+            conn.commit()
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def refresh(self, czo_accounts):
+        """
+        Bring the index up to date with the resources owned by all CZO accounts
+        :param czo_accounts: CZOHSAccount obj
+        :return: None
+        """
+        logging.info(text_emphasis("Indexing HydroShare Resources"))
+        for uname in czo_accounts.get_unames():
+            try:
+                self.refresh_account(uname, czo_accounts.get_hs_by_uname(uname))
+            except Exception as ex:
+                logging.error("Failed to index resources of account {}: {}".format(uname, ex))
+        logging.info("{} HS resources indexed; {} czo_ids".format(self.count(), len(self.czo_ids())))
+
+    def refresh_account(self, uname, hs):
+        """
+        :param uname: account
+        :param hs: hs obj of the account
+        :return: None
+        """
+        with self._lock:
+            conn = self._get_conn()
+            known = dict((row["hs_id"], row["date_last_updated"]) for row in conn.execute(
+                "SELECT hs_id, date_last_updated FROM hs_resources WHERE scope = ? AND uname = ?",
+                (self.scope, uname)))
+
+        listed = set()
+        scanned = 0
+        for res in hs.resources(owner=uname):
+            hs_id = res["resource_id"]
+            listed.add(hs_id)
+            date_last_updated = res.get("date_last_updated")
+            if hs_id in known and known[hs_id] == date_last_updated:
+                continue
+            try:
+                czo_id = _parse_czo_id(hs.resource(hs_id).scimeta.get())
+            except Exception as ex:
+                logging.warning("Failed to read extended metadata of {}: {}".format(hs_id, ex))
+                continue
+            scanned += 1
+            self._put(hs_id, czo_id, uname, res.get("resource_title"), date_last_updated)
+
+        removed = [hs_id for hs_id in known if hs_id not in listed]
+        with self._lock:
+            conn = self._get_conn()
+            conn.executemany("DELETE FROM hs_resources WHERE scope = ? AND hs_id = ?",
+                             [(self.scope, hs_id) for hs_id in removed])
+            conn.commit()
+        logging.info("Account {}: {} resources; {} (re)scanned; {} gone".format(uname, len(listed), scanned,
+                                                                                len(removed)))
+
+    def _put(self, hs_id, czo_id, uname, title=None, date_last_updated=None):
+        with self._lock:
+            conn = self._get_conn()
+            conn.execute("INSERT OR REPLACE INTO hs_resources (scope, hs_id, czo_id, uname, title, "
+                         "date_last_updated, scanned_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (self.scope, hs_id, czo_id, uname, title, date_last_updated, time.time()))
+            conn.commit()
+
+    def add(self, czo_id, hs_id, uname, title=None):
+        """
+        Record a resource created by this run; date_last_updated is left empty so the next refresh rescans it
+        :param czo_id: czo_id
+        :param hs_id: resource id
+        :param uname: owner
+        :param title: resource title
+        :return: None
+        """
+        self._put(hs_id, int(czo_id), uname, title=title)
+
+    def get(self, czo_id):
+        """
+        :param czo_id: czo_id
+        :return: {"hs_id", "uname", "title", ...} of the most recently updated resource of czo_id
+                 (resources added by this run first) or None
+        """
+        with self._lock:
+            rows = self._get_conn().execute(
+                "SELECT * FROM hs_resources WHERE scope = ? AND czo_id = ? "
+                "ORDER BY COALESCE(date_last_updated, '9999') DESC", (self.scope, int(czo_id))).fetchall()
+        if len(rows) == 0:
+            return None
+        if len(rows) > 1:
+            logging.warning("CZO_ID {} has {} HS resources: {}".format(czo_id, len(rows),
+                                                                      ", ".join(row["hs_id"] for row in rows)))
+        return dict(rows[0])
+
+    def get_hs_id(self, czo_id):
+        entry = self.get(czo_id)
+        return None if entry is None else entry["hs_id"]
+
+    def czo_ids(self):
+        with self._lock:
+            return [row[0] for row in self._get_conn().execute(
+                "SELECT DISTINCT czo_id FROM hs_resources WHERE scope = ? AND czo_id IS NOT NULL", (self.scope,))]
+
+    def count(self):
+        with self._lock:
+            return self._get_conn().execute("SELECT COUNT(*) FROM hs_resources WHERE scope = ?",
+                                            (self.scope,)).fetchone()[0]
+
+
+def get_hs_resource_index():
+    """
+    :return: HSResourceIndex or None if HS_RESOURCE_INDEX is None
+    """
+    global _hs_resource_index
+    if HS_RESOURCE_INDEX is None:
+        return None
+    with _hs_resource_index_lock:
+        if _hs_resource_index is None:
+            _hs_resource_index = HSResourceIndex(HS_RESOURCE_INDEX, "{}:{}".format(HS_URL, PORT))
+        return _hs_resource_index
@@ -0,0 +1,102 @@
+import logging
+import threading
+import time
+import weakref
+from collections import Counter
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from rate_limit import get_rate_limiter
+from settings import headers, HTTP_CONNECT_TIMEOUT_SEC, HTTP_READ_TIMEOUT_SEC, HTTP_POOL_HOSTS, HTTP_POOL_MAXSIZE
+from utils_logging import text_emphasis
+
+_http_client = None
+_http_client_lock = threading.Lock()
+
+
+class HTTPClient(object):
+    """
+    HTTP client for all outbound source-file traffic (CZO origin servers)
+    One shared requests.Session with a keep-alive connection pool per host, default connect/read timeouts
+    and the browser-like headers; every request is paced by the per-host rate limiter
+    """
+
+    def __init__(self, pool_hosts, pool_maxsize, timeout):
+        self.timeout = timeout
+        self._session = requests.Session()
+        self._adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_maxsize)
+        self._session.mount("http://", self._adapter)
+        self._session.mount("https://", self._adapter)
+        # running totals for get_stats: the pool manager drops the pools (and their counters) of hosts it evicts
+        self._stats_lock = threading.Lock()
+        self._totals = Counter()
+        self._hosts = set()
+        self._pool_counts = weakref.WeakKeyDictionary()  # pool -> (num_requests, num_connections) counted
+        self._session.hooks["response"].append(self._count_response)
+
+    def _count_response(self, response, **kwargs):
+        # add what the response's pool did since it was last looked at (redirects come here one by one)
+        pool = getattr(response.raw, "_pool", None)
+        with self._stats_lock:
+            self._hosts.add(urlparse(response.url).netloc)
+            if pool is None:
+                self._totals["requests"] += 1
+                return response
+            num_requests, num_connections = self._pool_counts.get(pool, (0, 0))
+            self._totals["requests"] += pool.num_requests - num_requests
+            self._totals["connections"] += pool.num_connections - num_connections
+            self._pool_counts[pool] = (pool.num_requests, pool.num_connections)
+        return response
+
+    def request(self, method, url, **kwargs):
+        # sending headers is very important or in some cases requests.get() wont download the actual file content/binary
+        kwargs.setdefault("headers", headers)
+        kwargs.setdefault("timeout", self.timeout)
+        rate_limiter = get_rate_limiter()
+        rate_limiter.acquire(url)
+        _start = time.time()
+        try:
+            response = self._session.request(method, url, **kwargs)
+        except Exception:
+            rate_limiter.report(url)
+            raise
+        # streamed bodies are accounted for by the caller once read
+        nbytes = 0 if kwargs.get("stream") else len(response.content)
+        rate_limiter.report(url, status_code=response.status_code, retry_after=response.headers.get('retry-after'),
+                            nbytes=nbytes, seconds=time.time() - _start)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+
+    def get_stats(self):
+        """
+        Connection reuse over all requests so far
+        :return: {"hosts": int, "requests": int, "connections": int, "reused": int}
+        """
+        with self._stats_lock:
+            stats = {"hosts": len(self._hosts),
+                     "requests": self._totals["requests"],
+                     "connections": self._totals["connections"]}
+        stats["reused"] = stats["requests"] - stats["connections"]
+        return stats
+
+    def log_stats(self):
+        stats = self.get_stats()
+        logging.info(text_emphasis("Summary on HTTP Connections"))
+        logging.info("{requests} requests to {hosts} hosts over {connections} connections; "
+                     "{reused} reused a kept-alive connection".format(**stats))
+
+
+def get_http_client():
+    global _http_client
+    with _http_client_lock:
+        if _http_client is None:
+            _http_client = HTTPClient(HTTP_POOL_HOSTS, HTTP_POOL_MAXSIZE,
+                                      (HTTP_CONNECT_TIMEOUT_SEC, HTTP_READ_TIMEOUT_SEC))
+        return _http_client
@@ -0,0 +1,155 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from settings import MIGRATION_JOURNAL, HS_URL, PORT
+
+# migration log lists an op appends to; a step record keeps what its op appended so a resumed row
+# reports the files of earlier runs too
+JOURNAL_LOG_LISTS = ["ref_file_list", "bad_ref_file_list", "concrete_file_list", "maps"]
+
+_migration_journal = None
+_migration_journal_lock = threading.Lock()
+
+
+def _czo_key(czo_id):
+    # czo_ids come as int (csv), numpy int or str (plans); journal_ids of delta plans are str
+    try:
+        return str(int(float(czo_id)))
+    except (TypeError, ValueError, OverflowError):
+        return str(czo_id)
+
+
+def _json_default(obj):
+    # numpy scalars from the csv
+    return obj.item() if hasattr(obj, "item") else str(obj)
+
+
+class MigrationJournal(object):
+    """
+    Append-only journal (JSON lines) of completed migration steps, keyed by czo_id
+    step record: an op of a row's plan had its effect on HydroShare (resource created, a metadata section
+                 updated, a file added, resource made public); a resumed run skips it
+    row record: all ops of a row were run; a resumed run skips the row and reuses its result
+    Records of another HydroShare server (scope) are ignored. czo_ids are kept as str whatever type they come in.
+    """
+
+    def __init__(self, path, scope):
+        self.path = path
+        self.scope = scope
+        self._lock = threading.Lock()
+        self._steps = {}  # czo_id -> {key: step record}
+        self._rows = {}  # czo_id -> row record
+        self._load()
+        self._f = open(self.path, 'a')
+        if self._f.tell() > 0 and not self._ends_with_newline():
+            # last line cut short by a crash; new records go on lines of their own
+            self._f.write("\n")
+            self._f.flush()
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, 'r') as f:
+            for line_no, line in enumerate(f, start=1):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # last line may be cut short by a crash
+                    logging.warning("Ignored bad line {} of journal {}".format(line_no, self.path))
+                    continue
+                if record.get("scope") != self.scope:
+                    continue
+                # journals of older versions have int czo_ids of direct runs
+                record["czo_id"] = _czo_key(record["czo_id"])
+                if record["type"] == "step":
+                    self._steps.setdefault(record["czo_id"], {})[record["key"]] = record
+                elif record["type"] == "row":
+                    self._rows[record["czo_id"]] = record
+        logging.info("Journal {}: {} steps of {} rows; {} rows done".format(
+            self.path, sum(len(steps) for steps in self._steps.values()), len(self._steps),
+            len(self.completed_czo_ids())))
+
+    def _ends_with_newline(self):
+        with open(self.path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def _append(self, record):
+        record["scope"] = self.scope
+        record["ts"] = time.time()
+        line = json.dumps(record, default=_json_default)
+        with self._lock:
+            self._f.write(line + "\n")
+            self._f.flush()
+            os.fsync(self._f.fileno())
+            if record["type"] == "step":
+                self._steps.setdefault(record["czo_id"], {})[record["key"]] = record
+            else:
+                self._rows[record["czo_id"]] = record
+
+    def record_step(self, czo_id, key, hs_id, uname, ok=True, log_delta=None, data=None):
+        """
+        :param czo_id: czo_id
+        :param key: op key (see api_helpers.get_op_key)
+        :param hs_id: resource id
+        :param uname: owner of the resource
+        :param ok: False if the op had its effect but counts as a failure (eg. file added as NOT_RESOLVING_URL)
+        :param log_delta: {JOURNAL_LOG_LISTS item: items the op appended}
+        :param data: anything a resumed run needs to finish the op (eg. deferred file ops)
+        :return: None
+        """
+        self._append({"type": "step", "czo_id": _czo_key(czo_id), "key": key, "hs_id": hs_id, "uname": uname, "ok": ok,
+                      "log": log_delta if log_delta else {}, "data": data})
+
+    def record_row(self, czo_id, czo_hs_id_lookup_dict, full_data_item):
+        """
+        :param czo_id: czo_id
+        :param czo_hs_id_lookup_dict: lookup table row
+        :param full_data_item: migration log
+        :return: None
+        """
+        self._append({"type": "row", "czo_id": _czo_key(czo_id), "lookup": czo_hs_id_lookup_dict, "log": full_data_item,
+                      "success": full_data_item["success"]})
+
+    def get_steps(self, czo_id):
+        """
+        :param czo_id: czo_id
+        :return: {key: step record} of completed steps
+        """
+        with self._lock:
+            return dict(self._steps.get(_czo_key(czo_id), {}))
+
+    def get_completed_row(self, czo_id):
+        """
+        :param czo_id: czo_id
+        :return: row record if the row migrated successfully, else None
+        """
+        with self._lock:
+            record = self._rows.get(_czo_key(czo_id))
+        if record is None or not record["success"]:
+            # failed rows are resumed from their first incomplete step
+            return None
+        return record
+
+    def completed_czo_ids(self):
+        return [czo_id for czo_id, record in self._rows.items() if record["success"]]
+
+    def close(self):
+        with self._lock:
+            self._f.close()
+
+
+def get_migration_journal():
+    """
+    :return: MigrationJournal or None if MIGRATION_JOURNAL is None
+    """
+    global _migration_journal
+    if MIGRATION_JOURNAL is None:
+        return None
+    with _migration_journal_lock:
+        if _migration_journal is None:
+            _migration_journal = MigrationJournal(MIGRATION_JOURNAL, "{}:{}".format(HS_URL, PORT))
+        return _migration_journal
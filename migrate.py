@@ -1,3 +1,4 @@
+import json
 import logging
 import os
 import time
@@ -6,12 +7,26 @@ import pandas as pd
 from pandas.io.json import json_normalize
 
 from accounts import CZOHSAccount
-from api_helpers import create_hs_res_from_czo_row
+from czo_data import get_czo_dataset
+from preflight import run_preflight
+from api_helpers import create_hs_res_from_czo_row, plan_hs_res_from_czo_row, apply_hs_res_plan, get_czo_primary
 from settings import LOG_DIR, CZO_ACCOUNTS, CLEAR_LOGS, \
     CZO_DATA_CSV, CZO_ID_LIST_TO_MIGRATE, START_ROW_INDEX, END_ROW_INDEX, \
-    RUN_2ND_PASS
-from utils_logging import text_emphasis, elapsed_time, log_uploaded_file_stats
+    RUN_2ND_PASS, CONCURRENT_MIGRATION, MAX_WORKERS, MAX_WORKERS_PER_ACCOUNT, PIPELINE_PREFETCH, \
+    USE_CACHED_FILES, MB_TO_BYTE, PREFLIGHT_CHECK, MIGRATION_MODE, PLAN_FILE, DELTA_BASE_CSV
+from utils_logging import text_emphasis, elapsed_time, log_uploaded_file_stats, log_exception
 from second_pass import second_pass
+from pipeline import start_prefetcher, get_prefetcher, stop_prefetcher
+from file_ops import get_cache_stats
+from util import run_bounded_per_key
+from http_client import get_http_client
+from retry_policy import get_retry_stats
+from dead_urls import get_dead_url_registry
+from journal import get_migration_journal
+from hs_index import get_hs_resource_index
+from delta import diff_exports, plan_delta
+from rate_limit import get_rate_limiter
+from staging import get_staging_area, row_workspace
 
 
 def logging_init(log_prefix="log"):
@@ -42,24 +57,43 @@ def logging_init(log_prefix="log"):
     return os.path.join(LOG_DIR, log_file_name), timestamp_suffix
 
 
-def migrate_czo_row(czo_row_dict, czo_accounts, row_no=1):
+def migrate_czo_row(czo_row_dict, czo_accounts, row_no=1, file_rows=None):
     """
     Create a HS resource from a CZO row dict
     :param czo_row_dict:
     :param czo_accounts:
     :param row_no:
-    :return:
+    :param file_rows: files table rows of the CZO row
+    :return: (czo_hs_id_lookup_dict, full_data_item)
     """
-    global error_status
     _start = time.time()
     # logging.info(text_emphasis("", char='=', num_char=40))
 
-    full_data_item = create_hs_res_from_czo_row(czo_row_dict, czo_accounts, index=row_no)
+    with row_workspace(czo_row_dict.get("czo_id")):
+        full_data_item = create_hs_res_from_czo_row(czo_row_dict, czo_accounts, index=row_no, file_rows=file_rows,
+                                                    journal=get_migration_journal(),
+                                                    hs_index=get_hs_resource_index())
+    return _row_done(full_data_item, czo_row_dict.get("czo_id"), row_no, _start)
 
-    if full_data_item["success"]:
-        error_status["success"].append(full_data_item)
-    else:
-        error_status["error"].append(full_data_item)
+
+def apply_czo_plan(plan, czo_accounts):
+    """
+    Create a HS resource from a plan written in "plan" mode
+    :param plan: plan dict (see api_helpers.plan_hs_res_from_czo_row)
+    :param czo_accounts:
+    :return: (czo_hs_id_lookup_dict, full_data_item)
+    """
+    _start = time.time()
+    with row_workspace(plan["czo_id"]):
+        full_data_item = apply_hs_res_plan(plan, czo_accounts, journal=get_migration_journal(),
+                                           hs_index=get_hs_resource_index())
+    return _row_done(full_data_item, plan["czo_id"], plan["index"], _start, journal_id=plan.get("journal_id"))
+
+
+def _row_done(full_data_item, czo_id, row_no, _start, journal_id=None):
+    prefetcher = get_prefetcher()
+    if prefetcher is not None:
+        prefetcher.finish_row(czo_id)
 
     czo_hs_id_lookup_dict = {"czo_id": full_data_item["czo_id"],
                              "hs_id": full_data_item["hs_id"],
@@ -70,16 +104,154 @@ def migrate_czo_row(czo_row_dict, czo_accounts, row_no=1):
                              "maps": "|".join(full_data_item["maps"]),
                              }
 
+    journal = get_migration_journal()
+    if journal is not None:
+        journal.record_row(czo_id if journal_id is None else journal_id, czo_hs_id_lookup_dict, full_data_item)
+
     log_uploaded_file_stats(full_data_item)
-    logging.info("{} - Success: {} - Error {}".format(elapsed_time(_start, time.time()),
-                                                      len(error_status["success"]), len(error_status["error"])))
-    return czo_hs_id_lookup_dict
+    logging.info("NO.{} {}".format(row_no, elapsed_time(_start, time.time())))
+    return czo_hs_id_lookup_dict, full_data_item
+
+
+def _failed_row(uname, args, ex):
+    """
+    Result of a row task that raised (see run_row_tasks); the row is reported as failed instead of dropped
+    :param uname: account of the task
+    :param args: task args; czo row dict or plan first
+    :param ex: exception
+    :return: (czo_hs_id_lookup_dict, full_data_item)
+    """
+    row = args[0]
+    row_no = row["index"] if "ops" in row else args[2]
+    full_data_item = {"success": False,
+                      "czo_id": row.get("czo_id"),
+                      "hs_id": -1,
+                      "ref_file_list": [],
+                      "bad_ref_file_list": [],
+                      "concrete_file_list": [],
+                      "error_msg_list": [],
+                      "uname": uname,
+                      "public": False,
+                      "maps": [],
+                      "file_op_failures": [],
+                      }
+    log_exception(ex, migration_log=full_data_item, extra_msg="Unhandled error: ")
+    return _row_done(full_data_item, row.get("czo_id"), row_no, time.time(), journal_id=row.get("journal_id"))
+
+
+def get_row_uname(czo_row_dict, czo_accounts):
+    """
+    HS account a CZO row will be migrated by; used to cap in-flight rows per account
+    :param czo_row_dict:
+    :param czo_accounts:
+    :return: uname
+    """
+    try:
+        czo_primary, _ = get_czo_primary(czo_row_dict)
+        return czo_accounts.get_account_by_czo(czo_primary).uname
+    except Exception:
+        # bad rows fail again (and get logged) in create_hs_res_from_czo_row
+        return czo_accounts.get_uname_by_czo("default")
+
+
+def run_row_tasks(tasks, on_result):
+    """
+    Run row tasks one by one, or concurrently if CONCURRENT_MIGRATION is on
+    In concurrent mode rows are dispatched from this (main) thread so that no more than MAX_WORKERS rows
+    are in flight in total and no more than MAX_WORKERS_PER_ACCOUNT rows per HS account;
+    on_result is always called in this thread, in whatever order rows complete
+    :param tasks: list of (uname, func, args); func returns (czo_hs_id_lookup_dict, full_data_item)
+    :param on_result: callback(czo_hs_id_lookup_dict, full_data_item)
+    :return: None
+    """
+    if not CONCURRENT_MIGRATION:
+        for _, func, args in tasks:
+            on_result(*func(*args))
+        return
+
+    def _on_row_done(uname, args, result, ex):
+        if ex is not None:
+            logging.error("Unhandled error by account {}: {}".format(uname, ex))
+            result = _failed_row(uname, args, ex)
+        on_result(*result)
+
+    logging.info("Concurrent migration: {} workers; {} per account".format(MAX_WORKERS, MAX_WORKERS_PER_ACCOUNT))
+    run_bounded_per_key(tasks, MAX_WORKERS, MAX_WORKERS_PER_ACCOUNT, _on_row_done)
+
+
+def get_row_tasks(czo_rows, czo_accounts):
+    """
+    Tasks to migrate CZO rows (see run_row_tasks)
+    :param czo_rows: list of (row_no, czo_row_dict, file_rows)
+    :param czo_accounts: CZOHSAccount obj
+    :return: list of tasks
+    """
+    return [(get_row_uname(czo_row_dict, czo_accounts), migrate_czo_row,
+             (czo_row_dict, czo_accounts, row_no, file_rows))
+            for row_no, czo_row_dict, file_rows in czo_rows]
+
+
+def get_plan_tasks(plans, czo_accounts):
+    """
+    Tasks to run plans (see run_row_tasks); plans that failed to plan are logged as errors
+    :param plans: list of plan dicts
+    :param czo_accounts: CZOHSAccount obj
+    :return: list of tasks
+    """
+    return [(plan["uname"] or czo_accounts.get_uname_by_czo("default"), apply_czo_plan, (plan, czo_accounts))
+            for plan in plans]
+
+
+def _json_default(obj):
+    # numpy scalars from the csv
+    return obj.item() if hasattr(obj, "item") else str(obj)
+
+
+def write_plans(czo_rows, czo_accounts, plan_path):
+    """
+    Plan CZO rows without writing to HydroShare and save the plans as JSON lines
+    :param czo_rows: list of (row_no, czo_row_dict, file_rows)
+    :param czo_accounts: CZOHSAccount obj
+    :param plan_path: path to plan file
+    :return: number of rows that failed to plan
+    """
+    failed = 0
+    with open(plan_path, 'w') as f:
+        for row_no, czo_row_dict, file_rows in czo_rows:
+            plan = plan_hs_res_from_czo_row(czo_row_dict, czo_accounts, index=row_no, file_rows=file_rows)
+            if not plan["ok"] or plan["file_errors"] > 0:
+                failed += 1
+            f.write(json.dumps(plan, default=_json_default) + "\n")
+    logging.info("Saved {} plans ({} with errors) to {}".format(len(czo_rows), failed, plan_path))
+    return failed
+
+
+def read_plans(plan_path):
+    """
+    :param plan_path: path to plan file written by write_plans
+    :return: list of plan dicts in row order
+    """
+    with open(plan_path, 'r') as f:
+        plans = [json.loads(line) for line in f if len(line.strip()) > 0]
+    return sorted(plans, key=lambda plan: plan["index"])
+
+
+def get_plan_download_urls(plan):
+    """
+    Urls apply_hs_res_plan will download (files planned but not downloaded yet)
+    :param plan: plan dict
+    :return: list of urls
+    """
+    return [op["file"]["original_url"] for op in plan["ops"]
+            if op["op"] == "add_file" and op["file"]["file_type"] != "ReferencedFile"
+            and not op["file"].get("downloaded")]
 
 
-def output_status(success_error, czo_accounts):
+def output_status(success_error, error_list, czo_accounts):
     """
     Parse and log the status
     :param: success_error:
+    :param: error_list:
     :param: czo_accounts:
     :return:
     """
@@ -107,45 +279,154 @@ def output_status(success_error, czo_accounts):
         df_concrete_file_list_filter = df_concrete_file_list[df_concrete_file_list.concrete_file_size_mb > 0]
         logging.info(df_concrete_file_list_filter.sum(axis=0, skipna=True))
 
-    for k, error_item in enumerate(error_status["error"]):
+    df_file_op_failures = json_normalize(success_error, "file_op_failures", ["czo_id", "hs_id"])
+    if (not df_file_op_failures.empty) and df_file_op_failures.shape[0] > 0:
+        logging.info(text_emphasis("Summary on Failed File Type/Metadata Updates"))
+        logging.info(df_file_op_failures.to_string())
+
+    if USE_CACHED_FILES:
+        cache_stats = get_cache_stats()
+        logging.info(text_emphasis("Summary on Cached Files"))
+        logging.info("Cache hits: {}; misses: {}; saved download of {:.2f} MB".format(
+            cache_stats["hits"], cache_stats["misses"], float(cache_stats["bytes_saved"]) / MB_TO_BYTE))
+
+    get_rate_limiter().log_stats()
+    get_http_client().log_stats()
+    get_retry_stats().log_stats()
+    get_dead_url_registry().log_stats()
+
+    for k, error_item in enumerate(error_list):
         errors = "|".join([err_msg.replace("\n", " ") for err_msg in error_item["error_msg_list"]])
         logging.info("{} CZO_ID {} HS_ID {} Error {}".format(k + 1, error_item["czo_id"], error_item["hs_id"], errors))
     return czo_accounts.get_hs_by_czo("default")
 
 
-def main():
-    log_file_path, timestamp_suffix = logging_init()
-    logging.info("Migration Start {}".format(start_time.asctime()))
+def _resumed(journal, czo_id, on_result):
+    # czo_id or journal_id of a plan
+    record = journal.get_completed_row(czo_id)
+    if record is None:
+        return False
+    logging.info("Skipping CZO_ID {}: migrated to HS resource {} by an earlier run".format(
+        czo_id, record["lookup"]["hs_id"]))
+    # journals written before file ops were batched
+    record["log"].setdefault("file_op_failures", [])
+    on_result(record["lookup"], record["log"])
+    return True
 
-    czo_accounts = CZOHSAccount(CZO_ACCOUNTS)
-    czo_hs_id_lookup_df = pd.DataFrame(columns=["success", "czo_id", "hs_id", "uname", "elapsed_time",
-                                                "public", "maps"]).\
-        astype(dtype={"elapsed_time": "timedelta64[s]", })
 
-    czo_data = pd.read_csv(CZO_DATA_CSV)
-    czo_data = czo_data[czo_data.czo_id > 1]
-    czo_data.czo_id = czo_data.czo_id.astype(int)
-    czo_id_list = CZO_ID_LIST_TO_MIGRATE.copy()
+def select_czo_rows(timestamp_suffix, czo_id_list=None):
+    """
+    CZO rows to migrate: czo_id_list, CZO_ID_LIST_TO_MIGRATE or rows START_ROW_INDEX to END_ROW_INDEX,
+    minus rows failing the preflight check
+    :param timestamp_suffix: suffix of report files
+    :param czo_id_list: czo_ids to migrate
+    :return: list of (row_no, czo_row_dict, file_rows)
+    """
+    czo_dataset = get_czo_dataset(CZO_DATA_CSV)
+    if czo_id_list is None:
+        czo_id_list = CZO_ID_LIST_TO_MIGRATE.copy()
+    elif len(czo_id_list) == 0:
+        return []
     if czo_id_list is None or len(czo_id_list) == 0:
+        all_czo_ids = [czo_id for czo_id in czo_dataset.czo_ids() if czo_id > 1]
         end_index = END_ROW_INDEX
-        if end_index > czo_data.shape[0] - 1:
-            end_index = czo_data.shape[0] - 1
+        if end_index > len(all_czo_ids) - 1:
+            end_index = len(all_czo_ids) - 1
             logging.warning("end_index reset to {}".format(end_index))
 
-        indices = range(START_ROW_INDEX, end_index+1)
-        czo_id_list = czo_data.iloc[indices]["czo_id"].tolist()
+        czo_id_list = all_czo_ids[START_ROW_INDEX:end_index+1]
+    if PREFLIGHT_CHECK:
+        czo_id_list = run_preflight(czo_dataset, czo_id_list,
+                                    os.path.join(LOG_DIR, 'preflight_{}.csv'.format(timestamp_suffix)))
     logging.info("Processing on {} czo_ids: {}".format(len(czo_id_list), czo_id_list))
 
+    czo_rows = []
     for i in range(len(czo_id_list)):
         czo_id = czo_id_list[i]
         # process a specific row by czo_id
-        czo_row_dict = czo_data.loc[czo_data['czo_id'] == czo_id].to_dict(orient='records')[0]
-        result = migrate_czo_row(czo_row_dict, czo_accounts, row_no=i + 1)
-        czo_hs_id_lookup_df = czo_hs_id_lookup_df.append(result, ignore_index=True)
-        if i % 5 == 0:
+        czo_row_dict = czo_dataset.get_dict(czo_id)
+        czo_rows.append((i + 1, czo_row_dict, czo_dataset.get_files(czo_id)))
+    return czo_rows
+
+
+def main():
+    log_file_path, timestamp_suffix = logging_init()
+    logging.info("Migration Start {}".format(start_time.asctime()))
+
+    czo_accounts = CZOHSAccount(CZO_ACCOUNTS)
+    czo_hs_id_lookup_df = pd.DataFrame(columns=["success", "czo_id", "hs_id", "uname", "elapsed_time",
+                                                "public", "maps"]).\
+        astype(dtype={"elapsed_time": "timedelta64[s]", })
+
+    # files left by runs that died
+    get_staging_area().sweep()
+
+    hs_index = get_hs_resource_index()
+    if hs_index is not None and MIGRATION_MODE != "plan":
+        hs_index.refresh(czo_accounts)
+
+    czo_rows = []
+    plans = []
+    if MIGRATION_MODE == "apply":
+        plans = read_plans(PLAN_FILE)
+        logging.info("Applying {} plans from {}".format(len(plans), PLAN_FILE))
+    elif MIGRATION_MODE == "delta":
+        if hs_index is None:
+            raise Exception("Delta migration needs HS_RESOURCE_INDEX (settings) to find existing resources")
+        old_dataset = get_czo_dataset(DELTA_BASE_CSV)
+        new_dataset = get_czo_dataset(CZO_DATA_CSV)
+        delta_report = diff_exports(old_dataset, new_dataset)
+        delta_file = os.path.join(LOG_DIR, 'delta_{}.csv'.format(timestamp_suffix))
+        delta_report.to_csv(delta_file, index=False)
+        logging.info("Saved delta of {} and {} to {}".format(DELTA_BASE_CSV, CZO_DATA_CSV, delta_file))
+        delta_id = "delta:{}:{}".format(os.path.basename(DELTA_BASE_CSV), os.path.basename(CZO_DATA_CSV))
+        new_czo_ids, plans = plan_delta(delta_report, old_dataset, new_dataset, czo_accounts, hs_index,
+                                        delta_id=delta_id)
+        czo_rows = select_czo_rows(timestamp_suffix, czo_id_list=new_czo_ids)
+    else:
+        czo_rows = select_czo_rows(timestamp_suffix)
+        if MIGRATION_MODE == "plan":
+            write_plans(czo_rows, czo_accounts, os.path.join(LOG_DIR, 'plan_{}.jsonl'.format(timestamp_suffix)))
+            return
+
+    migration_results = {"success": [], "error": []}
+
+    def _collect_result(czo_hs_id_lookup_dict, full_data_item):
+        nonlocal czo_hs_id_lookup_df
+        if full_data_item["success"]:
+            migration_results["success"].append(full_data_item)
+        else:
+            migration_results["error"].append(full_data_item)
+        czo_hs_id_lookup_df = czo_hs_id_lookup_df.append(czo_hs_id_lookup_dict, ignore_index=True)
+        logging.info("{} - Success: {} - Error {}".format(elapsed_time(start, time.time()),
+                                                          len(migration_results["success"]),
+                                                          len(migration_results["error"])))
+        if czo_hs_id_lookup_df.shape[0] % 5 == 1:
             print(czo_hs_id_lookup_df)
 
-    success_error = error_status["success"] + error_status["error"]
+    journal = get_migration_journal()
+    if journal is not None:
+        # rows done by earlier runs are reported from the journal, not migrated again
+        plans = [plan for plan in plans
+                 if not _resumed(journal, plan.get("journal_id", plan["czo_id"]), _collect_result)]
+        czo_rows = [row for row in czo_rows if not _resumed(journal, row[1]["czo_id"], _collect_result)]
+
+    if PIPELINE_PREFETCH:
+        # queue files of all rows in input order; staging budget limits how far ahead prefetching runs
+        prefetcher = start_prefetcher()
+        for plan in plans:
+            prefetcher.submit_urls(plan["czo_id"], get_plan_download_urls(plan))
+        for _, czo_row_dict, file_rows in czo_rows:
+            prefetcher.submit_row(czo_row_dict["czo_id"], file_rows)
+    try:
+        run_row_tasks(get_plan_tasks(plans, czo_accounts) + get_row_tasks(czo_rows, czo_accounts), _collect_result)
+    finally:
+        stop_prefetcher()
+    staging_stats = get_staging_area().get_stats()
+    logging.info("Staging area: peak {:.2f} MB; downloads waited for space {} times".format(
+        float(staging_stats["peak_bytes"]) / MB_TO_BYTE, staging_stats["waits"]))
+
+    success_error = migration_results["success"] + migration_results["error"]
 
     logging.info(czo_hs_id_lookup_df.to_string())
 
@@ -156,10 +437,10 @@ def main():
     czo_hs_id_lookup_df.to_csv(results_file, encoding='utf-8', index=False)
 
     if RUN_2ND_PASS:
-        second_pass(CZO_DATA_CSV, results_file, czo_accounts)
+        second_pass(CZO_DATA_CSV, results_file, czo_accounts, hs_index=hs_index)
 
     # upload logs and results to HS
-    hs = output_status(success_error, czo_accounts)
+    hs = output_status(success_error, migration_results["error"], czo_accounts)
 
     # existing_hs_ids = [x for x in hs.resources()]
     # scimeta = [hs.getScienceMetadata(x.get('resource_id')) for x in existing_hs_ids]
@@ -176,7 +457,6 @@ def main():
 if __name__ == "__main__":
     start_time = time
     start = time.time()
-    error_status = {"error": [], "success": [], "size_uploaded_mb": 0.0, "big_file_list": []}
 
     try:
         main()
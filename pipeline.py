@@ -0,0 +1,240 @@
+import logging
+import os
+import shutil
+import threading
+from collections import Counter, OrderedDict, deque
+
+import file_ops
+from file_ops import stream_to_file, check_file_size_mb, get_cached_file
+from util import hash_string
+from dead_urls import get_dead_url_registry
+from settings import MB_TO_BYTE, BIG_FILE_SIZE_MB, PREFETCH_WORKERS, PREFETCH_MAX_STAGED_MB, USE_CACHED_FILES
+from staging import get_staging_area
+
+_prefetcher = None
+# staging area workspace the prefetcher stages files in
+_prefetch_workspace = None
+
+
+def get_row_download_urls(file_rows):
+    """
+    Urls of a CZO row that migration would download (concrete files; same rules as api_helpers.get_files)
+    Known dead urls and urls in the local cache (download_file links those) are left out.
+    :param file_rows: files table rows of the CZO row (see czo_data.build_files_table)
+    :return: list of urls
+    """
+    download_urls = []
+    for f in file_rows:
+        if f["kind"] == "component" and (not f["parse_ok"] or f["is_private"]):
+            # private components are migrated as ReferencedFile; their metadata files are downloaded anyway
+            continue
+        if f["extension_class"] != "supported" or f["url"] in download_urls:
+            continue
+        if get_dead_url_registry().is_dead(f["url"]):
+            continue
+        if USE_CACHED_FILES and get_cached_file(f["url"])[0] is not None:
+            continue
+        download_urls.append(f["url"])
+    return download_urls
+
+
+class FilePrefetcher(object):
+    """
+    Prefetch stage of the migration pipeline:
+    downloads source files of upcoming rows into a staging dir while the current row goes to HydroShare.
+    Workers pause (back-pressure) once max_staged_mb are staged and resume as rows release their files.
+    """
+
+    def __init__(self, staging_dir, max_staged_mb, num_workers):
+        self._staging_dir = staging_dir
+        self._max_staged_bytes = max_staged_mb * MB_TO_BYTE
+        self._num_workers = num_workers
+        self._cond = threading.Condition()
+        self._staged_bytes = 0
+        self._entries = {}  # url -> {"state": pending|downloading|staged|failed|skipped|claimed|released, ...}
+        self._row_urls = {}  # czo_id -> [url]
+        self._queue = deque()
+        self._threads = []
+        self._stopped = False
+        self.stats = Counter()
+
+    def start(self):
+        if not os.path.exists(self._staging_dir):
+            os.makedirs(self._staging_dir)
+        for i in range(self._num_workers):
+            t = threading.Thread(target=self._worker, name="prefetch-{}".format(i), daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
+        shutil.rmtree(self._staging_dir, ignore_errors=True)
+        logging.info("Prefetch: {} staged ({:.2f} MB); {} claimed; {} missed; {} failed; {} big files skipped".format(
+            self.stats["staged"], float(self.stats["staged_bytes"]) / MB_TO_BYTE,
+            self.stats["claimed"], self.stats["missed"], self.stats["failed"], self.stats["big"]))
+
+    def submit_row(self, czo_id, file_rows):
+        self.submit_urls(czo_id, get_row_download_urls(file_rows))
+
+    def submit_urls(self, czo_id, urls):
+        with self._cond:
+            urls = list(OrderedDict.fromkeys(urls))
+            self._row_urls[czo_id] = urls
+            for url in urls:
+                if url in self._entries:
+                    # a url of several rows stays until the last of them is done (see finish_row)
+                    self._entries[url]["rows"] += 1
+                    continue
+                self._entries[url] = {"state": "pending", "path": None, "size": 0, "md5": None, "rows": 1}
+                self._queue.append(url)
+            self._cond.notify_all()
+
+    def claim(self, url):
+        """
+        Hand a staged file over to the caller, who must move it away and call release() after uploading.
+        Waits if the url is being downloaded right now; a url still in the queue is dropped from it
+        so the caller simply downloads the file itself.
+        :param url: source url
+        :return: {"path": staged file, "size": bytes, "md5": hex digest} or None
+        """
+        with self._cond:
+            entry = self._entries.get(url)
+            if entry is None:
+                return None
+            while entry["state"] == "downloading":
+                self._cond.wait()
+            if entry["state"] == "staged":
+                entry["state"] = "claimed"
+                self.stats["claimed"] += 1
+                return {"path": entry["path"], "size": entry["size"], "md5": entry["md5"]}
+            if entry["state"] == "pending":
+                entry["state"] = "skipped"
+            self.stats["missed"] += 1
+            return None
+
+    def release(self, url):
+        """
+        Give back the staging bytes of a claimed file
+        :param url: source url
+        :return: None
+        """
+        with self._cond:
+            entry = self._entries.get(url)
+            if entry is None or entry["state"] != "claimed":
+                return
+            entry["state"] = "released"
+            self._staged_bytes -= entry["size"]
+            self._cond.notify_all()
+
+    def finish_row(self, czo_id):
+        """
+        Release everything staged for a finished row, incl. files the row never claimed (eg. turned out ReferencedFile)
+        Urls other unfinished rows also listed are left to the last of them: one of those may hold the claim.
+        :param czo_id: czo_id
+        :return: None
+        """
+        with self._cond:
+            for url in self._row_urls.pop(czo_id, []):
+                entry = self._entries.get(url)
+                if entry is None:
+                    continue
+                entry["rows"] -= 1
+                if entry["rows"] > 0:
+                    continue
+                if entry["state"] == "pending":
+                    entry["state"] = "skipped"
+                elif entry["state"] == "staged":
+                    entry["state"] = "released"
+                    self._staged_bytes -= entry["size"]
+                    if os.path.isfile(entry["path"]):
+                        os.remove(entry["path"])
+                elif entry["state"] == "claimed":
+                    entry["state"] = "released"
+                    self._staged_bytes -= entry["size"]
+                elif entry["state"] == "downloading":
+                    # dropped by the worker once the download completes
+                    entry["orphan"] = True
+            self._cond.notify_all()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._stopped and \
+                        (len(self._queue) == 0 or self._staged_bytes >= self._max_staged_bytes):
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                url = self._queue.popleft()
+                entry = self._entries[url]
+                if entry["state"] != "pending":
+                    continue
+                entry["state"] = "downloading"
+
+            f_path = os.path.join(self._staging_dir, hash_string(url))
+            try:
+                state = "staged" if self._download(url, f_path, entry) else "big"
+            except Exception as ex:
+                logging.warning("Prefetch failed {}: {}".format(url, ex))
+                state = "failed"
+                if os.path.isfile(f_path):
+                    os.remove(f_path)
+
+            with self._cond:
+                self.stats[state] += 1
+                if state == "staged":
+                    self.stats["staged_bytes"] += entry["size"]
+                if state == "staged" and entry.get("orphan"):
+                    state = "released"
+                    os.remove(f_path)
+                if state != "staged":
+                    self._staged_bytes -= entry["size"]
+                    entry["size"] = 0
+                entry["path"] = f_path
+                # a big file is left to migration, which makes it a ReferencedFile
+                entry["state"] = "skipped" if state == "big" else state
+                self._cond.notify_all()
+
+    def _download(self, url, save_to_path, entry):
+        """
+        :return: False if the file is bigger than BIG_FILE_SIZE_MB (nothing downloaded), else True
+        """
+        if check_file_size_mb(url) > BIG_FILE_SIZE_MB:
+            return False
+
+        def _count_chunk(chunk):
+            # count bytes while they stream so in-flight downloads also apply back-pressure
+            with self._cond:
+                entry["size"] += len(chunk)
+                self._staged_bytes += len(chunk)
+
+        stream_info = stream_to_file(url, save_to_path, max_size_byte=BIG_FILE_SIZE_MB * MB_TO_BYTE,
+                                     on_chunk=_count_chunk)
+        entry["md5"] = stream_info["md5"]
+        return True
+
+
+def start_prefetcher():
+    global _prefetcher, _prefetch_workspace
+    _prefetch_workspace = get_staging_area().open_workspace("prefetch")
+    _prefetcher = FilePrefetcher(_prefetch_workspace.path, PREFETCH_MAX_STAGED_MB, PREFETCH_WORKERS)
+    _prefetcher.start()
+    file_ops.set_prefetcher(_prefetcher)
+    return _prefetcher
+
+
+def get_prefetcher():
+    return _prefetcher
+
+
+def stop_prefetcher():
+    global _prefetcher
+    if _prefetcher is None:
+        return
+    file_ops.set_prefetcher(None)
+    _prefetcher.stop()
+    _prefetcher = None
+    _prefetch_workspace.close()
@@ -1,99 +1,143 @@
 # This is a standalone script to prototype the pre-downloading feature
 import os
 import logging
+import time
+from collections import Counter, OrderedDict
 from datetime import datetime as dt
-import hashlib
-import multiprocessing
-from multiprocessing import Manager, Process
 
 import requests
 import pandas as pd
-import numpy as np
-import validators
 
-from util import retry_func
-from settings import headers, MB_TO_BYTE, CACHED_FILE_DIR, BIG_FILE_SIZE_MB, CZO_DATA_CSV
+from util import retry_func, hash_string, run_bounded_per_key
+from file_ops import stream_to_file, BigFileInterrupted
+from file_cache import get_file_cache
+from czo_data import get_czo_dataset
+from pipeline import get_row_download_urls
+from http_client import get_http_client
+from rate_limit import get_rate_limiter, get_host
+from retry_policy import get_retry_stats, RetryError
+from dead_urls import get_dead_url_registry
+from settings import MB_TO_BYTE, CACHED_FILE_DIR, BIG_FILE_SIZE_MB, CZO_DATA_CSV, \
+    CACHE_REVALIDATE_HOURS, PREDOWNLOAD_MAX_WORKERS, PREDOWNLOAD_MAX_PER_HOST
 
 requests.packages.urllib3.disable_warnings()
-N_PROCESS = multiprocessing.cpu_count()
 
 
-def _hash_string(_str):
-
-    hash_object = hashlib.md5(_str.encode())
-    return hash_object.hexdigest()
-
-
-def _download(url, save_to_path):
-
-    # sending headers is very important or in some cases requests.get() wont download the actual file content/binary
-    response = requests.get(url, stream=True, verify=False, headers=headers)
-
-    with open(save_to_path, 'wb') as fd:
-        for chunk in response.iter_content(chunk_size=5*MB_TO_BYTE):
-            fd.write(chunk)
-            if os.path.getsize(save_to_path) > BIG_FILE_SIZE_MB*MB_TO_BYTE:
-                logging.error("Big File Interrupted @ {}".format(url))
-                break
-
-
-    return os.path.getsize(save_to_path)
-
-
-def _save_to_file(url, url_file_dict):
-    if not validators.url(url):
-        return
-    url_hash = _hash_string(url)
-    if url_hash not in url_file_dict:
-
-        fn = "{fname}".format(fname=url_hash)
-        f_path = os.path.join(output_dir, fn)
-
-        logging.info("{}".format(url))
-        size = retry_func(_download, args=[url, f_path])
-        f_dict = {"url_md5": url_hash, "path": f_path, "size": size, "url": url}
-        logging.info("Saved to {f_path}: {size_mb:0.4f} MB".format(f_path=f_path, size_mb=float(size)/MB_TO_BYTE))
-        url_file_dict[url_hash] = f_dict
-
-
-def download_czo(czo_id_queue, url_file_dict, czo_id_done):
-
-        while True:
-            czo_id = czo_id_queue.get()
-
-            if czo_id == -1:
-                break
-            logging.info("Downloading files for czo_id {}".format(czo_id))
-            row_dict = _extract_data_row_as_dict(czo_id)
-            files = row_dict['COMPONENT_FILES-location$topic$url$data_level$private$doi$metadata_url']
-
-            component_files = []
-            for f_str in files.split("|"):
-                f_info_list = f_str.split("$")
-                f_url = f_info_list[2].strip()
-                component_files.append(f_url)
-                f_metadata_url = f_info_list[6].strip()
-                component_files.append(f_metadata_url)
-            maps_uploads = str(row_dict["map_uploads"]).strip()
-            maps_uploads_list = maps_uploads.split('|') if len(maps_uploads) > 0 else []
-            kml_files = str(row_dict["kml_files"]).strip()
-            kml_files_list = kml_files.split('|') if len(kml_files) > 0 else []
-
-            urls = component_files + maps_uploads_list + kml_files_list
-            for url in urls:
-                try:
-                    url = url.strip()
-                    _save_to_file(url, url_file_dict)
-                except Exception as ex:
-                    logging.error(ex)
-
-            czo_id_done.append(czo_id)
-            logging.info("Finished czo_ids: {}/{}".format(len(czo_id_done), len(czo_id_list_subset)-N_PROCESS))
-            czo_id_queue.task_done()
+def _download(url, save_to_path, etag=None, last_modified=None):
+    try:
+        # partially written files left by an earlier run are resumed with Range requests
+        return stream_to_file(url, save_to_path, max_size_byte=BIG_FILE_SIZE_MB*MB_TO_BYTE, verify=False,
+                              resume=True, etag=etag, last_modified=last_modified)
+    except BigFileInterrupted:
+        # big files are migrated as referenced files so no point keeping them
+        logging.error("Big File Interrupted @ {}".format(url))
+        os.remove(save_to_path)
+        return None
+
+
+def _file_dict(url, f_path, size, content_hash):
+    return {"url_md5": hash_string(url), "path": f_path, "size": size, "url": url, "content_hash": content_hash}
+
+
+def _save_to_file(url):
+    """
+    Download a url into the cache unless an earlier run already did
+    :param url: source url
+    :return: file dict for the list_*.csv manifest or None
+    """
+    url_hash = hash_string(url)
+
+    if get_dead_url_registry().is_dead(url):
+        logging.info("Known dead url {}".format(url))
+        return None
+
+    # skip urls completed by earlier runs; revalidate stale ones instead of refetching
+    file_cache = get_file_cache(output_dir)
+    entry = file_cache.get(url)
+    etag, last_modified = None, None
+    if entry is not None:
+        if time.time() - entry["fetched_at"] < CACHE_REVALIDATE_HOURS * 3600:
+            logging.info("Cached {}".format(url))
+            return _file_dict(url, entry["path"], entry["size"], entry["content_hash"])
+        etag, last_modified = entry["etag"], entry["last_modified"]
+
+    partial_path = os.path.join(partial_dir, url_hash)
+
+    logging.info("{}".format(url))
+    try:
+        stream_info = retry_func(_download, args=[url, partial_path],
+                                 kwargs={"etag": etag, "last_modified": last_modified})
+    except RetryError as ex:
+        get_dead_url_registry().record_failure(url, ex)
+        raise
+    if stream_info is None:
+        return None
+    if stream_info["not_modified"]:
+        logging.info("Not modified {}".format(url))
+        file_cache.touch(url)
+        return _file_dict(url, entry["path"], entry["size"], entry["content_hash"])
+    f_path = file_cache.put(url, partial_path, stream_info["md5"], stream_info["size"],
+                            content_type=stream_info["content_type"],
+                            etag=stream_info["etag"],
+                            last_modified=stream_info["last_modified"])
+    size = stream_info["size"]
+    logging.info("Saved to {f_path}: {size_mb:0.4f} MB".format(f_path=f_path, size_mb=float(size)/MB_TO_BYTE))
+    return _file_dict(url, f_path, size, stream_info["md5"])
+
+
+def get_czo_urls(czo_id):
+    """
+    Urls a czo row will download during migration (see pipeline.get_row_download_urls)
+    :param czo_id: czo_id
+    :return: list of valid urls
+    """
+    return get_row_download_urls(czo_dataset.get_files(czo_id))
+
+
+def download_urls(czo_id_list):
+    """
+    Download all urls of czo_id_list with a thread pool; single urls (not whole czo_ids) are scheduled
+    so one row with many files can't leave the other workers idle.
+    At most PREDOWNLOAD_MAX_WORKERS downloads run at once and at most PREDOWNLOAD_MAX_PER_HOST per host.
+    :param czo_id_list: list of czo_id
+    :return: list of file dicts
+    """
+    url_czo_ids = OrderedDict()  # url -> [czo_id]; each url is downloaded once
+    czo_id_pending = Counter()
+    for czo_id in czo_id_list:
+        try:
+            urls = get_czo_urls(czo_id)
+        except Exception as ex:
+            logging.error("Failed to parse urls of czo_id {}: {}".format(czo_id, ex))
+            continue
+        for url in OrderedDict.fromkeys(urls):
+            url_czo_ids.setdefault(url, []).append(czo_id)
+            czo_id_pending[czo_id] += 1
+
+    file_info_list = []
+    czo_id_done = []
+
+    def _on_url_done(host, args, f_dict, ex):
+        url = args[0]
+        if ex is not None:
+            logging.error(ex)
+        elif f_dict is not None:
+            file_info_list.append(f_dict)
+        for czo_id in url_czo_ids[url]:
+            czo_id_pending[czo_id] -= 1
+            if czo_id_pending[czo_id] == 0:
+                czo_id_done.append(czo_id)
+                logging.info("Finished czo_ids: {}/{}".format(len(czo_id_done), len(czo_id_pending)))
+
+    logging.info("Downloading {} urls of {} czo_ids: {} workers; {} per host".format(
+        len(url_czo_ids), len(czo_id_list), PREDOWNLOAD_MAX_WORKERS, PREDOWNLOAD_MAX_PER_HOST))
+    tasks = [(get_host(url), _save_to_file, (url,)) for url in url_czo_ids]
+    run_bounded_per_key(tasks, PREDOWNLOAD_MAX_WORKERS, PREDOWNLOAD_MAX_PER_HOST, _on_url_done)
+    return file_info_list
 
 
 def get_czo_id_list():
-    return czo_df['czo_id'].values
+    return czo_dataset.czo_ids()
 
 
 def create_output_dir():
@@ -105,12 +149,6 @@ def create_output_dir():
     return os.path.dirname(log_dir)
 
 
-def _extract_data_row_as_dict(czo_id):
-    df_row = czo_df.loc[czo_df['czo_id'] == czo_id]
-    czo_row_dict = df_row.to_dict(orient='records')[0]
-    return czo_row_dict
-
-
 if __name__ == "__main__":
 
     start_time = dt.utcnow()
@@ -123,44 +161,36 @@ if __name__ == "__main__":
         base_dir = os.path.abspath(base_dir)
 
     output_dir = create_output_dir()
+    # downloads in progress; moved into the cache once complete
+    partial_dir = os.path.join(output_dir, "partial")
+    if not os.path.exists(partial_dir):
+        os.makedirs(partial_dir)
 
     logging.basicConfig(
         level=logging.INFO,
-        format="%(processName)s %(asctime)s [%(levelname)-5.5s]  %(message)s",
+        format="%(threadName)s %(asctime)s [%(levelname)-5.5s]  %(message)s",
         handlers=[
             logging.FileHandler(os.path.join(output_dir, "./logs/log_{}.log".format(start_time_str))),
             logging.StreamHandler()
         ])
 
+    file_cache = get_file_cache(output_dir)
+    logging.info("Cache has {} urls; {:.2f} MB".format(file_cache.count(), float(file_cache.total_size())/MB_TO_BYTE))
+
     # read in czo.csv
-    czo_df = pd.read_csv(CZO_DATA_CSV)
+    czo_dataset = get_czo_dataset(CZO_DATA_CSV)
     czo_id_list = get_czo_id_list()
-    czo_id_list_subset = czo_id_list[:]
-    czo_id_list_subset = np.append(czo_id_list_subset, [-1] * N_PROCESS)
-
-    with Manager() as manager:
-
-        url_file_dict = manager.dict()
-        czo_id_queue = manager.Queue()
-        _ = list(map(czo_id_queue.put,  czo_id_list_subset))
-        czo_id_done = manager.list()
-
-        processes = []
-
-        for i in range(N_PROCESS):
-            proc = Process(target=download_czo, args=(czo_id_queue, url_file_dict, czo_id_done))
-            processes.append(proc)
-            proc.start()
-
-        for proc in processes:
-            proc.join()
 
-        file_info_list = list(url_file_dict.values())
+    file_info_list = download_urls(czo_id_list)
 
-        df_lookup = pd.DataFrame(file_info_list)
+    df_lookup = pd.DataFrame(file_info_list)
 
-        df_lookup.to_csv(os.path.join(output_dir, "./logs/list_{}.csv".format(start_time_str)), index=False)
-        logging.info("Total number {}; Total size (MB): {}".format(df_lookup["size"].count(),
-                                                                   df_lookup["size"].sum()/MB_TO_BYTE))
+    df_lookup.to_csv(os.path.join(output_dir, "./logs/list_{}.csv".format(start_time_str)), index=False)
+    logging.info("Total number {}; Total size (MB): {}".format(df_lookup["size"].count(),
+                                                               df_lookup["size"].sum()/MB_TO_BYTE))
 
+    get_rate_limiter().log_stats()
+    get_http_client().log_stats()
+    get_retry_stats().log_stats()
+    get_dead_url_registry().log_stats()
     logging.info("Done in {}".format(dt.utcnow() - start_time))
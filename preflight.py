@@ -0,0 +1,136 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+from czo_data import explode_packed
+from utils_logging import text_emphasis
+
+# fields create_hs_res_from_czo_row can't do without (_extract_value_from_df_row_dict(..., required=True))
+REQUIRED_COLUMNS = ["CZOS", "title", "description", "location", "date_start",
+                    "east_long", "west_long", "south_lat", "north_lat", "TOPICS"]
+# packed fields and the number of "$"-separated terms of each "|"-separated item
+ARITY_COLUMNS = [("AWARD_GRANT_NUMBERS-grant_number$funding_agency$url_for_grant", 3),
+                 ("EXTERNAL_LINKS-url$link_text", 2)]
+BLANK_VALUES = ["", "nan", "na", "n/a", r"n\a", "none"]
+
+PREFLIGHT_REPORT_COLUMNS = ["czo_id", "severity", "check", "column", "message"]
+
+
+def _blank(series):
+    # same notion of "missing" as api_helpers._extract_value_from_df_row_dict
+    return series.astype(str).str.strip().str.lower().isin(BLANK_VALUES)
+
+
+def _issues(czo_ids, mask, severity, check, column, message):
+    czo_ids = czo_ids[mask.values]
+    return pd.DataFrame({"czo_id": czo_ids,
+                         "severity": severity,
+                         "check": check,
+                         "column": column,
+                         "message": [message] * len(czo_ids)},
+                        columns=PREFLIGHT_REPORT_COLUMNS)
+
+
+def check_rows(czo_df, known_czo_ids):
+    """
+    Vectorized validation of CZO rows; checks each column over all rows at once
+    errors (row can't be migrated): missing required field, non-numeric or out of range bbox, unparsable date,
+                                    wrong number of "$" terms in grants/external links
+    warnings (reported only): misordered bbox (migrated as is, HS may reject its spatial coverage),
+                              RELATED_DATASETS ids that are not in the dataset
+    :param czo_df: DataFrame of the rows to check
+    :param known_czo_ids: all czo_ids of the dataset
+    :return: report DataFrame (PREFLIGHT_REPORT_COLUMNS), one row per issue
+    """
+    czo_ids = czo_df["czo_id"].values
+    issues = []
+
+    for column in REQUIRED_COLUMNS:
+        if column not in czo_df.columns:
+            issues.append(_issues(czo_ids, pd.Series(True, index=czo_df.index), "error", "required", column,
+                                  "column missing in csv"))
+            continue
+        issues.append(_issues(czo_ids, _blank(czo_df[column]), "error", "required", column, "missing value"))
+
+    # bounding box
+    bbox = {}
+    for column in ["east_long", "west_long", "south_lat", "north_lat"]:
+        bbox[column] = pd.to_numeric(czo_df.get(column, pd.Series(np.nan, index=czo_df.index)), errors='coerce')
+        present = ~_blank(czo_df[column]) if column in czo_df.columns else pd.Series(False, index=czo_df.index)
+        issues.append(_issues(czo_ids, present & bbox[column].isnull(), "error", "bbox", column, "not a number"))
+    for column, limit in [("east_long", 180), ("west_long", 180), ("south_lat", 90), ("north_lat", 90)]:
+        issues.append(_issues(czo_ids, bbox[column].abs() > limit, "error", "bbox", column,
+                              "out of range [-{0}, {0}]".format(limit)))
+    # some exports have these swapped; migration doesn't stop on them
+    issues.append(_issues(czo_ids, bbox["south_lat"] > bbox["north_lat"], "warning", "bbox", "south_lat",
+                          "south_lat > north_lat"))
+    issues.append(_issues(czo_ids, bbox["west_long"] > bbox["east_long"], "warning", "bbox", "west_long",
+                          "west_long > east_long"))
+
+    # dates
+    dates = {}
+    for column in ["date_start", "date_end"]:
+        if column not in czo_df.columns:
+            continue
+        present = ~_blank(czo_df[column])
+        dates[column] = pd.to_datetime(czo_df[column].where(present), errors='coerce')
+        issues.append(_issues(czo_ids, present & dates[column].isnull(), "error", "date", column,
+                              "not a date"))
+    if len(dates) == 2:
+        issues.append(_issues(czo_ids, dates["date_start"] > dates["date_end"], "error", "date", "date_end",
+                              "date_end before date_start"))
+
+    # "$" arity of packed fields
+    row_pos = np.arange(czo_df.shape[0])
+    for column, arity in ARITY_COLUMNS:
+        if column not in czo_df.columns:
+            continue
+        items = explode_packed(row_pos, czo_df[column])
+        bad_rows = np.unique(items["_row"].values[(items["item"].str.count(r"\$") != arity - 1).values])
+        issues.append(_issues(czo_ids, pd.Series(np.isin(row_pos, bad_rows)), "error", "arity", column,
+                              "expected {} '$'-separated terms per item".format(arity)))
+
+    # related datasets
+    if "RELATED_DATASETS" in czo_df.columns:
+        items = explode_packed(row_pos, czo_df["RELATED_DATASETS"])
+        related_ids = pd.to_numeric(items["item"], errors='coerce')
+        unresolved = related_ids.isnull() | ~related_ids.isin(list(known_czo_ids))
+        bad_rows = np.unique(items["_row"].values[unresolved.values])
+        issues.append(_issues(czo_ids, pd.Series(np.isin(row_pos, bad_rows)), "warning", "related",
+                              "RELATED_DATASETS", "czo_id not in dataset"))
+
+    return pd.concat(issues, ignore_index=True).sort_values(["czo_id", "severity"]).reset_index(drop=True)
+
+
+def run_preflight(czo_dataset, czo_id_list, report_path):
+    """
+    Validate the rows of czo_id_list before migration and write the report as csv
+    :param czo_dataset: CZODataset
+    :param czo_id_list: czo_ids selected for migration
+    :param report_path: path to report csv
+    :return: czo_id_list without rows that have errors
+    """
+    logging.info(text_emphasis("Preflight Check"))
+    known_czo_ids = czo_dataset.czo_ids()
+    unknown = [czo_id for czo_id in czo_id_list if czo_id not in czo_dataset]
+    czo_df = czo_dataset.data[czo_dataset.data["czo_id"].isin(czo_id_list)]
+
+    report = check_rows(czo_df, known_czo_ids)
+    if len(unknown) > 0:
+        report = pd.concat([report, pd.DataFrame({"czo_id": unknown,
+                                                  "severity": "error",
+                                                  "check": "czo_id",
+                                                  "column": "czo_id",
+                                                  "message": ["czo_id not in dataset"] * len(unknown)},
+                                                 columns=PREFLIGHT_REPORT_COLUMNS)], ignore_index=True)
+    report.to_csv(report_path, index=False)
+
+    failed = set(report.loc[report["severity"] == "error", "czo_id"].tolist())
+    for czo_id in sorted(failed):
+        messages = report.loc[(report["czo_id"] == czo_id) & (report["severity"] == "error")]
+        logging.error("Skipping czo_id {}: {}".format(czo_id, "; ".join(
+            "{} {}".format(c, m) for c, m in zip(messages["column"], messages["message"]))))
+    logging.info("Preflight: {} rows checked; {} skipped with errors {}; {} warnings; report {}".format(
+        len(czo_id_list), len(failed), sorted(failed), int((report["severity"] == "warning").sum()), report_path))
+    return [czo_id for czo_id in czo_id_list if czo_id not in failed]
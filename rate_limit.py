@@ -0,0 +1,206 @@
+import logging
+import threading
+import time
+from email.utils import parsedate_tz, mktime_tz
+from urllib.parse import urlparse
+
+from settings import HOST_MAX_REQUESTS_PER_SEC, HOST_MIN_REQUESTS_PER_SEC, HOST_BURST, MB_TO_BYTE, \
+    SEGMENTED_DOWNLOAD, SEGMENTS_MAX
+from utils_logging import text_emphasis
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+
+def get_host(url):
+    return urlparse(url).netloc.lower()
+
+
+def parse_retry_after(value):
+    """
+    Retry-After header is either seconds or a HTTP date
+    :param value: header value
+    :return: seconds to wait or None
+    """
+    if value is None:
+        return None
+    value = str(value).strip()
+    if value.isdigit():
+        return float(value)
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0.0, mktime_tz(parsed) - time.time())
+
+
+class _HostState(object):
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.tokens = float(burst)
+        self.last_refill = time.time()
+        self.blocked_until = 0.0
+        self.requests = 0
+        self.throttled = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        # segmented downloads (see file_ops.stream_to_file): byte ranges per download, 0 if the host ignores Range;
+        # the count is doubled or halved (segment_step) after each download of the host and turned around
+        # when throughput drops
+        self.segments = None
+        self.segment_step = 1
+        self.segment_mb_per_sec = 0.0
+
+
+class HostRateLimiter(object):
+    """
+    Token bucket per host shared by all requests to CZO origin servers
+    The rate of a host is halved on 429/5xx responses (which also pause the host for Retry-After seconds if given)
+    and grows back slowly on successes, up to max_rate (AIMD). Bytes and transfer time are recorded per host.
+    The number of parallel byte ranges of segmented downloads is tuned per host by throughput (report_segmented).
+    """
+
+    def __init__(self, max_rate, min_rate, burst, max_segments=1):
+        self.max_rate = float(max_rate)
+        self.min_rate = float(min_rate)
+        self.burst = burst
+        self.max_segments = max(1, int(max_segments))
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _get_state(self, host):
+        if host not in self._hosts:
+            self._hosts[host] = _HostState(self.max_rate, self.burst)
+            self._hosts[host].segments = min(4, self.max_segments)
+        return self._hosts[host]
+
+    def acquire(self, url):
+        """
+        Block until a request to the host of url is allowed
+        :param url: url about to be requested
+        :return: None
+        """
+        host = get_host(url)
+        while True:
+            with self._lock:
+                st = self._get_state(host)
+                now = time.time()
+                if st.blocked_until > now:
+                    wait_sec = st.blocked_until - now
+                else:
+                    st.tokens = min(float(self.burst), st.tokens + (now - st.last_refill) * st.rate)
+                    st.last_refill = now
+                    if st.tokens >= 1:
+                        st.tokens -= 1
+                        st.requests += 1
+                        return
+                    wait_sec = (1 - st.tokens) / st.rate
+            time.sleep(wait_sec)
+
+    def report(self, url, status_code=None, retry_after=None, nbytes=0, seconds=0.0):
+        """
+        Feed back the outcome of a request
+        :param url: requested url
+        :param status_code: HTTP status code; None if the request failed without a response
+        :param retry_after: Retry-After response header
+        :param nbytes: bytes transferred
+        :param seconds: transfer time
+        :return: None
+        """
+        host = get_host(url)
+        with self._lock:
+            st = self._get_state(host)
+            st.bytes += nbytes
+            st.seconds += seconds
+            if status_code is not None and (status_code == 429 or status_code >= 500):
+                st.throttled += 1
+                st.rate = max(self.min_rate, st.rate / 2)
+                pause_sec = parse_retry_after(retry_after)
+                if pause_sec is None:
+                    pause_sec = 1.0 / st.rate
+                st.blocked_until = max(st.blocked_until, time.time() + pause_sec)
+                st.tokens = 0.0
+                if st.segments > 1:
+                    st.segments //= 2
+                logging.warning("Backing off {} ({}): {:.2f} req/s; paused {:.0f} sec".format(
+                    host, status_code, st.rate, pause_sec))
+            elif status_code is not None and status_code < 400:
+                st.rate = min(self.max_rate, st.rate + self.min_rate)
+
+    def get_segments(self, url):
+        """
+        :param url: url about to be downloaded
+        :return: number of byte ranges to download it in; 0 if the host doesn't serve ranges
+        """
+        with self._lock:
+            return self._get_state(get_host(url)).segments
+
+    def report_segmented(self, url, segments, nbytes, seconds):
+        """
+        Feed back the throughput of a download of a file the host could serve in ranges (single streams included)
+        and pick the segment count of the next one: keep doubling (or halving) while throughput holds up,
+        turn around once it drops by more than 10%
+        :param url: downloaded url
+        :param segments: byte ranges the file was downloaded in
+        :param nbytes: file size
+        :param seconds: download time
+        :return: None
+        """
+        if seconds <= 0:
+            return
+        mb_per_sec = float(nbytes) / MB_TO_BYTE / seconds
+        with self._lock:
+            st = self._get_state(get_host(url))
+            if st.segments == 0:
+                return
+            if st.segment_mb_per_sec > 0 and mb_per_sec < 0.9 * st.segment_mb_per_sec:
+                st.segment_step = -st.segment_step
+            if segments <= 1:
+                # nowhere to go but up
+                st.segment_step = 1
+            st.segment_mb_per_sec = mb_per_sec
+            segments = segments * 2 if st.segment_step > 0 else segments // 2
+            st.segments = min(self.max_segments, max(1, segments))
+
+    def disable_segments(self, url):
+        """
+        Download from the host of url in a single stream from now on (it answered a Range request with the whole file)
+        :param url: url
+        :return: None
+        """
+        host = get_host(url)
+        with self._lock:
+            self._get_state(host).segments = 0
+        logging.warning("{} ignores Range requests; no segmented downloads".format(host))
+
+    def get_stats(self):
+        """
+        :return: list of per-host dicts
+        """
+        with self._lock:
+            return [{"host": host,
+                     "requests": st.requests,
+                     "throttled": st.throttled,
+                     "size_mb": float(st.bytes) / MB_TO_BYTE,
+                     "mb_per_sec": float(st.bytes) / MB_TO_BYTE / st.seconds if st.seconds > 0 else 0.0,
+                     "rate": st.rate,
+                     "segments": st.segments,
+                     } for host, st in sorted(self._hosts.items())]
+
+    def log_stats(self):
+        stats = self.get_stats()
+        if len(stats) == 0:
+            return
+        logging.info(text_emphasis("Summary on Source Hosts"))
+        for s in stats:
+            logging.info("{host}: {requests} requests; {throttled} throttled; {size_mb:.2f} MB "
+                         "@ {mb_per_sec:.2f} MB/s; rate {rate:.2f} req/s; {segments} segments".format(**s))
+
+
+def get_rate_limiter():
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = HostRateLimiter(HOST_MAX_REQUESTS_PER_SEC, HOST_MIN_REQUESTS_PER_SEC, HOST_BURST,
+                                            max_segments=SEGMENTS_MAX if SEGMENTED_DOWNLOAD else 1)
+        return _rate_limiter
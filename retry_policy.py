@@ -0,0 +1,239 @@
+import logging
+import random
+import socket
+import threading
+import time
+from collections import defaultdict
+
+import requests
+from hs_restclient import HydroShareHTTPException, HydroShareNotAuthorized, HydroShareNotFound, \
+    HydroShareArgumentException
+
+from settings import RETRY_MAX_DELAY_SEC, CIRCUIT_BREAKER_THRESHOLD, CIRCUIT_BREAKER_COOLDOWN_SEC
+from utils_logging import text_emphasis
+
+# HTTP status codes worth retrying; any other 4xx won't change by waiting
+RETRYABLE_STATUS_CODES = (408, 425, 429)
+
+_circuit_breaker = None
+_retry_stats = None
+_singleton_lock = threading.Lock()
+
+# host name doesn't exist (NXDOMAIN); terminal
+_DNS_FAILURE_MARKERS = ("Name or service not known", "nodename nor servname", "No address associated",
+                        "[Errno 11001] getaddrinfo failed")
+# resolver couldn't answer right now (EAI_AGAIN); retryable
+_DNS_TRANSIENT_MARKERS = ("Temporary failure in name resolution", "[Errno 11002] getaddrinfo failed")
+_DNS_TRANSIENT_ERRNOS = tuple(errno for errno in (getattr(socket, "EAI_AGAIN", None), 11002) if errno is not None)
+
+
+class RetryError(Exception):
+    """
+    Raised by util.retry_func when it gives up; last_exception is the error of the final attempt
+    """
+
+    def __init__(self, msg, last_exception=None, retryable=True):
+        super(RetryError, self).__init__(msg)
+        self.last_exception = last_exception
+        self.retryable = retryable
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised without calling out when a host has failed too often recently
+    """
+    pass
+
+
+class DeadUrlError(Exception):
+    """
+    Raised without calling out when a url is in the dead-url registry (see dead_urls.py)
+    """
+    pass
+
+
+def is_dns_failure(ex):
+    """
+    Host name that doesn't resolve (NXDOMAIN); a resolver that failed to answer (EAI_AGAIN) is not one
+    :param ex: exception
+    :return: bool
+    """
+    chain = []
+    while ex is not None and ex not in chain:
+        chain.append(ex)
+        ex = ex.__cause__ or ex.__context__
+    for ex in chain:
+        if isinstance(ex, socket.gaierror) and ex.errno in _DNS_TRANSIENT_ERRNOS:
+            return False
+        if any(marker in str(ex) for marker in _DNS_TRANSIENT_MARKERS):
+            return False
+    for ex in chain:
+        if isinstance(ex, socket.gaierror):
+            return True
+        if any(marker in str(ex) for marker in _DNS_FAILURE_MARKERS):
+            return True
+    return False
+
+
+def _is_retryable_status(status_code):
+    return status_code in RETRYABLE_STATUS_CODES or status_code >= 500
+
+
+def is_retryable(ex):
+    """
+    Classify an error as retryable (network hiccup, throttling, server error) or terminal
+    (404 and other client errors, DNS failure, bad arguments, open circuit, known dead url)
+    :param ex: exception
+    :return: bool
+    """
+    if isinstance(ex, (CircuitOpenError, DeadUrlError,
+                       HydroShareNotAuthorized, HydroShareNotFound, HydroShareArgumentException)):
+        return False
+    if isinstance(ex, RetryError):
+        return ex.retryable
+    if isinstance(ex, HydroShareHTTPException):
+        return _is_retryable_status(getattr(ex, "status_code", 500))
+    if isinstance(ex, requests.exceptions.HTTPError):
+        if ex.response is None:
+            return True
+        return _is_retryable_status(ex.response.status_code)
+    if isinstance(ex, (requests.exceptions.InvalidURL, requests.exceptions.MissingSchema,
+                       requests.exceptions.InvalidSchema, requests.exceptions.URLRequired)):
+        return False
+    if isinstance(ex, requests.exceptions.ConnectionError):
+        return not is_dns_failure(ex)
+    if isinstance(ex, (ValueError, TypeError, KeyError, AttributeError, AssertionError)):
+        return False
+    return True
+
+
+def is_host_failure(ex):
+    """
+    Errors that say the host itself is in trouble (as opposed to a single bad url)
+    """
+    if isinstance(ex, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if isinstance(ex, requests.exceptions.HTTPError) and ex.response is not None:
+        return ex.response.status_code >= 500
+    return False
+
+
+def backoff_delay(attempt, interval_sec, increase_interval=True, max_delay_sec=RETRY_MAX_DELAY_SEC):
+    """
+    Exponential backoff with jitter: a random delay between half and all of interval_sec * 2^attempt
+    :param attempt: 0-based number of the failed attempt
+    :param interval_sec: base interval
+    :param increase_interval: False for a constant (jittered) interval
+    :param max_delay_sec: cap
+    :return: seconds
+    """
+    delay = interval_sec * (2 ** attempt) if increase_interval else interval_sec
+    delay = min(delay, max_delay_sec)
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+
+class CircuitBreaker(object):
+    """
+    Per-host circuit breaker: after `threshold` consecutive host failures the host is considered down and calls
+    fail fast for `cooldown_sec`; then a single trial call is let through (half-open) to probe it again while
+    other calls keep failing fast until the probe succeeds (closed) or fails (open for another cooldown)
+    """
+
+    def __init__(self, threshold, cooldown_sec):
+        self.threshold = threshold
+        self.cooldown_sec = cooldown_sec
+        self._failures = defaultdict(int)
+        self._open_until = {}
+        self._probing = {}  # host -> thread making the half-open probe
+        self._lock = threading.Lock()
+
+    def check(self, host):
+        if host is None:
+            return
+        with self._lock:
+            open_until = self._open_until.get(host)
+            if open_until is None:
+                return
+            if time.time() < open_until:
+                raise CircuitOpenError("Host {} is down; failing fast for {:.0f} more sec".format(
+                    host, open_until - time.time()))
+            if host in self._probing:
+                raise CircuitOpenError("Host {} is down; waiting for a probe".format(host))
+            # half-open: let this call probe the host
+            self._probing[host] = threading.get_ident()
+
+    def _close(self, host):
+        self._failures.pop(host, None)
+        self._open_until.pop(host, None)
+        self._probing.pop(host, None)
+
+    def record_success(self, host):
+        if host is None:
+            return
+        with self._lock:
+            self._close(host)
+
+    def record_failure(self, host, ex):
+        if host is None or isinstance(ex, CircuitOpenError):
+            return
+        with self._lock:
+            probe = self._probing.get(host) == threading.get_ident()
+            if probe:
+                del self._probing[host]
+            if not is_host_failure(ex):
+                if probe:
+                    # the host answered (eg. 404), so it is up
+                    self._close(host)
+                return
+            self._failures[host] += 1
+            if probe or self._failures[host] >= self.threshold:
+                self._open_until[host] = time.time() + self.cooldown_sec
+                logging.error("Circuit open for host {} after {} consecutive failures".format(
+                    host, self._failures[host]))
+
+
+class RetryStats(object):
+    """
+    Calls, attempts, failures and time slept per call site (function name)
+    """
+
+    def __init__(self):
+        self._stats = defaultdict(lambda: {"calls": 0, "attempts": 0, "failed": 0, "slept_sec": 0.0})
+        self._lock = threading.Lock()
+
+    def record(self, call_site, attempts, failed, slept_sec):
+        with self._lock:
+            s = self._stats[call_site]
+            s["calls"] += 1
+            s["attempts"] += attempts
+            s["failed"] += 1 if failed else 0
+            s["slept_sec"] += slept_sec
+
+    def get_stats(self):
+        with self._lock:
+            return dict((k, dict(v)) for k, v in self._stats.items())
+
+    def log_stats(self):
+        stats = self.get_stats()
+        if len(stats) == 0:
+            return
+        logging.info(text_emphasis("Summary on Retries"))
+        for call_site in sorted(stats):
+            logging.info("{}: {calls} calls; {attempts} attempts; {failed} gave up; slept {slept_sec:.0f} sec".format(
+                call_site, **stats[call_site]))
+
+
+def get_circuit_breaker():
+    global _circuit_breaker
+    with _singleton_lock:
+        if _circuit_breaker is None:
+            _circuit_breaker = CircuitBreaker(CIRCUIT_BREAKER_THRESHOLD, CIRCUIT_BREAKER_COOLDOWN_SEC)
+        return _circuit_breaker
+
+
+def get_retry_stats():
+    global _retry_stats
+    with _singleton_lock:
+        if _retry_stats is None:
+            _retry_stats = RetryStats()
+        return _retry_stats
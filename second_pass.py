@@ -6,10 +6,13 @@ from collections import OrderedDict
 import pandas as pd
 
 from util import gen_readme
+from staging import row_workspace
 from settings import CZO_ACCOUNTS, CZO_DATA_CSV, README_COLUMN_MAP_PATH, \
-     README_SHOW_MAPS, HS_EXTERNAL_FULL_DOMAIN, SECOND_PASS_FILE
-from api_helpers import _extract_value_from_df_row_dict, string_to_list
+     README_SHOW_MAPS, HS_EXTERNAL_FULL_DOMAIN, SECOND_PASS_FILE, README_FILENAME
+from api_helpers import _extract_value_from_df_row_dict, string_to_list, get_resource_file_names
 from accounts import CZOHSAccount
+from czo_data import get_czo_dataset
+from hs_index import get_hs_resource_index
 
 
 def query_lookup_table(czo_id, lookup_data_df, attr="hs_id"):
@@ -20,6 +23,20 @@ def query_lookup_table(czo_id, lookup_data_df, attr="hs_id"):
         return v
 
 
+def query_hs_id(czo_id, lookup_data_df, hs_index=None):
+    """
+    hs_id of czo_id from the lookup table of this run, or from the HS resource index
+    for rows migrated by earlier runs
+    """
+    if hs_index is None:
+        return query_lookup_table(czo_id, lookup_data_df)
+    if czo_id in lookup_data_df.index:
+        hs_id = query_lookup_table(czo_id, lookup_data_df)
+        if hs_id is not None:
+            return hs_id
+    return hs_index.get_hs_id(czo_id)
+
+
 def get_resource_file_url(hs_id, filename):
 
     landing = get_resource_landing_page_url(hs_id)
@@ -42,13 +59,13 @@ def build_maps_md(map_filename, hs_id):
     return md
 
 
-def build_related_dataset_md(res_id, czo_id, czo_data_df=None):
+def build_related_dataset_md(res_id, czo_id, czo_dataset=None):
 
     res_url = get_resource_landing_page_url(res_id)
     res_title = None
-    if czo_data_df is not None:
+    if czo_dataset is not None:
         try:
-            res_title = get_dict_by_czo_id(czo_id, czo_data_df)["title"]
+            res_title = czo_dataset[czo_id]["title"]
         except:
             pass
     md = "[{res_title}]({url} '{tooltip}')".format(res_title=res_title if res_title is not None else res_id,
@@ -57,18 +74,31 @@ def build_related_dataset_md(res_id, czo_id, czo_data_df=None):
     return md
 
 
-def get_dict_by_czo_id(czo_id, czo_data_df):
+def replace_readme(hs, hs_id, readme_path):
+    """
+    Upload ReadMe.md, replacing the one a resource resumed or updated in place may have already
+    :param hs: hs obj
+    :param hs_id: resource id
+    :param readme_path: path to ReadMe.md
+    :return: None
+    """
+    if README_FILENAME in get_resource_file_names(hs, hs_id):
+        hs.deleteResourceFile(hs_id, README_FILENAME)
+        logging.info("Deleted old ReadMe file of {}".format(hs_id))
+    hs.addResourceFile(hs_id, readme_path)
+
+
+def get_dict_by_czo_id(czo_id, czo_dataset):
 
-    czo_row_dict = czo_data_df.loc[czo_data_df['czo_id'] == czo_id].to_dict(orient='records')[0]
-    return czo_row_dict
+    return czo_dataset.get_dict(czo_id)
 
 
-def second_pass(czo_csv_path, lookup_csv_path, czo_accounts):
+def second_pass(czo_csv_path, lookup_csv_path, czo_accounts, hs_index=None):
 
     logging.info("\n\nSecond Pass Started")
 
     # read czo csv
-    czo_data_df = pd.read_csv(czo_csv_path)
+    czo_dataset = get_czo_dataset(czo_csv_path)
     # read lookup table and set czo_id as index
     lookup_data_df = pd.read_csv(lookup_csv_path, index_col=1)
 
@@ -90,8 +120,12 @@ def second_pass(czo_csv_path, lookup_csv_path, czo_accounts):
         if None not in (hs_id, hs_owner):
 
             logging.info("Updating {0} - {1} by account {2}".format(hs_id, czo_id, hs_owner))
-            hs = czo_accounts.get_hs_by_uname(hs_owner)
-            czo_row_dict = get_dict_by_czo_id(czo_id, czo_data_df)
+            try:
+                hs = czo_accounts.get_hs_by_uname(hs_owner)
+                czo_row_dict = get_dict_by_czo_id(czo_id, czo_dataset)
+            except Exception as ex:
+                logging.error("Skipped {0} - {1}: {2}".format(hs_id, czo_id, str(ex)))
+                continue
 
             related_datasets_md = []
             try:  # update czo_id
@@ -100,11 +134,12 @@ def second_pass(czo_csv_path, lookup_csv_path, czo_accounts):
                     related_datasets_list = string_to_list(related_datasets)
                     print("Related datasets {}".format(related_datasets_list))
                     czo_id_list = list(map(lambda x: int(str.strip(x)), related_datasets_list))
-                    hs_id_list = list(map(functools.partial(query_lookup_table, lookup_data_df=lookup_data_df),
+                    hs_id_list = list(map(functools.partial(query_hs_id, lookup_data_df=lookup_data_df,
+                                                            hs_index=hs_index),
                                           czo_id_list))
 
                     related_datasets_md = list(map(functools.partial(build_related_dataset_md,
-                                                                     czo_data_df=czo_data_df), hs_id_list,
+                                                                     czo_dataset=czo_dataset), hs_id_list,
                                                    czo_id_list))
 
                     # update czo_row_dict for readme.md
@@ -136,14 +171,14 @@ def second_pass(czo_csv_path, lookup_csv_path, czo_accounts):
             # generate readme.md file
             if readme_column_map is not None:
 
-                readme_path = gen_readme(czo_row_dict, related_datasets_md)
-
-                try:
-                    file_add_respone = hs.addResourceFile(hs_id, readme_path)
-                    logging.info("Creating ReadMe file {}".format(readme_path))
-                    readme_counter += 1
-                except IndexError as index_err:
-                    logging.error('Resource exists hs: {} czo: {} - {}'.format(hs_id, czo_id, index_err))
+                with row_workspace("readme-{}".format(czo_id)) as workspace:
+                    try:
+                        readme_path = gen_readme(czo_row_dict, related_datasets_md, workspace.new_dir())
+                        replace_readme(hs, hs_id, readme_path)
+                        logging.info("Creating ReadMe file {}".format(readme_path))
+                        readme_counter += 1
+                    except Exception as ex:
+                        logging.error("Failed to create ReadMe file hs: {} czo: {} - {}".format(hs_id, czo_id, ex))
 
             if not public:
                 try:
@@ -166,4 +201,5 @@ if __name__ == "__main__":
     czo_accounts = CZOHSAccount(CZO_ACCOUNTS)
     second_pass(CZO_DATA_CSV,
                 lookup_path,
-                czo_accounts)
+                czo_accounts,
+                hs_index=get_hs_resource_index())
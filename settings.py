@@ -1,5 +1,4 @@
 import logging
-import os
 
 logger = logging.getLogger(__name__)
 
@@ -7,6 +6,8 @@ logger = logging.getLogger(__name__)
 # CZO_DATA_CSV = "./data/IMLCZODatasetsMetadata2020-02-07.csv"
 
 CZO_DATA_CSV = "./data/IMLCZODatasetsMetadata2020-02-07.csv"
+# Columnar snapshots of the parsed CZO_DATA_CSV for fast startup (needs pyarrow; None to always parse the csv)
+SNAPSHOT_DIR = "./snapshots"
 
 # a list of czo_ids to migrate.
 # If empty or None, list to be generated automatically by START_ROW_INDEX and END_ROW_INDEX below
@@ -49,6 +50,49 @@ CZO_ACCOUNTS = [
     {"czo":  "default", "group": "", "uname": "czo", "pwd": "czone123"},
 ]
 
+# Concurrent migration: rows run in a thread pool and finish in whatever order they complete
+CONCURRENT_MIGRATION = False
+MAX_WORKERS = 8  # max rows in flight in total (at least 1)
+MAX_WORKERS_PER_ACCOUNT = 2  # max rows in flight per HydroShare account (at least 1)
+
+# Prefetch pipeline: download source files of upcoming rows while the current row uploads to HydroShare
+PIPELINE_PREFETCH = False
+PREFETCH_WORKERS = 4
+PREFETCH_MAX_STAGED_MB = 2048  # back-pressure: prefetching pauses while this many MB are staged
+
+# Politeness toward CZO origin servers: token bucket per host shared by all source-file requests
+# a host's rate is halved on 429/5xx (honoring Retry-After) and recovers slowly up to the max
+HOST_MAX_REQUESTS_PER_SEC = 5.0
+HOST_MIN_REQUESTS_PER_SEC = 0.2
+HOST_BURST = 5
+
+# Segmented download: files of SEGMENTED_MIN_MB or more from servers that accept Range requests are fetched as up to
+# SEGMENTS_MAX byte ranges in parallel; the number of ranges per host follows the throughput measured for it
+SEGMENTED_DOWNLOAD = False
+SEGMENTED_MIN_MB = 32
+SEGMENTS_MAX = 8
+
+# Pooled HTTP client for source files: keep-alive pools per host and connect/read timeouts (sec)
+HTTP_POOL_HOSTS = 64
+HTTP_POOL_MAXSIZE = 16  # connections kept per host
+HTTP_CONNECT_TIMEOUT_SEC = 10
+HTTP_READ_TIMEOUT_SEC = 60
+
+# util.retry_func: exponential backoff with jitter, capped per sleep and by a time budget per call
+RETRY_MAX_DELAY_SEC = 60
+RETRY_TIME_BUDGET_SEC = 300
+# per-host circuit breaker: fail fast for a while after this many consecutive connection errors/5xx
+CIRCUIT_BREAKER_THRESHOLD = 5
+CIRCUIT_BREAKER_COOLDOWN_SEC = 300
+
+# Dead-url registry: source urls that failed terminally (404, 410, malformed url) are not requested again
+# for this many hours and go straight to the NOT_RESOLVING_URL fallback
+DEAD_URL_REGISTRY = "./dead_urls.sqlite3"
+DEAD_URL_TTL_HOURS = 24 * 30
+# files listing verified dead urls (one per line) to seed the registry with; they expire like the others
+# (notfound.txt is not one: it lists files missing from a local tmp2, incl. valid DOIs and HS urls)
+DEAD_URL_SEED_FILES = []
+
 # file size above this limit to be migrated as reference types
 BIG_FILE_SIZE_MB = 500
 
@@ -61,15 +105,19 @@ headers = {
 USE_CACHED_FILES = True
 # Path to predownloaded files
 CACHED_FILE_DIR = "./tmp"
-
-if not os.path.exists("./tmp2"):
-    os.mkdir("./tmp2")
-
-if not os.path.exists("./tmp2/readme"):  # this is hardcoded in util.py
-    os.mkdir("./tmp2/readme")
-
-# More tmp
+# predownload.py concurrency; downloads are network-bound so these don't depend on cpu count
+PREDOWNLOAD_MAX_WORKERS = 16
+PREDOWNLOAD_MAX_PER_HOST = 4
+# Disk budget of predownloaded files; least recently used ones are evicted beyond it (0: unlimited)
+CACHE_MAX_SIZE_MB = 0
+# predownload revalidates cached files older than this with conditional requests (If-None-Match/If-Modified-Since)
+CACHE_REVALIDATE_HOURS = 24 * 7
+
+# More tmp: staging area of downloaded files (see staging.py); created on first use, swept at start
 MORE_TMP = "./tmp2"
+# quota of bytes staged by all rows; downloads wait while it is full (prefetched files count against
+# PREFETCH_MAX_STAGED_MB instead)
+STAGING_MAX_MB = 4096
 
 # Unit conversion
 MB_TO_BYTE = 1024 * 1024
@@ -79,8 +127,57 @@ README_FILENAME = "ReadMe.md"
 README_COLUMN_MAP_PATH = './data/markdown_map.json'
 README_SHOW_MAPS = True
 
+# Send all core metadata sections of a resource in one updateScienceMetadata call; only if that fails are the
+# sections bisected to isolate the bad one (HS doesn't say which part of a request is wrong); resources end up
+# with the same metadata as with one call per section (False)
+METADATA_BATCH_UPDATE = True
+
+# Set file types (SingleFile) and file metadata of a resource after all its files are uploaded,
+# FILE_OPS_WORKERS at a time, instead of right after each upload (HS has no bulk endpoint for these);
+# resources end up the same as with False, failures are reported in the summary instead of failing the file
+FILE_OPS_BATCH = True
+FILE_OPS_WORKERS = 4
+
+# Upload concrete files of up to BUNDLE_MAX_FILE_MB as one zip (of up to BUNDLE_MAX_FILES files / BUNDLE_MAX_MB)
+# and unzip it on HS, keeping the file names; falls back to one upload per file if that fails
+FILE_BUNDLE = False
+BUNDLE_MAX_FILE_MB = 1
+BUNDLE_MAX_FILES = 100
+BUNDLE_MAX_MB = 100
+
+# Pipe the source response of a concrete file straight into its HS upload instead of saving it to MORE_TMP first
+# (only for responses with a Content-Length and no Content-Encoding, not cached and not prefetched);
+# if the upload fails the file is downloaded to MORE_TMP and uploaded from there
+STREAM_UPLOADS = False
+
 # Switch to activate 2nd pass (keep True)
 RUN_2ND_PASS = True
+# lookup csv of an earlier run that second_pass.py / fix_second_pass.py work on when run by themselves
+SECOND_PASS_FILE = None
+
+# Validate all selected rows before any HydroShare writes; rows with errors are skipped
+# and reported in LOG_DIR/preflight_*.csv (off: every selected row is attempted)
+PREFLIGHT_CHECK = False
+
+# "direct": plan and apply each row in one go
+# "plan": only write migration plans to LOG_DIR/plan_*.jsonl (metadata payloads, file names and types; files are
+#         not downloaded); nothing is written to HydroShare
+# "apply": create resources from the plans in PLAN_FILE
+# "delta": compare CZO_DATA_CSV with the export migrated before (DELTA_BASE_CSV); migrate new rows and update
+#          only changed metadata and files of existing resources (needs HS_RESOURCE_INDEX)
+MIGRATION_MODE = "direct"
+PLAN_FILE = None
+DELTA_BASE_CSV = None
+
+# append-only journal of completed steps; a rerun skips rows migrated successfully and continues
+# other rows from their first incomplete step (no duplicate resources). Off (None) by default;
+# eg. "./migration_journal.jsonl"
+MIGRATION_JOURNAL = None
+
+# local index czo_id --> HS resource (from extended metadata of resources owned by CZO_ACCOUNTS), refreshed
+# at start (lists all resources of every account and reads the extended metadata of new/changed ones);
+# rows already on HS are updated in place instead of duplicated. Off (None) by default; eg. "./hs_resources.sqlite3"
+HS_RESOURCE_INDEX = None
 
 
 ## Keep Codes Below Unchanged ##
@@ -0,0 +1,260 @@
+import logging
+import os
+import shutil
+import threading
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+
+from settings import MORE_TMP, STAGING_MAX_MB, MB_TO_BYTE
+
+WORKSPACE_PREFIX = "ws"
+
+_staging_area = None
+_staging_area_lock = threading.Lock()
+# workspace of the row the current thread is migrating (see row_workspace)
+_local = threading.local()
+
+
+def _workspace_pid(name):
+    # ws-<pid>-<name>-<token>
+    parts = name.split("-")
+    if len(parts) < 3 or parts[0] != WORKSPACE_PREFIX:
+        return None
+    try:
+        return int(parts[1])
+    except ValueError:
+        return None
+
+
+def _pid_alive(pid):
+    if pid == os.getpid():
+        return True
+    if os.name == "nt":
+        # no way to probe a pid without side effects there; the other run is taken as gone
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _disk_usage(path):
+    if not os.path.isdir(path):
+        return os.lstat(path).st_size
+    nbytes = 0
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                nbytes += os.lstat(os.path.join(dir_path, file_name)).st_size
+            except OSError:
+                pass
+    return nbytes
+
+
+class Workspace(object):
+    """
+    Folder of the staging area holding the downloads of one row; every file gets a folder of its own (new_dir)
+    """
+
+    def __init__(self, area, name):
+        self.area = area
+        self.name = name
+        self.path = os.path.join(area.root, "{}-{}-{}-{}".format(WORKSPACE_PREFIX, os.getpid(), name,
+                                                                 uuid.uuid4().hex[:8]))
+        self.nbytes = 0
+
+    def new_dir(self, nbytes=0):
+        return self.area.new_dir(nbytes=nbytes, workspace=self)
+
+    def close(self):
+        self.area.close_workspace(self)
+
+
+class StagingArea(object):
+    """
+    Disk space under MORE_TMP where source files wait for their upload to HydroShare
+    Files are staged in per-row workspaces; new_dir() blocks while the bytes staged by all rows are over the quota,
+    except for the oldest workspace holding bytes, so that rows waiting for each other can't deadlock
+    (one row may overshoot the quota by its own files).
+    A file's bytes are given back when its folder is removed (remove_dir, after its upload) and the rest of
+    a row's when its workspace is closed (the row is done).
+    """
+
+    def __init__(self, root, max_mb):
+        self.root = os.path.abspath(root)
+        self._max_bytes = max_mb * MB_TO_BYTE
+        self._cond = threading.Condition()
+        self._used_bytes = 0
+        self._workspaces = []  # open workspaces, oldest first
+        self._dirs = {}  # folder -> {"workspace", "nbytes"}
+        self._shared = None  # for files staged outside of a row
+        self.stats = Counter()
+
+    def sweep(self):
+        """
+        Remove what runs that are gone left in the staging area: their workspaces and the folders of
+        older versions (MORE_TMP/<uuid4>, readme, prefetch)
+        :return: None
+        """
+        if not os.path.isdir(self.root):
+            return
+        removed = 0
+        nbytes = 0
+        for name in os.listdir(self.root):
+            pid = _workspace_pid(name)
+            if pid is not None and _pid_alive(pid):
+                continue
+            path = os.path.join(self.root, name)
+            try:
+                nbytes += _disk_usage(path)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+                removed += 1
+            except OSError as ex:
+                logging.warning("Failed to remove orphaned {}: {}".format(path, ex))
+        logging.info("Staging area {}: removed {} orphaned items ({:.2f} MB)".format(
+            self.root, removed, float(nbytes) / MB_TO_BYTE))
+
+    def open_workspace(self, name):
+        """
+        :param name: workspace name (eg. czo_id)
+        :return: Workspace; its folder is created with its first file
+        """
+        workspace = Workspace(self, name)
+        with self._cond:
+            self._workspaces.append(workspace)
+        return workspace
+
+    def _may_exceed(self, workspace):
+        for w in self._workspaces:
+            if w.nbytes > 0:
+                return w is workspace
+        return True
+
+    def new_dir(self, nbytes=0, workspace=None):
+        """
+        Create a folder for a file to be staged, waiting for nbytes to fit in the quota
+        :param nbytes: expected size of the file; 0 if unknown (see set_size)
+        :param workspace: Workspace; None for the workspace of the current row (see row_workspace)
+        :return: path to folder
+        """
+        if workspace is None:
+            workspace = current_workspace() or self._get_shared()
+        with self._cond:
+            waited = False
+            while self._used_bytes + nbytes > self._max_bytes and not self._may_exceed(workspace):
+                if not waited:
+                    logging.info("Staging area full ({:.2f} MB); {} waits".format(
+                        float(self._used_bytes) / MB_TO_BYTE, workspace.name))
+                    self.stats["waits"] += 1
+                    waited = True
+                self._cond.wait()
+            path = os.path.join(workspace.path, uuid.uuid4().hex)
+            self._dirs[path] = {"workspace": workspace, "nbytes": 0}
+            self._add_bytes(path, nbytes)
+        os.makedirs(path)
+        return path
+
+    def _add_bytes(self, path, nbytes):
+        entry = self._dirs[path]
+        entry["nbytes"] += nbytes
+        entry["workspace"].nbytes += nbytes
+        self._used_bytes += nbytes
+        self.stats["peak_bytes"] = max(self.stats["peak_bytes"], self._used_bytes)
+        if nbytes < 0:
+            self._cond.notify_all()
+
+    def set_size(self, path, nbytes):
+        """
+        Count the actual size of a staged file instead of the one expected by new_dir (never waits)
+        :param path: folder from new_dir
+        :param nbytes: bytes on disk
+        :return: None
+        """
+        with self._cond:
+            if path in self._dirs:
+                self._add_bytes(path, nbytes - self._dirs[path]["nbytes"])
+
+    def remove_dir(self, path):
+        """
+        Delete a staged folder and give its bytes back; folders outside the staging area are left alone
+        :param path: folder from new_dir
+        :return: None
+        """
+        path = os.path.abspath(path)
+        if not path.startswith(self.root + os.sep):
+            return
+        with self._cond:
+            entry = self._dirs.pop(path, None)
+            if entry is not None:
+                entry["workspace"].nbytes -= entry["nbytes"]
+                self._used_bytes -= entry["nbytes"]
+                self._cond.notify_all()
+        logging.info("DELTREE {}".format(path))
+        shutil.rmtree(path, ignore_errors=True)
+
+    def close_workspace(self, workspace):
+        """
+        Delete a workspace with whatever is left in it and give its bytes back
+        :param workspace: Workspace
+        :return: None
+        """
+        with self._cond:
+            for path in [path for path, entry in self._dirs.items() if entry["workspace"] is workspace]:
+                del self._dirs[path]
+            self._used_bytes -= workspace.nbytes
+            workspace.nbytes = 0
+            if workspace in self._workspaces:
+                self._workspaces.remove(workspace)
+            self._cond.notify_all()
+        shutil.rmtree(workspace.path, ignore_errors=True)
+
+    def _get_shared(self):
+        with self._cond:
+            if self._shared is None:
+                self._shared = Workspace(self, "shared")
+                self._workspaces.append(self._shared)
+            return self._shared
+
+    def get_stats(self):
+        """
+        :return: {"used_bytes", "peak_bytes", "waits"}
+        """
+        with self._cond:
+            return {"used_bytes": self._used_bytes,
+                    "peak_bytes": self.stats["peak_bytes"],
+                    "waits": self.stats["waits"]}
+
+
+def get_staging_area():
+    global _staging_area
+    with _staging_area_lock:
+        if _staging_area is None:
+            _staging_area = StagingArea(MORE_TMP, STAGING_MAX_MB)
+        return _staging_area
+
+
+def current_workspace():
+    return getattr(_local, "workspace", None)
+
+
+@contextmanager
+def row_workspace(name):
+    """
+    Stage the files downloaded by the current thread in a workspace of their own and delete it on exit
+    :param name: workspace name (eg. czo_id)
+    :return: Workspace
+    """
+    workspace = get_staging_area().open_workspace(name)
+    _local.workspace = workspace
+    try:
+        yield workspace
+    finally:
+        _local.workspace = None
+        workspace.close()
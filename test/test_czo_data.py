@@ -0,0 +1,112 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import czo_data
+from czo_data import COMPONENT_FILES_COLUMN, FILES_TABLE_COLUMNS, build_files_table, explode_packed, load_czo_tables
+
+ROWS = [
+    {"czo_id": 1,
+     COMPONENT_FILES_COLUMN: "Farm$Stage$http://example.org/a.csv$$Y$10.1/x$http://example.org/a_meta.txt | "
+                             "malformed$component | "
+                             "Field$Flow$http://example.org/page$$$$",
+     "map_uploads": "http://example.org/map.png",
+     "kml_files": "http://example.org/sites.kml"},
+    {"czo_id": 2, COMPONENT_FILES_COLUMN: "n/a", "map_uploads": None, "kml_files": ""},
+    {"czo_id": 3, COMPONENT_FILES_COLUMN: None, "map_uploads": "not a url", "kml_files": None},
+]
+
+
+def _files(rows=ROWS):
+    return build_files_table(pd.DataFrame(rows))
+
+
+def test_explode_packed():
+    packed = pd.Series(["a | b", "", None, "n/a", " NA ", "c", np.nan])
+    items = explode_packed(np.arange(len(packed)), packed)
+    assert items.values.tolist() == [[0, 0, "a"], [0, 1, "b"], [5, 0, "c"]]
+    assert items["item"].dtype == object
+
+
+def test_explode_packed_no_items():
+    items = explode_packed(np.arange(2), pd.Series([None, "n/a"]))
+    assert items.shape[0] == 0
+    # .str works on the items of rows without any
+    assert items["item"].dtype == object
+    assert items["item"].str.strip().tolist() == []
+
+
+def test_files_table_order():
+    files = _files()
+    assert list(files.columns) == FILES_TABLE_COLUMNS
+    row_1 = files[files["czo_id"] == 1]
+    # each component followed by its metadata file, then maps, then kml files
+    assert row_1["kind"].tolist() == ["component", "metadata", "component", "component", "metadata", "map", "kml"]
+    assert row_1["seq"].tolist() == list(range(7))
+    assert row_1["url"].tolist() == ["http://example.org/a.csv", "http://example.org/a_meta.txt", None,
+                                     "http://example.org/page", "", "http://example.org/map.png",
+                                     "http://example.org/sites.kml"]
+    assert row_1["tag"].tolist() == [None, None, None, None, None, "map", "map"]
+
+
+def test_files_table_fields():
+    files = _files().set_index(["czo_id", "seq"])
+    component = files.loc[(1, 0)]
+    assert (component["location"], component["topic"], component["doi"]) == ("Farm", "Stage", "10.1/x")
+    assert component["is_private"] and component["parse_ok"]
+    assert component["extension_class"] == "supported"
+    # the metadata file goes with its component, private flag included
+    metadata = files.loc[(1, 1)]
+    assert (metadata["location"], metadata["is_private"], metadata["extension_class"]) == ("Farm", True, "supported")
+    assert files.loc[(1, 3), "extension_class"] == "unsupported"
+    # component without metadata_url
+    assert files.loc[(1, 4), "url"] == ""
+    assert files.loc[(1, 4), "extension_class"] == "invalid"
+
+
+def test_files_table_malformed_component():
+    malformed = _files().set_index(["czo_id", "seq"]).loc[(1, 2)]
+    assert not malformed["parse_ok"]
+    assert not malformed["url_valid"]
+    assert all(malformed[field] is None for field in czo_data.COMPONENT_FIELDS)
+    # no metadata row for it
+    assert _files()["kind"].tolist().count("metadata") == 2
+
+
+def test_files_table_empty_fields():
+    files = _files()
+    # "n/a" and empty packed fields have no files; a bad map url is kept (and classified as invalid)
+    assert files[files["czo_id"] == 2].shape[0] == 0
+    row_3 = files[files["czo_id"] == 3]
+    assert row_3[["kind", "url", "url_valid", "extension_class"]].values.tolist() == \
+        [["map", "not a url", False, "invalid"]]
+
+
+def test_files_table_no_files():
+    files = _files(ROWS[1:2])
+    assert files.shape[0] == 0
+    assert list(files.columns) == FILES_TABLE_COLUMNS
+
+
+def test_files_table_missing_values_are_none():
+    files = _files()
+    for column in files.columns:
+        if files[column].dtype == object:
+            assert not any(isinstance(v, float) for v in files[column]), column
+
+
+def test_snapshot_matches_csv(tmp_path):
+    pytest.importorskip("pyarrow")
+    csv_path = str(tmp_path / "export.csv")
+    pd.DataFrame(ROWS).to_csv(csv_path, index=False)
+    snapshot_dir = str(tmp_path / "snapshots")
+
+    df, files = load_czo_tables(csv_path, snapshot_dir=None)
+    df_built, files_built = load_czo_tables(csv_path, snapshot_dir=snapshot_dir)
+    df_loaded, files_loaded = load_czo_tables(csv_path, snapshot_dir=snapshot_dir)
+    assert len(list((tmp_path / "snapshots").iterdir())) == 2
+
+    for other_df, other_files in [(df_built, files_built), (df_loaded, files_loaded)]:
+        pd.testing.assert_frame_equal(df, other_df)
+        pd.testing.assert_frame_equal(files, other_files)
+        assert files.to_dict(orient="records") == other_files.to_dict(orient="records")
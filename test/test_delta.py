@@ -0,0 +1,131 @@
+import pandas as pd
+import pytest
+
+import dead_urls
+import file_ops
+from accounts import CZOHSAccount
+from czo_data import COMPONENT_FILES_COLUMN, CZODataset
+from dead_urls import DeadUrlRegistry
+from delta import diff_exports, plan_delta, plan_delta_row
+from settings import CZO_ACCOUNTS
+
+# an IML row of a bundled export as template of the rows below
+TEMPLATE_CSV = "./data/IMLCZODatasetsMetadata20191014.csv"
+
+
+def _component(location, url, metadata_url=""):
+    return "{}$Stage${}$$$${}".format(location, url, metadata_url)
+
+
+def _export(tmp_path, name, rows):
+    """
+    :param rows: {czo_id: {column: value}}
+    :return: CZODataset
+    """
+    template = pd.read_csv(TEMPLATE_CSV, encoding='utf-8-sig').iloc[0]
+    df = pd.DataFrame([template] * len(rows)).reset_index(drop=True)
+    for i, (czo_id, values) in enumerate(rows.items()):
+        df.loc[i, "czo_id"] = czo_id
+        for column, value in values.items():
+            df.loc[i, column] = value
+    csv_path = str(tmp_path / "{}.csv".format(name))
+    df.to_csv(csv_path, index=False)
+    return CZODataset(csv_path, snapshot_dir=None)
+
+
+OLD_B_FILES = "|".join([_component("Farm", "http://example.org/a.csv", "http://example.org/a_meta.txt"),
+                        _component("Farm", "http://example.org/b.csv"),
+                        _component("Farm", "http://example.org/c_v1.csv"),
+                        _component("Farm", "http://example.org/gone.csv")])
+# b.csv moved to another location (file replaced), c_v1.csv renamed to c_v2.csv, gone.csv dropped
+NEW_B_FILES = "|".join([_component("Farm", "http://example.org/a.csv", "http://example.org/a_meta.txt"),
+                        _component("Field", "http://example.org/b.csv"),
+                        _component("Farm", "http://example.org/c_v2.csv")])
+
+
+@pytest.fixture
+def exports(tmp_path):
+    old = _export(tmp_path, "old", {1: {"title": "Old title"},
+                                    2: {COMPONENT_FILES_COLUMN: OLD_B_FILES},
+                                    3: {}})
+    new = _export(tmp_path, "new", {1: {"title": "New title"},
+                                    2: {COMPONENT_FILES_COLUMN: NEW_B_FILES},
+                                    4: {}})
+    return old, new
+
+
+@pytest.fixture
+def probed_urls(tmp_path, monkeypatch):
+    # every url looked up (HEAD); no dead urls
+    monkeypatch.setattr(dead_urls, "_dead_url_registry", DeadUrlRegistry(str(tmp_path / "dead_urls.sqlite3"), 1))
+    urls = []
+    monkeypatch.setattr(file_ops, "check_file_size_mb", lambda url: urls.append(url) or 1.0)
+    return urls
+
+
+class _FakeIndex(object):
+
+    def __init__(self, czo_ids):
+        self.czo_ids = czo_ids
+
+    def get(self, czo_id):
+        return {"hs_id": "hs{}".format(czo_id), "uname": "czo_iml"} if czo_id in self.czo_ids else None
+
+    def get_hs_id(self, czo_id):
+        entry = self.get(czo_id)
+        return None if entry is None else entry["hs_id"]
+
+
+def _changes(report, change):
+    return sorted((row["czo_id"], row["detail"]) for row in report.to_dict(orient="records")
+                  if row["change"] == change)
+
+
+def test_diff_exports(exports):
+    old, new = exports
+    report = diff_exports(old, new)
+    assert _changes(report, "added") == [(4, "")]
+    assert _changes(report, "removed") == [(3, "")]
+    # the file column isn't a metadata change; unchanged values of other columns (NaN, floats) aren't either
+    assert _changes(report, "metadata") == [(1, "title")]
+    assert _changes(report, "file_removed") == [(2, "http://example.org/b.csv"), (2, "http://example.org/c_v1.csv"),
+                                                (2, "http://example.org/gone.csv")]
+    assert _changes(report, "file_added") == [(2, "http://example.org/b.csv"), (2, "http://example.org/c_v2.csv")]
+
+
+def test_plan_metadata_only_change(exports, probed_urls):
+    old, new = exports
+    report = diff_exports(old, new)
+    changes = report[report["czo_id"] == 1].to_dict(orient="records")
+    plan = plan_delta_row(1, changes, old, new, CZOHSAccount(CZO_ACCOUNTS), delta_id="delta:old:new")
+    assert plan["ok"]
+    assert plan["journal_id"] == "delta:old:new:1"
+    assert plan["ops"] == [{"op": "update_metadata", "message": "Title", "metadata": {"title": "New title"}}]
+    assert probed_urls == []
+
+
+def test_plan_file_changes(exports, probed_urls):
+    old, new = exports
+    report = diff_exports(old, new)
+    changes = report[report["czo_id"] == 2].to_dict(orient="records")
+    plan = plan_delta_row(2, changes, old, new, CZOHSAccount(CZO_ACCOUNTS))
+    assert [(op["op"], op["file_name"]) for op in plan["ops"] if op["op"] == "delete_file"] == \
+        [("delete_file", "b.csv"), ("delete_file", "c_v1.csv"), ("delete_file", "gone.csv")]
+    add_files = [op["file"] for op in plan["ops"] if op["op"] == "add_file"]
+    assert [(f["file_name"], f["file_type"]) for f in add_files] == [("b.csv", ""), ("c_v2.csv", "")]
+    assert add_files[0]["metadata"]["extra_metadata"]["location"] == "Field"
+    # deletes go before the adds so that a replaced file keeps its name
+    assert [op["op"] for op in plan["ops"]] == ["delete_file"] * 3 + ["add_file"] * 2
+    # only the added files are looked up
+    assert sorted(probed_urls) == ["http://example.org/b.csv", "http://example.org/c_v2.csv"]
+
+
+def test_plan_delta(exports, probed_urls):
+    old, new = exports
+    report = diff_exports(old, new)
+    # row 1 has no resource on HS: migrated as new, like row 4
+    new_czo_ids, plans = plan_delta(report, old, new, CZOHSAccount(CZO_ACCOUNTS), _FakeIndex([2, 3]))
+    assert new_czo_ids == [1, 4]
+    # removed row 3 is only reported; its resource is left alone
+    assert [str(plan["czo_id"]) for plan in plans] == ["2"]
+    assert len([op for op in plans[0]["ops"] if op["op"] == "delete_file"]) == 3
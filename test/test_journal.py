@@ -0,0 +1,186 @@
+import json
+
+import numpy as np
+import pytest
+
+import api_helpers
+from api_helpers import apply_hs_res_plan, get_op_key
+from journal import MigrationJournal
+from migrate import _resumed
+
+SCOPE = "localhost:8000"
+
+
+@pytest.fixture
+def journal_path(tmp_path):
+    return str(tmp_path / "journal.jsonl")
+
+
+def _reload(journal, journal_path):
+    journal.close()
+    return MigrationJournal(journal_path, SCOPE)
+
+
+def _row_log(czo_id, success=True):
+    return {"success": success, "czo_id": czo_id, "hs_id": "abc", "uname": "czo", "public": True, "maps": [],
+            "ref_file_list": [], "bad_ref_file_list": [], "concrete_file_list": [], "error_msg_list": []}
+
+
+def _lookup(czo_id, success=True):
+    return {"czo_id": czo_id, "hs_id": "abc", "success": success, "uname": "czo"}
+
+
+def test_direct_mode_int_czo_ids(journal_path):
+    # direct runs journal czo_ids as they come from the csv
+    journal = MigrationJournal(journal_path, SCOPE)
+    journal.record_step(np.int64(7), "create_resource", "abc", "czo")
+    journal.record_row(7, _lookup(7), _row_log(7))
+    journal = _reload(journal, journal_path)
+    for czo_id in (7, "7", np.int64(7), 7.0):
+        assert list(journal.get_steps(czo_id).keys()) == ["create_resource"]
+        assert journal.get_completed_row(czo_id)["lookup"]["hs_id"] == "abc"
+    assert journal.completed_czo_ids() == ["7"]
+
+
+def test_apply_mode_str_czo_ids(journal_path):
+    # plans (and the journal_ids of delta plans) come with str ids
+    journal = MigrationJournal(journal_path, SCOPE)
+    journal.record_step("8", "create_resource", "abc", "czo")
+    journal.record_row("8", _lookup("8", success=False), _row_log("8", success=False))
+    journal.record_step("delta:a.csv:b.csv:9", "create_resource", "def", "czo")
+    journal = _reload(journal, journal_path)
+    assert "create_resource" in journal.get_steps(8)
+    assert journal.get_steps("delta:a.csv:b.csv:9")["create_resource"]["hs_id"] == "def"
+    # failed rows are resumed, not skipped
+    assert journal.get_completed_row(8) is None
+    assert journal.completed_czo_ids() == []
+
+
+def test_older_journal_with_int_ids(journal_path):
+    records = [{"type": "step", "czo_id": 5, "key": "create_resource", "hs_id": "abc", "uname": "czo", "ok": True,
+                "log": {}, "data": None, "scope": SCOPE},
+               {"type": "row", "czo_id": 5, "lookup": _lookup(5), "log": _row_log(5), "success": True,
+                "scope": SCOPE},
+               # another HydroShare server
+               {"type": "row", "czo_id": 6, "lookup": _lookup(6), "log": _row_log(6), "success": True,
+                "scope": "www.hydroshare.org:443"}]
+    with open(journal_path, 'w') as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+        # cut short by a crash
+        f.write('{"type": "step", "czo_id": 5, "ke')
+    journal = MigrationJournal(journal_path, SCOPE)
+    assert "create_resource" in journal.get_steps("5")
+    assert journal.get_completed_row("5") is not None
+    assert journal.get_completed_row(6) is None
+    # new records of the same row go with the old ones
+    journal.record_step(5, "make_public", "abc", "czo")
+    journal = _reload(journal, journal_path)
+    assert sorted(journal.get_steps(5).keys()) == ["create_resource", "make_public"]
+
+
+def test_resumed_skips_finished_rows(journal_path):
+    journal = MigrationJournal(journal_path, SCOPE)
+    journal.record_row(7, _lookup(7), _row_log(7))
+    journal.record_row("8", _lookup("8", success=False), _row_log("8", success=False))
+    journal = _reload(journal, journal_path)
+    results = []
+
+    def _on_result(lookup, log):
+        results.append((lookup, log))
+
+    assert _resumed(journal, "7", _on_result)
+    assert not _resumed(journal, 8, _on_result)
+    assert len(results) == 1
+    assert results[0][0]["czo_id"] == 7
+    # journals written before file ops were batched
+    assert results[0][1]["file_op_failures"] == []
+
+
+class _Response(object):
+    status_code = 200
+    text = ""
+
+
+class _FakeResource(object):
+
+    def __init__(self, calls):
+        self.functions = self
+        self.files = self
+        self._calls = calls
+
+    def set_file_type(self, options):
+        self._calls.append(("set_file_type", options["file_path"]))
+        return _Response()
+
+    def metadata(self, file_id, metadata):
+        self._calls.append(("metadata", file_id))
+        return _Response()
+
+
+class _FakeHS(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def resource(self, hs_id):
+        return _FakeResource(self.calls)
+
+    def createResource(self, *args, **kwargs):
+        self.calls.append(("createResource",))
+
+    def addResourceFile(self, hs_id, path):
+        self.calls.append(("addResourceFile", path))
+
+    def setAccessRules(self, hs_id, public=True):
+        self.calls.append(("setAccessRules",))
+
+
+class _FakeAccounts(object):
+
+    def __init__(self, hs):
+        self.hs = hs
+
+    def get_hs_by_uname(self, uname):
+        return self.hs
+
+
+def _add_file_op(name):
+    return {"op": "add_file", "file": {"original_url": "http://example.org/{}".format(name), "file_name": name,
+                                       "file_type": "", "metadata": {}}}
+
+
+def test_resumed_plan_skips_finished_steps(journal_path, monkeypatch):
+    monkeypatch.setattr(api_helpers, "FILE_OPS_BATCH", True)
+    monkeypatch.setattr(api_helpers, "FILE_BUNDLE", False)
+    done_file, file_op_pending, new_file = _add_file_op("a.csv"), _add_file_op("b.csv"), _add_file_op("c.csv")
+    plan = {"czo_id": 7, "index": 1, "ok": True, "uname": "czo", "file_errors": 0, "error_msg_list": [],
+            "ops": [{"op": "create_resource", "resource_type": "CompositeResource", "title": "t"},
+                    done_file, file_op_pending, new_file, {"op": "make_public"}]}
+
+    # an earlier direct run: resource created, a.csv added with its file op, b.csv added but not its file op
+    journal = MigrationJournal(journal_path, SCOPE)
+    journal.record_step(7, "create_resource", "abc", "czo")
+    for op in (done_file, file_op_pending):
+        file_name = op["file"]["file_name"]
+        journal.record_step(7, get_op_key(op), "abc", "czo", log_delta={"concrete_file_list": [op["file"]]},
+                            data={"file_name": file_name, "file_id": file_name, "set_file_type": True,
+                                  "metadata": {}})
+    journal.record_step(7, "file_op:a.csv", "abc", "czo")
+    journal = _reload(journal, journal_path)
+
+    added = []
+    monkeypatch.setattr(api_helpers, "_add_file", lambda hs, hs_id, f, migration_log, file_ops=None,
+                        hs_file_path=None: added.append(f["file_name"]) or True)
+    hs = _FakeHS()
+    migration_log = apply_hs_res_plan(plan, _FakeAccounts(hs), journal=journal)
+
+    assert migration_log["success"]
+    assert migration_log["hs_id"] == "abc"
+    assert ("createResource",) not in hs.calls
+    assert added == ["c.csv"]
+    # only the file op b.csv was missing is run again
+    assert hs.calls == [("set_file_type", "b.csv"), ("metadata", "b.csv"), ("setAccessRules",)]
+    assert [f["file_name"] for f in migration_log["concrete_file_list"]] == ["a.csv", "b.csv"]
+    steps = journal.get_steps("7")
+    assert "file_op:b.csv" in steps and "make_public" in steps
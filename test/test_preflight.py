@@ -0,0 +1,105 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from czo_data import COMPONENT_FILES_COLUMN, CZODataset
+from preflight import PREFLIGHT_REPORT_COLUMNS, check_rows, run_preflight
+
+GRANTS_COLUMN = "AWARD_GRANT_NUMBERS-grant_number$funding_agency$url_for_grant"
+LINKS_COLUMN = "EXTERNAL_LINKS-url$link_text"
+
+GOOD_ROW = {"CZOS": "IML", "title": "A title", "description": "A description", "location": "Farm",
+            "date_start": "10/13/15", "date_end": "3/11/16", "TOPICS": "Stage",
+            "north_lat": 40.1, "south_lat": 40.0, "east_long": -88.6, "west_long": -88.7,
+            GRANTS_COLUMN: "123$NSF$http://nsf.gov | 456$NSF$", LINKS_COLUMN: "http://example.org$Example",
+            "RELATED_DATASETS": "1 | 2", COMPONENT_FILES_COLUMN: "Farm$Stage$http://example.org/a.csv$$$$"}
+
+# czo_id -> changed values
+ROWS = {1: {},
+        2: {},
+        3: {"title": "n/a", "description": np.nan},
+        4: {"north_lat": "north", "east_long": 200},
+        5: {"south_lat": 40.2, "west_long": -88.5},
+        6: {"date_start": "someday"},
+        7: {"date_start": "3/11/16", "date_end": "10/13/15"},
+        8: {GRANTS_COLUMN: "123$NSF", LINKS_COLUMN: "http://example.org"},
+        9: {"RELATED_DATASETS": "1 | 99 | x"},
+        10: {"date_end": np.nan, GRANTS_COLUMN: "n/a", "RELATED_DATASETS": ""}}
+
+
+def _czo_df(rows=ROWS):
+    records = []
+    for czo_id, values in rows.items():
+        record = dict(GOOD_ROW, czo_id=czo_id)
+        record.update(values)
+        records.append(record)
+    return pd.DataFrame(records)
+
+
+def _issues(report, czo_id):
+    return sorted((row["severity"], row["check"], row["column"])
+                  for row in report[report["czo_id"] == czo_id].to_dict(orient="records"))
+
+
+@pytest.fixture
+def report():
+    return check_rows(_czo_df(), list(ROWS.keys()))
+
+
+def test_report_columns(report):
+    assert list(report.columns) == PREFLIGHT_REPORT_COLUMNS
+
+
+@pytest.mark.parametrize("czo_id", [1, 2, 10])
+def test_valid_rows(report, czo_id):
+    assert _issues(report, czo_id) == []
+
+
+def test_missing_required_values(report):
+    assert _issues(report, 3) == [("error", "required", "description"), ("error", "required", "title")]
+
+
+def test_bbox_values(report):
+    assert _issues(report, 4) == [("error", "bbox", "east_long"), ("error", "bbox", "north_lat")]
+
+
+def test_bbox_order_is_a_warning(report):
+    assert _issues(report, 5) == [("warning", "bbox", "south_lat"), ("warning", "bbox", "west_long")]
+
+
+def test_dates(report):
+    assert _issues(report, 6) == [("error", "date", "date_start")]
+    assert _issues(report, 7) == [("error", "date", "date_end")]
+
+
+def test_arity(report):
+    assert _issues(report, 8) == [("error", "arity", GRANTS_COLUMN), ("error", "arity", LINKS_COLUMN)]
+
+
+def test_related_datasets(report):
+    assert _issues(report, 9) == [("warning", "related", "RELATED_DATASETS")]
+
+
+def test_missing_required_column():
+    report = check_rows(_czo_df({1: {}, 2: {}}).drop(columns=["TOPICS"]), [1, 2])
+    assert _issues(report, 1) == _issues(report, 2) == [("error", "required", "TOPICS")]
+
+
+def test_run_preflight(tmp_path):
+    csv_path = str(tmp_path / "export.csv")
+    _czo_df().to_csv(csv_path, index=False)
+    report_path = str(tmp_path / "preflight.csv")
+    czo_id_list = run_preflight(CZODataset(csv_path, snapshot_dir=None), [1, 3, 5, 9, 42], report_path)
+    # errors and unknown czo_ids are skipped; rows with warnings only are migrated
+    assert czo_id_list == [1, 5, 9]
+    report = pd.read_csv(report_path)
+    assert _issues(report, 42) == [("error", "czo_id", "czo_id")]
+
+
+@pytest.mark.parametrize("csv_path", ["./data/IMLCZODatasetsMetadata2020-02-07.csv",
+                                      "./data/CZO-datasets-metadata-2019-10-29.csv"])
+def test_bundled_exports_not_shrunk(csv_path):
+    # all rows of the bundled exports were migrated without the check
+    czo_dataset = CZODataset(csv_path, snapshot_dir=None)
+    report = check_rows(czo_dataset.data, czo_dataset.czo_ids())
+    assert report[report["severity"] == "error"].shape[0] == 0
@@ -0,0 +1,203 @@
+import socket
+import threading
+import time
+
+import pytest
+import requests
+
+import retry_policy
+import util
+from rate_limit import HostRateLimiter, parse_retry_after
+from retry_policy import CircuitBreaker, CircuitOpenError, RetryError, RetryStats, is_dns_failure, is_retryable
+from util import retry_func
+
+
+def _connection_error(cause):
+    # requests wraps the resolver error the way urllib3 raises it
+    try:
+        try:
+            raise cause
+        except socket.gaierror as ex:
+            raise requests.exceptions.ConnectionError("Max retries exceeded: {}".format(ex)) from ex
+    except requests.exceptions.ConnectionError as ex:
+        return ex
+
+
+def _http_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.exceptions.HTTPError("{} error".format(status_code), response=response)
+
+
+def test_nxdomain_is_terminal():
+    ex = _connection_error(socket.gaierror(socket.EAI_NONAME, "Name or service not known"))
+    assert is_dns_failure(ex)
+    assert not is_retryable(ex)
+
+
+def test_eai_again_is_retryable():
+    ex = _connection_error(socket.gaierror(socket.EAI_AGAIN, "Temporary failure in name resolution"))
+    assert not is_dns_failure(ex)
+    assert is_retryable(ex)
+    # same error only known from its message (eg. re-raised by urllib3 as text)
+    ex = requests.exceptions.ConnectionError("Failed to establish a new connection: "
+                                             "[Errno -3] Temporary failure in name resolution")
+    assert not is_dns_failure(ex)
+    assert is_retryable(ex)
+
+
+def test_connection_refused_is_retryable():
+    assert is_retryable(requests.exceptions.ConnectionError("Connection refused"))
+
+
+@pytest.mark.parametrize("status_code, retryable", [(429, True), (408, True), (500, True), (503, True),
+                                                     (400, False), (403, False), (404, False), (410, False)])
+def test_http_status_retryable(status_code, retryable):
+    assert is_retryable(_http_error(status_code)) == retryable
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("120") == 120.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("soon") is None
+    http_date = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(time.time() + 60))
+    assert 55 <= parse_retry_after(http_date) <= 60
+    past_date = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(time.time() - 60))
+    assert parse_retry_after(past_date) == 0.0
+
+
+def test_retry_after_pauses_host():
+    rate_limiter = HostRateLimiter(10, 1, 5)
+    url = "http://example.org/file.csv"
+    rate_limiter.report(url, status_code=429, retry_after="30")
+    stats = rate_limiter.get_stats()[0]
+    assert stats["throttled"] == 1
+    assert stats["rate"] == 5
+    assert 29 <= rate_limiter._get_state("example.org").blocked_until - time.time() <= 30
+    # a 404 says nothing about the host's load
+    rate_limiter.report(url, status_code=404)
+    assert rate_limiter.get_stats()[0]["throttled"] == 1
+
+
+def _open_circuit(circuit_breaker, host):
+    for _ in range(circuit_breaker.threshold):
+        circuit_breaker.check(host)
+        circuit_breaker.record_failure(host, requests.exceptions.ConnectionError("Connection refused"))
+    with pytest.raises(CircuitOpenError):
+        circuit_breaker.check(host)
+
+
+def _check_in_thread(circuit_breaker, host):
+    errors = []
+
+    def _check():
+        try:
+            circuit_breaker.check(host)
+        except CircuitOpenError as ex:
+            errors.append(ex)
+
+    t = threading.Thread(target=_check)
+    t.start()
+    t.join()
+    return len(errors) == 0
+
+
+def test_circuit_single_probe_after_cooldown():
+    circuit_breaker = CircuitBreaker(2, 0.05)
+    host = "example.org"
+    _open_circuit(circuit_breaker, host)
+    time.sleep(0.1)
+    # half-open: this thread probes, everybody else keeps failing fast
+    circuit_breaker.check(host)
+    assert not _check_in_thread(circuit_breaker, host)
+    assert not _check_in_thread(circuit_breaker, host)
+    circuit_breaker.record_success(host)
+    assert _check_in_thread(circuit_breaker, host)
+
+
+def test_circuit_failed_probe_opens_again():
+    circuit_breaker = CircuitBreaker(2, 0.05)
+    host = "example.org"
+    _open_circuit(circuit_breaker, host)
+    time.sleep(0.1)
+    circuit_breaker.check(host)
+    circuit_breaker.record_failure(host, requests.exceptions.ConnectionError("Connection refused"))
+    # one failed probe is enough, no need to reach the threshold again
+    with pytest.raises(CircuitOpenError):
+        circuit_breaker.check(host)
+    time.sleep(0.1)
+    circuit_breaker.check(host)
+
+
+def test_circuit_probe_answered_with_404_closes():
+    circuit_breaker = CircuitBreaker(2, 0.05)
+    host = "example.org"
+    _open_circuit(circuit_breaker, host)
+    time.sleep(0.1)
+    circuit_breaker.check(host)
+    circuit_breaker.record_failure(host, _http_error(404))
+    assert _check_in_thread(circuit_breaker, host)
+
+
+class _FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, sec):
+        self.sleeps.append(sec)
+        self.now += sec
+
+
+@pytest.fixture
+def fake_clock(monkeypatch):
+    clock = _FakeClock()
+    clock.stats = RetryStats()
+    monkeypatch.setattr(util, "time", clock)
+    monkeypatch.setattr(util, "get_retry_stats", lambda: clock.stats)
+    # full backoff delays: 1, 2, 4, 8 ... sec
+    monkeypatch.setattr(retry_policy.random, "uniform", lambda a, b: b)
+    return clock
+
+
+def test_retry_stops_at_time_budget(fake_clock):
+    def fun():
+        raise requests.exceptions.ConnectionError("Connection refused")
+
+    with pytest.raises(RetryError) as ex_info:
+        retry_func(fun, max_tries=10, interval_sec=1, time_budget_sec=10)
+    # 1 + 2 + 4 sec slept; waiting another 8 sec would pass the 10 sec budget
+    assert fake_clock.sleeps == [1, 2, 4]
+    assert ex_info.value.retryable
+    stats = list(fake_clock.stats.get_stats().values())[0]
+    assert stats == {"calls": 1, "attempts": 4, "failed": 1, "slept_sec": 7}
+
+
+def test_retry_terminal_error_not_retried(fake_clock):
+    def fun():
+        raise _http_error(404)
+
+    with pytest.raises(RetryError) as ex_info:
+        retry_func(fun, max_tries=10, interval_sec=1, time_budget_sec=10)
+    assert fake_clock.sleeps == []
+    assert not ex_info.value.retryable
+    assert isinstance(ex_info.value.last_exception, requests.exceptions.HTTPError)
+
+
+def test_retry_succeeds_after_retryable_errors(fake_clock):
+    calls = []
+
+    def fun():
+        calls.append(1)
+        if len(calls) < 3:
+            raise _http_error(503)
+        return "ok"
+
+    assert retry_func(fun, max_tries=4, interval_sec=1, time_budget_sec=10) == "ok"
+    assert fake_clock.sleeps == [1, 2]
+    stats = list(fake_clock.stats.get_stats().values())[0]
+    assert stats == {"calls": 1, "attempts": 3, "failed": 0, "slept_sec": 3}
@@ -0,0 +1,131 @@
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+import staging
+from settings import MB_TO_BYTE
+from staging import StagingArea, row_workspace, current_workspace
+
+# the quota is 1 MB
+BIG = int(0.6 * MB_TO_BYTE)
+
+
+@pytest.fixture
+def area(tmp_path):
+    return StagingArea(str(tmp_path / "staging"), 1)
+
+
+def _new_dir_in_thread(workspace, nbytes):
+    """
+    :return: (thread, list the folder is put in once new_dir returns)
+    """
+    paths = []
+    t = threading.Thread(target=lambda: paths.append(workspace.new_dir(nbytes=nbytes)), daemon=True)
+    t.start()
+    return t, paths
+
+
+def _blocked(t, paths):
+    t.join(0.2)
+    return t.is_alive() and len(paths) == 0
+
+
+def test_waiter_wakes_when_a_row_frees_its_bytes(area):
+    first = area.open_workspace("1")
+    second = area.open_workspace("2")
+    path = first.new_dir(nbytes=BIG)
+    assert os.path.isdir(path)
+
+    t, paths = _new_dir_in_thread(second, BIG)
+    assert _blocked(t, paths)
+    assert area.get_stats()["waits"] == 1
+
+    # the first row uploaded its file
+    area.remove_dir(path)
+    t.join(5)
+    assert len(paths) == 1 and os.path.isdir(paths[0])
+    assert not os.path.exists(path)
+    assert area.get_stats()["used_bytes"] == BIG
+
+
+def test_waiter_wakes_when_a_row_is_done(area):
+    first = area.open_workspace("1")
+    second = area.open_workspace("2")
+    first.new_dir(nbytes=BIG)
+    t, paths = _new_dir_in_thread(second, BIG)
+    assert _blocked(t, paths)
+    first.close()
+    t.join(5)
+    assert len(paths) == 1
+    assert not os.path.exists(first.path)
+
+
+def test_oldest_workspace_is_not_blocked(area):
+    first = area.open_workspace("1")
+    second = area.open_workspace("2")
+    # over the quota by its own files, so that rows waiting for each other can't deadlock
+    first.new_dir(nbytes=BIG)
+    first.new_dir(nbytes=BIG)
+    assert area.get_stats() == {"used_bytes": 2 * BIG, "peak_bytes": 2 * BIG, "waits": 0}
+
+    t, paths = _new_dir_in_thread(second, BIG)
+    assert _blocked(t, paths)
+    first.close()
+    t.join(5)
+    assert len(paths) == 1
+
+
+def test_actual_size_counts(area):
+    first = area.open_workspace("1")
+    second = area.open_workspace("2")
+    # size unknown when the download starts
+    path = first.new_dir()
+    area.set_size(path, BIG)
+    t, paths = _new_dir_in_thread(second, BIG)
+    assert _blocked(t, paths)
+    area.set_size(path, 1024)
+    t.join(5)
+    assert len(paths) == 1
+
+
+def test_row_workspace(area, monkeypatch):
+    monkeypatch.setattr(staging, "_staging_area", area)
+    with row_workspace("7") as workspace:
+        assert current_workspace() is workspace
+        path = area.new_dir(nbytes=1024)
+        assert os.path.dirname(path) == workspace.path
+    assert current_workspace() is None
+    assert not os.path.exists(workspace.path)
+    assert area.get_stats()["used_bytes"] == 0
+
+
+def _dead_pid():
+    p = subprocess.Popen([sys.executable, "-c", "pass"])
+    p.wait()
+    return p.pid
+
+
+def test_sweep_keeps_live_workspaces(area):
+    live = os.path.join(area.root, "ws-{}-7-abcd1234".format(os.getpid()))
+    dead = os.path.join(area.root, "ws-{}-8-abcd1234".format(_dead_pid()))
+    # folders and files of older versions
+    legacy_dir = os.path.join(area.root, "0123456789abcdef")
+    legacy_file = os.path.join(area.root, "readme.md")
+    for path in (live, dead, legacy_dir):
+        os.makedirs(os.path.join(path, "sub"))
+        with open(os.path.join(path, "sub", "file.csv"), 'w') as f:
+            f.write("x")
+    with open(legacy_file, 'w') as f:
+        f.write("x")
+
+    area.sweep()
+    assert sorted(os.listdir(area.root)) == [os.path.basename(live)]
+    assert os.path.isfile(os.path.join(live, "sub", "file.csv"))
+
+
+def test_sweep_without_staging_area(area):
+    area.sweep()
+    assert not os.path.exists(area.root)
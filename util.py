@@ -1,39 +1,139 @@
+import logging
 import time
 import tempfile
 import os
-from settings import README_FILENAME, MORE_TMP
+import hashlib
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from settings import README_FILENAME, RETRY_TIME_BUDGET_SEC
+from rate_limit import get_host
+from retry_policy import RetryError, is_retryable, backoff_delay, get_circuit_breaker, get_retry_stats
 
 
-def retry_func(fun, args=None, kwargs=None, max_tries=4, interval_sec=5, increase_interval=True, raise_on_failure=True):
+def _call_site(fun):
+    return getattr(fun, "__qualname__", None) or getattr(fun, "__name__", None) or str(fun)
+
+
+def _infer_host(args):
+    # source-file helpers take the url as first argument
+    if len(args) > 0 and isinstance(args[0], str) and args[0].lower().startswith(("http://", "https://")):
+        return get_host(args[0])
+    return None
+
+
+def retry_func(fun, args=None, kwargs=None, max_tries=4, interval_sec=5, increase_interval=True, raise_on_failure=True,
+               time_budget_sec=RETRY_TIME_BUDGET_SEC, host=None):
     """
-    :param fun:
-    :param args:
-    :param kwargs:
-    :param max_tries:
-    :param interval_sec:
-    :param increase_interval:
-    :return:
+    Call fun and retry it on retryable errors with exponential backoff and jitter.
+    Terminal errors (404 and other client errors, DNS failures, bad arguments) are not retried; a host that keeps
+    failing trips a circuit breaker so later calls to it fail fast. Attempts and sleep time are recorded per call site.
+    :param fun: function to call
+    :param args: positional arguments
+    :param kwargs: keyword arguments
+    :param max_tries: max attempts
+    :param interval_sec: base backoff interval
+    :param increase_interval: double the interval after every failed attempt
+    :param raise_on_failure: raise RetryError on giving up, otherwise return None
+    :param time_budget_sec: stop retrying once the next sleep would pass this many seconds since the first attempt
+    :param host: host for the circuit breaker; inferred from a url as first positional argument if not given
+    :return: result of fun
     """
     pass_on_args = args if args else []
     pass_on_kwargs = kwargs if kwargs else {}
-
+    host = host if host is not None else _infer_host(pass_on_args)
+    circuit_breaker = get_circuit_breaker()
+
+    _start = time.time()
+    slept_sec = 0.0
+    attempts = 0
+    last_ex = None
+    retryable = True
     for i in range(max_tries):
+        attempts += 1
         try:
+            circuit_breaker.check(host)
             func_result = fun(*pass_on_args, **pass_on_kwargs)
+            circuit_breaker.record_success(host)
+            get_retry_stats().record(_call_site(fun), attempts, False, slept_sec)
             return func_result
         except Exception as ex:
-            if i == max_tries - 1 and raise_on_failure:
-                msg = "All {} attempts were failed to call {} with arguments: {} {}".format(max_tries,
-                                                                                       str(fun),
-                                                                                       str(pass_on_args),
-                                                                                       str(pass_on_kwargs))
-                raise Exception(msg)
-
-            if increase_interval:
-                time.sleep(interval_sec*(i+1))
-            else:
-                time.sleep(interval_sec)
-            continue
+            last_ex = ex
+            circuit_breaker.record_failure(host, ex)
+            retryable = is_retryable(ex)
+            if not retryable or i == max_tries - 1:
+                break
+            delay = backoff_delay(i, interval_sec, increase_interval=increase_interval)
+            if time.time() - _start + delay > time_budget_sec:
+                break
+            logging.warning("Attempt {} of {} failed: {}; retrying in {:.1f} sec".format(
+                attempts, _call_site(fun), ex, delay))
+            time.sleep(delay)
+            slept_sec += delay
+
+    get_retry_stats().record(_call_site(fun), attempts, True, slept_sec)
+    if raise_on_failure:
+        msg = "Gave up calling {} after {} attempts ({}) with arguments: {} {}: {}".format(
+            str(fun), attempts, "retryable" if retryable else "terminal",
+            str(pass_on_args), str(pass_on_kwargs), last_ex)
+        raise RetryError(msg, last_exception=last_ex, retryable=retryable)
+    return None
+
+
+def run_bounded_per_key(tasks, max_workers, max_per_key, on_result):
+    """
+    Run tasks in a thread pool with at most max_workers in flight in total and at most max_per_key per key
+    (eg. per HS account or per host). Tasks are dispatched from the calling thread in input order, skipping
+    those whose key is at capacity, so no worker ever sits blocked waiting for its key.
+    :param tasks: iterable of (key, fun, args)
+    :param max_workers: max tasks in flight
+    :param max_per_key: max tasks in flight with the same key
+    :param on_result: callback(key, args, result, exception) called in the calling thread in completion order
+    :return: None
+    """
+    if max_workers < 1 or max_per_key < 1:
+        # with no room for a task nothing would ever be dispatched
+        raise ValueError("max_workers and max_per_key must be at least 1 (got {} and {})".format(
+            max_workers, max_per_key))
+    pending = deque(tasks)
+    in_flight = {}  # future -> (key, args)
+    in_flight_per_key = Counter()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while len(pending) > 0 or len(in_flight) > 0:
+            waiting = deque()
+            while len(pending) > 0 and len(in_flight) < max_workers:
+                key, fun, args = pending.popleft()
+                if in_flight_per_key[key] >= max_per_key:
+                    waiting.append((key, fun, args))
+                    continue
+                in_flight[executor.submit(fun, *args)] = (key, args)
+                in_flight_per_key[key] += 1
+            waiting.extend(pending)
+            pending = waiting
+
+            done, _ = wait(list(in_flight.keys()), return_when=FIRST_COMPLETED)
+            for future in done:
+                key, args = in_flight.pop(future)
+                in_flight_per_key[key] -= 1
+                try:
+                    result = future.result()
+                except Exception as ex:
+                    on_result(key, args, None, ex)
+                else:
+                    on_result(key, args, result, None)
+
+
+def hash_string(_str):
+    hash_object = hashlib.md5(_str.encode())
+    return hash_object.hexdigest()
+
+
+def hash_file(f_path, chunk_size=1024*1024):
+    md5 = hashlib.md5()
+    with open(f_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
 
 
 def conditional_write(_heading, _text):
@@ -61,16 +161,15 @@ def normal_write(_heading, _text):
     return ""
 
 
-def gen_readme(rowdata, related_resources):
+def gen_readme(rowdata, related_resources, save_dir):
     """
     Create a readme from the mappings agreed on with CZOs and captured in markdown_map.json
     :param rowdata: dict data of row from csv
     :param related_resources: list of hydroshare resource ids
-    :return: save markdown file to tmp
+    :param save_dir: folder to save the readme to (eg. a staging area workspace, see staging.py)
+    :return: path to markdown file
     """
-    # readme_path = os.path.join(tempfile.mkdtemp(), README_FILENAME)
-    readme_path = os.path.join(MORE_TMP, 'readme')  # TODO parameterize
-    readme_path = os.path.join(readme_path, README_FILENAME)
+    readme_path = os.path.join(save_dir, README_FILENAME)
 
     info = ''
     with open(os.path.join(readme_path), 'w', encoding='utf-8') as f: